@@ -18,6 +18,9 @@ import string
 import hashlib
 import logging
 import traceback
+import numpy
+from array import array
+from bisect import bisect_left, bisect_right
 from streamcorpus import OffsetType
 
 logger = logging.getLogger('kba-toy-system')
@@ -32,21 +35,102 @@ slot_names = dict(
     ORG = ['Affiliate', 'TopMembers', 'FoundedBy']
     )
 
-## make a unicode translation table to converts all punctuation to white space
-strip_punctuation = dict((ord(char), u" ") for char in string.punctuation)
+## ASCII punctuation and ASCII whitespace both become white space,
+## and each run of them collapses to a single space
+separators_re = re.compile(u"[\t\n\x0b\x0c\r %s]+" % re.escape(string.punctuation))
 
-white_space_re = re.compile("(\s|\n|\r)+")
+## increment this whenever strip_string or the construction of
+## Scorer.text and Scorer.sentences changes, so that stored copies of
+## normalized text are not reused, see toy_kba_cache.TextCache
+NORMALIZATION_VERSION = 1
 
 def strip_string(s):
     """
     strips punctuation and repeated whitespace from unicode strings
     """
-    return white_space_re.sub(" ", s.translate(strip_punctuation).lower())
+    ## punctuation and whitespace are replaced in the same pass, and
+    ## lowercasing never creates or removes either, so this makes one
+    ## less copy of s than translating punctuation separately
+    return separators_re.sub(u" ", s.lower())
+
+def strip_string_offsets(s):
+    """
+    Maps positions in strip_string(s) back to positions in s.
+
+    :returns array: offsets such that strip_string(s)[i] came from
+    s[offsets[i]], where a space that replaced a run of separators
+    maps to the start of the run.  There is one extra entry equal to
+    len(s) for the end of the string.
+    """
+    offsets = array('l')
+    source = 0
+    for match in separators_re.finditer(s):
+        start, end = match.span()
+        offsets.extend(xrange(source, start))
+        offsets.append(start)
+        source = end
+    offsets.extend(xrange(source, len(s)))
+    offsets.append(len(s))
+    return offsets
+
+def make_recall_filters(profiles, mode):
+    """
+    Creates a dict keyed on entity URLs with the values set to lists
+    of surface form names from the profiles: the values of the
+    upper-case slots in 'slots' mode, or the canonical_name and its
+    tokens in 'simple' mode.
+    """
+    recall_filters = {}
+    for target_id, data in profiles['entities'].iteritems():
+        recall_filters[target_id] = []
+        for slot_name, values in data['slots'].iteritems():
+            if slot_name.isupper() and mode == 'slots':
+                for val in values:
+                    recall_filters[target_id].append(val['value'])
+            elif mode == 'simple' and slot_name == 'canonical_name':
+                recall_filters[target_id].append(values)
+                recall_filters[target_id] += values.split()
+
+    return recall_filters
+
+class EntityRepresentation(object):
+    """
+    The parts of a target's names that the scorer looks for, the
+    length of the longest one, and the slots to fill for its
+    entity_type.  With many targets, slots keep these small, and
+    equal strings and slot_names tuples can be shared between them,
+    see toy_kba_cache.ProfileCache.
+    """
+    __slots__ = ('parts', 'longest', 'entity_type', 'slot_names')
+
+    def __init__(self, parts, longest, entity_type, slot_names):
+        self.parts = parts
+        self.longest = longest
+        self.entity_type = entity_type
+        self.slot_names = slot_names
+
+    def to_dict(self):
+        return dict(parts=list(self.parts), longest=self.longest,
+                    entity_type=self.entity_type,
+                    slot_names=list(self.slot_names))
+
+    @classmethod
+    def from_dict(cls, rec):
+        return cls(rec['parts'], rec['longest'], rec['entity_type'],
+                   rec['slot_names'])
+
+    ## classes with __slots__ only pickle with protocol 2 unless they
+    ## provide their own state
+    def __getstate__(self):
+        return (self.parts, self.longest, self.entity_type, self.slot_names)
+
+    def __setstate__(self, state):
+        self.parts, self.longest, self.entity_type, self.slot_names = state
 
 def prepare_entities(targets, recall_filters=None, slot_names=None):
     """
-    Creates a dict keyed on entity URLs with the values set to a
-    representation that is efficient for the scorer
+    Creates a dict keyed on entity URLs with the values set to an
+    EntityRepresentation, which is efficient for the scorer
     """
     if recall_filters is None:
         recall_filters = {}
@@ -76,47 +160,618 @@ def prepare_entities(targets, recall_filters=None, slot_names=None):
 
         assert len(names) > 0, target
             
-        prep[target_id] = dict(parts=names, longest=longest, 
-                               entity_type=target['entity_type'],
-                               slot_names=slot_names[target['entity_type']],
+        prep[target_id] = EntityRepresentation(
+            parts=names, longest=longest,
+            entity_type=target['entity_type'],
+            slot_names=slot_names[target['entity_type']],
         )
 
     return prep
 
 
-class Scorer:
-    def __init__(self, si):
+class EntityMatcher(object):
+    '''
+    Aho-Corasick automaton compiled from the output of
+    prepare_entities, so that one pass over a document's text finds
+    the name parts of every target at once, instead of one substring
+    scan per name part per target.
+    '''
+    def __init__(self, entity_representations):
+        ## map each distinct name string to a pattern index, and
+        ## remember every (target_id, part_index) that uses it.
+        ## Duplicate parts within a target are kept, because
+        ## NAMES_FRAC counts them once per occurrence in "parts".
+        self.patterns = []
+        self.pattern_targets = []
+        pattern_ids = {}
+        for target_id, entity_repr in entity_representations.iteritems():
+            for part_index, name in enumerate(entity_repr.parts):
+                pid = pattern_ids.get(name)
+                if pid is None:
+                    pid = pattern_ids[name] = len(self.patterns)
+                    self.patterns.append(name)
+                    self.pattern_targets.append([])
+                self.pattern_targets[pid].append((target_id, part_index))
+
+        ## empty names match everywhere, so handle them outside of
+        ## the automaton
+        self.empty_pattern = pattern_ids.get(u'')
+
+        ## build the trie: goto is a list of dicts from char to state
+        self.goto = [{}]
+        self.out = [()]
+        for pid, name in enumerate(self.patterns):
+            if not name:
+                continue
+            state = 0
+            for char in name:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.out.append(())
+                state = next_state
+            self.out[state] += (pid,)
+
+        ## breadth-first construction of failure links, merging the
+        ## outputs of each state's failure state into its own
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        while queue:
+            next_queue = []
+            for state in queue:
+                for char, next_state in self.goto[state].iteritems():
+                    fail = self.fail[state]
+                    while fail and char not in self.goto[fail]:
+                        fail = self.fail[fail]
+                    fail = self.goto[fail].get(char, 0)
+                    if fail == next_state:
+                        fail = 0
+                    self.fail[next_state] = fail
+                    self.out[next_state] += self.out[fail]
+                    next_queue.append(next_state)
+            queue = next_queue
+
+        ## the same name parts as numpy arrays, for batch_scores: the
+        ## columns of the targets, and the target column and rank of
+        ## every (target_id, part_index) that uses a pattern, grouped
+        ## by pattern
+        self.target_ids = sorted(entity_representations)
+        self.target_nums = dict((target_id, target_num)
+                                for target_num, target_id in enumerate(self.target_ids))
+        self.target_parts = [entity_representations[target_id].parts
+                             for target_id in self.target_ids]
+        self.target_longest = numpy.array(
+            [entity_representations[target_id].longest
+             for target_id in self.target_ids], numpy.float64)
+
+        ## a rank orders the uses of patterns by name length, and ties
+        ## by part_index, so that the largest rank of a target is its
+        ## longest observed name, as in Scorer.assess_target
+        self.rank_base = max([len(parts) for parts in self.target_parts] or [0]) + 1
+        usage_targets = []
+        usage_ranks = []
+        usage_starts = [0]
+        for pid, name in enumerate(self.patterns):
+            for target_id, part_index in self.pattern_targets[pid]:
+                usage_targets.append(self.target_nums[target_id])
+                usage_ranks.append(len(name) * self.rank_base +
+                                   self.rank_base - 1 - part_index)
+            usage_starts.append(len(usage_targets))
+        self.usage_targets = numpy.array(usage_targets, numpy.int64)
+        self.usage_ranks = numpy.array(usage_ranks, numpy.int64)
+        self.usage_starts = numpy.array(usage_starts, numpy.int64)
+
+    def count_patterns(self, text):
+        '''
+        Scans text once and returns a dict from pattern index to the
+        number of non-overlapping occurrences, counted left to right
+        exactly as unicode.count or re.findall would count them.
+        '''
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        patterns = self.patterns
+        counts = {}
+        next_free = {}
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pid in out[state]:
+                start = pos + 1 - len(patterns[pid])
+                if start >= next_free.get(pid, 0):
+                    counts[pid] = counts.get(pid, 0) + 1
+                    next_free[pid] = pos + 1
+
+        if self.empty_pattern is not None:
+            counts[self.empty_pattern] = len(text) + 1
+
+        return counts
+
+    def scan(self, text):
+        '''
+        Scans text once for the name parts of all targets.
+
+        :returns dict: target_id --> (longest_observed_name,
+        num_observed_names) for every target with at least one name
+        part in the text.  Ties for the longest name go to the part
+        that comes first in the entity representation, as in
+        Scorer.assess_target.
+        '''
+        observed = {}
+        for pid, count in self.count_patterns(text).iteritems():
+            name = self.patterns[pid]
+            for target_id, part_index in self.pattern_targets[pid]:
+                prev = observed.get(target_id)
+                if prev is None:
+                    observed[target_id] = [len(name), part_index, name, count]
+                else:
+                    if (len(name), -part_index) > (prev[0], -prev[1]):
+                        prev[0:3] = len(name), part_index, name
+                    prev[3] += count
+
+        return dict((target_id, (name, count))
+                    for target_id, (_, _, name, count) in observed.iteritems())
+
+    def batch_scores(self, pattern_counts, conf_heuristic=LEN_FRAC, cutoff=None):
+        '''
+        Scores a block of documents against every target at once.
+
+        :param pattern_counts: list of the output of count_patterns
+        for each document
+
+        :returns BatchScores: with a row for each document and a
+        column for each of self.target_ids
+        '''
+        shape = (len(pattern_counts), len(self.target_ids))
+
+        ## one entry for each pattern found in each document
+        doc_nums = []
+        pids = []
+        counts = []
+        for doc_num, doc_counts in enumerate(pattern_counts):
+            doc_nums.extend([doc_num] * len(doc_counts))
+            pids.extend(doc_counts.iterkeys())
+            counts.extend(doc_counts.itervalues())
+        pids = numpy.array(pids, numpy.int64)
+
+        ## expand each entry to the uses of its pattern by targets
+        starts = self.usage_starts[pids]
+        num_uses = self.usage_starts[pids + 1] - starts
+        first_use = numpy.cumsum(num_uses) - num_uses
+        usages = numpy.arange(num_uses.sum()) + numpy.repeat(starts - first_use, num_uses)
+        cells = numpy.repeat(numpy.array(doc_nums, numpy.int64), num_uses) * shape[1] + \
+            self.usage_targets[usages]
+
+        ## sum the counts and take the largest rank in each cell
+        count = numpy.bincount(
+            cells, numpy.repeat(numpy.array(counts, numpy.float64), num_uses),
+            shape[0] * shape[1]).astype(numpy.int64).reshape(shape)
+        rank = numpy.zeros(shape[0] * shape[1], numpy.int64)
+        order = numpy.lexsort((self.usage_ranks[usages], cells))
+        cells = cells[order]
+        last = numpy.ones(len(cells), bool)
+        last[:-1] = cells[1:] != cells[:-1]
+        rank[cells[last]] = self.usage_ranks[usages[order][last]]
+        rank = rank.reshape(shape)
+
+        longest = rank // self.rank_base
+        part = numpy.where(rank > 0, self.rank_base - 1 - rank % self.rank_base, -1)
+        confidence, relevance, contains_mention = confidences(
+            longest, count, self.target_longest, conf_heuristic)
+
+        selected = None
+        if cutoff is not None:
+            selected = confidence > cutoff
+
+        return BatchScores(self.target_ids, self.target_parts, longest, part,
+                           count, confidence, relevance, contains_mention, selected)
+
+def confidences(longest, count, entity_longest, conf_heuristic=LEN_FRAC):
+    '''
+    The confidence maths of Scorer.assess_target on numpy arrays of
+    the length of the longest observed name and the number of name
+    parts observed, for entities whose longest name is entity_longest.
+
+    :returns tuple: (confidence, relevance, contains_mention) arrays
+    '''
+    found = longest > 0
+    if conf_heuristic == NAMES_FRAC:
+        confidence = numpy.minimum(1000, count)
+
+    else:
+        assert conf_heuristic == LEN_FRAC
+        ## normalize score by length of longest name, which is
+        ## full_name, in thousandths; the same float operations as
+        ## int(1000 * (float(len) / longest)) in python
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            confidence = 1000 * (longest.astype(numpy.float64) / entity_longest)
+
+    ## zero confidence, relevance="garbage", non-mentioning, unless a
+    ## name part is found, and then hard coded "vital" and mentioning
+    ## for this toy system
+    confidence = numpy.where(found, confidence, 0).astype(numpy.int64)
+    relevance = numpy.where(found, 2, -1).astype(numpy.int8)
+    contains_mention = found.astype(numpy.int8)
+    return confidence, relevance, contains_mention
+
+class BatchScores(object):
+    '''
+    Output of score_batch, as numpy arrays with a row for each
+    document and a column for each of target_ids: the length of the
+    longest observed name part and its index in the target's parts
+    (-1 if none), the number of name parts observed, confidence,
+    relevance and contains_mention, and, if a cutoff was given,
+    whether confidence is above it.
+    '''
+    def __init__(self, target_ids, target_parts, longest, part, count,
+                 confidence, relevance, contains_mention, selected=None):
+        self.target_ids = target_ids
+        self.target_parts = target_parts
+        self.longest = longest
+        self.part = part
+        self.count = count
+        self.confidence = confidence
+        self.relevance = relevance
+        self.contains_mention = contains_mention
+        self.selected = selected
+
+    def observed_names(self, doc_num):
+        '''
+        :returns ObservedNames: the name parts observed in one
+        document, which does not hold on to the arrays of the whole
+        block
+        '''
+        targets = numpy.flatnonzero(self.part[doc_num] >= 0)
+        return ObservedNames(numpy.array([
+                    targets, self.longest[doc_num, targets],
+                    self.part[doc_num, targets], self.count[doc_num, targets]],
+                                         numpy.int64))
+
+    def observed(self, doc_num, target_num):
+        '''
+        :returns tuple: (longest_observed_name, num_observed_names),
+        as from EntityMatcher.scan
+        '''
+        part = self.part[doc_num, target_num]
+        if part < 0:
+            return '', 0
+        return self.target_parts[target_num][part], int(self.count[doc_num, target_num])
+
+class ObservedNames(object):
+    '''
+    The name parts observed in one document, for only the targets in
+    which at least one was observed, so that it stays small with many
+    targets: a 4 x N array of their columns in EntityMatcher.target_ids,
+    and for each, the length of the longest observed part, its index in
+    the target's parts and the number of parts observed.  The other
+    targets score zero under any conf_heuristic.
+    '''
+    __slots__ = ('observed',)
+
+    def __init__(self, observed):
+        self.observed = observed
+
+    def scores(self, matcher, conf_heuristic=LEN_FRAC, cutoff=None):
+        '''
+        :returns BatchScores: the document's row under conf_heuristic
+        and cutoff, with a column for each of matcher.target_ids
+        '''
+        targets, observed_longest, observed_part, observed_count = self.observed
+        shape = (1, len(matcher.target_ids))
+        longest = numpy.zeros(shape, numpy.int64)
+        part = numpy.empty(shape, numpy.int64)
+        part.fill(-1)
+        count = numpy.zeros(shape, numpy.int64)
+        longest[0, targets] = observed_longest
+        part[0, targets] = observed_part
+        count[0, targets] = observed_count
+
+        confidence, relevance, contains_mention = confidences(
+            longest, count, matcher.target_longest, conf_heuristic)
+        selected = None
+        if cutoff is not None:
+            selected = confidence > cutoff
+        return BatchScores(matcher.target_ids, matcher.target_parts, longest, part,
+                           count, confidence, relevance, contains_mention, selected)
+
+def score_batch(documents, entity_representations, conf_heuristic=LEN_FRAC,
+                cutoff=None, matcher=None):
+    '''
+    Scores a block of documents against all of the prepared entities
+    at once, see EntityMatcher.batch_scores.
+
+    :param documents: Scorers that are ready
+    :param matcher: optional EntityMatcher of entity_representations,
+    which is built if it is not provided
+
+    :returns BatchScores: with a row for each of documents and a
+    column for each target_id in entity_representations, in sorted
+    order
+    '''
+    if matcher is None:
+        matcher = EntityMatcher(entity_representations)
+    return matcher.batch_scores(
+        [matcher.count_patterns(scorer.text) for scorer in documents],
+        conf_heuristic, cutoff)
+
+
+## the only non-ASCII chars that unicode.lower maps to ASCII, capital
+## I with dot above to 'i' and the Kelvin sign to 'k', so that they
+## can become part of an ASCII name part
+_lower_to_ascii = [u'\u0130'.encode('utf8'), u'\u212a'.encode('utf8')]
+
+def trie_pattern(keys):
+    '''
+    Builds a regex that finds any of keys, with the alternatives
+    factored into a trie so that the regex engine does not try every
+    key at every position.  A key that extends another key is
+    dropped, because the shorter one already matches.
+    '''
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[None] = True
+
+    def build(node):
+        if None in node:
+            return ''
+        alts = [re.escape(char) + build(child)
+                for char, child in sorted(node.iteritems())]
+        if len(alts) == 1:
+            return alts[0]
+        return '(?:%s)' % '|'.join(alts)
+
+    return build(trie)
+
+class NamePrefilter(object):
+    '''
+    Rejects documents from their raw clean_visible bytes, before they
+    are decoded and normalized, when they cannot contain any name
+    part of entity_representations.  Such documents get zero
+    confidence from Scorer.assess_target for every target, so they
+    are never in a run with a cutoff of zero or more.
+
+    For each name part, the key is its longest run of ASCII chars
+    other than the spaces that strip_string puts between tokens.  If
+    the part is in Scorer.text, then its key is in the lowercased
+    clean_visible, which differs from the raw bytes only in the case
+    of ASCII letters or in the few non-ASCII chars that lowercase to
+    ASCII, which are also looked for.  A part without any ASCII chars
+    other than spaces, such as u' ' from a recall filter of "-", cannot
+    be found this way, so then every document is a candidate.
+    '''
+    def __init__(self, entity_representations):
+        keys = set()
+        self.usable = True
+        for entity_repr in entity_representations.itervalues():
+            for name in entity_repr.parts:
+                if not name:
+                    ## has no length, so it is never the longest
+                    ## observed name that makes a document score
+                    continue
+                runs = re.findall(u'[\x00-\x1f\x21-\x7f]+', name)
+                if not runs:
+                    self.usable = False
+                    continue
+                keys.add(max(runs, key=len).encode('ascii'))
+
+        self.keys = sorted(keys)
+        self.keys_re = re.compile(
+            '%s|%s' % (trie_pattern(self.keys),
+                       '|'.join(map(re.escape, _lower_to_ascii))),
+            re.IGNORECASE)
+
+    def candidate(self, clean_visible):
+        '''
+        :returns bool: False only if no name part can be in the
+        normalized text of clean_visible
+        '''
+        if not self.usable:
+            return True
+        return self.keys_re.search(clean_visible) is not None
+
+
+class SentenceIndex(object):
+    '''
+    All of a document's normalized sentence strings, joined into one
+    string with SEPARATOR between them, along with the start of each
+    sentence in that string and its (first, last) char range in
+    clean_visible.  Finding the sentences that contain a name is then
+    a search in one string plus a bisect over the sentence starts,
+    instead of a substring test on every sentence.
+    '''
+    ## a unicode noncharacter, which neither strip_string nor the
+    ## tokens of real text produce, so names never match across it
+    SEPARATOR = u'\uffff'
+
+    def __init__(self, sent_strs, firsts, lasts):
+        self.text = self.SEPARATOR.join(sent_strs)
+        self.firsts = firsts
+        self.lasts = lasts
+        self.starts = array('l')
+        start = 0
+        for sent_str in sent_strs:
+            self.starts.append(start)
+            start += len(sent_str) + 1
+
+    @classmethod
+    def from_serif(cls, serif_sentences):
+        '''
+        Builds the index from the 'serif' sentences of a StreamItem,
+        normalizing all of the sentences in one call to strip_string
+        '''
+        raw_strs = []
+        firsts = array('l')
+        lasts = array('l')
+        for sent in serif_sentences:
+            if not sent.tokens: continue
+            raw_strs.append(
+                u' '.join([tok.token.decode('utf8') for tok in sent.tokens]))
+            firsts.append(sent.tokens[0].offsets[OffsetType.CHARS].first)
+            last_token_offset = sent.tokens[-1].offsets[OffsetType.CHARS]
+            lasts.append(last_token_offset.first + last_token_offset.length)
+
+        sent_strs = []
+        if raw_strs:
+            ## strip_string never merges characters across SEPARATOR,
+            ## so this equals normalizing each sentence on its own
+            sent_strs = strip_string(
+                cls.SEPARATOR.join(raw_strs)).split(cls.SEPARATOR)
+        return cls(sent_strs, firsts, lasts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def sentence(self, sent_num):
+        '''
+        :returns tuple(sent_str, first, last):
+        '''
+        start = self.starts[sent_num]
+        if sent_num + 1 < len(self.starts):
+            end = self.starts[sent_num + 1] - 1
+        else:
+            end = len(self.text)
+        return self.text[start:end], self.firsts[sent_num], self.lasts[sent_num]
+
+    def longest_containing(self, name):
+        '''
+        :returns int: number of the longest sentence that contains
+        name, preferring the earliest of equally long sentences, or
+        None if no non-empty sentence contains name.
+        '''
+        longest = None
+        longest_len = 0
+        if not self.starts:
+            return longest
+
+        pos = self.text.find(name)
+        while pos != -1:
+            sent_num = bisect_right(self.starts, pos) - 1
+            if sent_num + 1 < len(self.starts):
+                end = self.starts[sent_num + 1] - 1
+            else:
+                end = len(self.text)
+            if end - self.starts[sent_num] > longest_len:
+                longest = sent_num
+                longest_len = end - self.starts[sent_num]
+
+            ## further mentions in this sentence change nothing
+            if end == len(self.text):
+                break
+            pos = self.text.find(name, end + 1)
+
+        return longest
+
+
+class Scorer(object):
+    """
+    The normalized text of one document, and its sentences, which are
+    only normalized if fill_slots needs them.  Slots keep the many
+    Scorers of a long run small, and reset lets one Scorer be reused
+    for document after document, see toy_kba_pipeline.ScratchScorers.
+    """
+    __slots__ = ('text', 'ready', '_clean_visible', '_source', '_offsets',
+                 '_serif', '_sentence_index')
+
+    def __init__(self, si=None, normalized=None):
+        self.reset(si, normalized)
+
+    def reset(self, si, normalized=None):
         """
-        Take StreamItem (si) and prepare to evaluate entity mentions
+        Take StreamItem (si) and prepare to evaluate entity mentions,
+        dropping everything about the previous document.  With neither
+        si nor normalized, the Scorer is not ready.
+
+        :param normalized: optional (text, sentences) tuple of a
+        previous Scorer's text and sentences for the same document,
+        e.g. from toy_kba_cache.TextCache, in which case si is not
+        used and may be None.
         """
+        self.text = None
+        self.ready = False
+
+        ## raw clean_visible, decoded again only if mention_range
+        ## needs to map positions in self.text back to it
+        self._clean_visible = None
+        self._source = None
+        self._offsets = None
+
+        ## sentences are only normalized if fill_slots needs them, see
+        ## sentence_index
+        self._serif = None
+        self._sentence_index = None
+
+        if normalized is not None:
+            self.text, sentences = normalized
+            self._sentence_index = SentenceIndex(
+                [sent_str for sent_str, _, _ in sentences],
+                array('l', [first for _, first, _ in sentences]),
+                array('l', [last for _, _, last in sentences]))
+            self.ready = True
+            return
+
+        if si is None:
+            return
+
         try:
             self.text = strip_string(si.body.clean_visible.decode('utf8'))
+            self._clean_visible = si.body.clean_visible
             self.ready = True
         except Exception, exc:
             ## ignore failures, such as PDFs
             #sys.exit(traceback.format_exc(exc))
             logger.warn("failed to initialize on doc: %s\n" % exc)
-            self.ready = False
 
-        self.sentences = []
         if si.body.sentences and 'serif' in si.body.sentences:
-            for sent in si.body.sentences['serif']:
-                if not sent.tokens: continue
-                sent_str = strip_string(
-                    u' '.join([tok.token.decode('utf8') for tok in sent.tokens]))
-                sent_first = sent.tokens[0].offsets[OffsetType.CHARS].first
-                last_token_offset = sent.tokens[-1].offsets[OffsetType.CHARS]
-                sent_last = last_token_offset.first + last_token_offset.length
-                self.sentences.append((sent_str, sent_first, sent_last))
-            
+            self._serif = si.body.sentences['serif']
         else:
             logger.warn('missing sentences for %s' % si.stream_id)
 
-    def assess_target(self, entity_representation, conf_heuristic=LEN_FRAC):
+    @property
+    def source(self):
+        '''
+        decoded clean_visible, or None if the Scorer was built without
+        the StreamItem
+        '''
+        if self._source is None and self._clean_visible is not None:
+            self._source = self._clean_visible.decode('utf8')
+        return self._source
+
+    @property
+    def sentence_index(self):
+        if self._sentence_index is None:
+            self._sentence_index = SentenceIndex.from_serif(self._serif or [])
+            self._serif = None
+        return self._sentence_index
+
+    @property
+    def sentences(self):
+        '''
+        list of (sent_str, first, last) for every sentence
+        '''
+        index = self.sentence_index
+        return [index.sentence(sent_num) for sent_num in xrange(len(index))]
+
+    def assess_target(self, entity_representation, conf_heuristic=LEN_FRAC,
+                      observed=None):
         """
-        Searches text for parts of entity_name
+        Searches text for parts of entity_name.  This scores one
+        (document, entity) pair with the same maths as score_batch,
+        which should be used to score many.
+
+        :param observed: optional (longest_observed_name,
+        num_observed_names) tuple for this entity, as computed for all
+        entities at once by EntityMatcher.scan.  If it is not
+        provided, the text is searched for each name part in turn.
 
-        :returns tuple(confidence, relevance, contains_mention):
+        :returns tuple(confidence, relevance, contains_mention,
+        longest_observed_name):
 
         confidence score is between zero and 1000, which represents a
         float in [0,1] measured in thousandths.
@@ -127,66 +782,88 @@ class Scorer:
         contains_mention is an integer in the set [0, 1], which
         represents a boolean assertion that the document either
         mentions or does not mention the target entity
-        """
-        ## look for name parts in text:
-        len_longest_observed_name = 0
-        self.longest_observed_name = ''
-        num_observed_names = 0
-        for name in entity_representation["parts"]:
-            if name in self.text:
-                if len(name) > len_longest_observed_name:
-                    len_longest_observed_name = len(name)
-                    ## hold on to this string for SSF below
-                    self.longest_observed_name = name
-
-                if conf_heuristic == NAMES_FRAC:
-                    num_observed_names += len(re.findall(name, self.text))
-
-            else:
-                pass #print u'%r not in %r' % (name, self.text[:100])
-
-        ## default score is 0
-        if len_longest_observed_name == 0:
-            ## zero confidence, relevance="garbage", non-mentioning
-            return 0, -1, 0
 
-        if conf_heuristic == NAMES_FRAC:
-            confidence = min(1000, num_observed_names)
+        longest_observed_name is the longest name part found in the
+        text, which fill_slots looks for in the sentences
+        """
+        if observed is None:
+            ## look for name parts in text, counting them as
+            ## EntityMatcher.scan does; for one pair this is much
+            ## cheaper than building an EntityMatcher
+            longest_observed_name = ''
+            num_observed_names = 0
+            for name in entity_representation.parts:
+                if name in self.text:
+                    if len(name) > len(longest_observed_name):
+                        longest_observed_name = name
+                    num_observed_names += self.text.count(name)
+            observed = longest_observed_name, num_observed_names
+
+        longest_observed_name, num_observed_names = observed
+
+        ## the same maths as score_batch, for one pair
+        confidence, relevance, contains_mention = confidences(
+            numpy.array([len(longest_observed_name)]),
+            numpy.array([num_observed_names]),
+            entity_representation.longest, conf_heuristic)
+
+        return (int(confidence[0]), int(relevance[0]), int(contains_mention[0]),
+                longest_observed_name)
+
+    def mention_range(self, name, first, last):
+        '''
+        Finds the first occurrence of name in self.text that starts
+        within chars [first, last) of clean_visible.
 
-        else:
-            assert conf_heuristic == LEN_FRAC
-            ## normalize score by length of longest name, which is full_name
-            conf_zero_to_one = float(len_longest_observed_name) / entity_representation["longest"]
+        :returns tuple(first, last): char range of that occurrence in
+        clean_visible, or None if there is no such occurrence or the
+        Scorer was built without the StreamItem.
+        '''
+        source = self.source
+        if source is None or not name:
+            return None
 
-            ## return score in thousandths
-            confidence = int(1000 * conf_zero_to_one)
+        if self._offsets is None:
+            self._offsets = strip_string_offsets(source)
+        offsets = self._offsets
 
-        relevance = 2  ## hard code "vital" level for this toy system
-        
-        contains_mention = 1  ## hard code always mentioning for this
-                              ## toy system
+        ## offsets is sorted, so start looking at the first position
+        ## that comes from at or after first
+        pos = self.text.find(name, bisect_left(offsets, first))
+        if pos == -1 or offsets[pos] >= last:
+            return None
 
-        return (confidence, relevance, contains_mention)
+        return offsets[pos], offsets[pos + len(name) - 1] + 1
 
-    def fill_slots(self, entity_representation):
+    def fill_slots(self, entity_representation, longest_observed_name,
+                   exact_ranges=False):
         '''
         simple algorithm for filling all of the slot types for
-        entity_type.  Finds the longest sentence containing the
-        longest name observed above, and returns that entire sentence
-        for every slot type for this entity_type.
+        entity_type.  Finds the longest sentence containing
+        longest_observed_name, as returned by assess_target, and
+        returns that entire sentence for every slot type for this
+        entity_type.
+
+        If exact_ranges is True, the char range of the longest name's
+        mention within that sentence is returned instead of the range
+        of the whole sentence, when it can be found.
         '''        
-        longest_sentence = ''
-        for sent_str, first, last in self.sentences:
-            if self.longest_observed_name in sent_str:
-                if len(sent_str) > len(longest_sentence):
-                    longest_sentence = sent_str
-
-                    ## construct original byte range for this sentence
-                    char_range = 'c%d-%d' % (first, last)
-        
-        if not longest_sentence:
+        index = self.sentence_index
+        sent_num = index.longest_containing(longest_observed_name)
+        if sent_num is None:
             ## no slot fills
             return
+
+        ## only the selected sentence is sliced out of the index
+        longest_sentence, first, last = index.sentence(sent_num)
+
+        ## construct original byte range for this sentence
+        char_range = 'c%d-%d' % (first, last)
+
+        if exact_ranges:
+            mention = self.mention_range(longest_observed_name, first, last)
+            if mention is not None:
+                char_range = 'c%d-%d' % mention
         
         ## most conservative approach to slot alias equivalence is to
         ## treat the sentence itself as the equiv class name; here we
@@ -195,7 +872,7 @@ class Scorer:
         ## duplicate sentences do occur in the KBA corpus.
         slot_equiv_id = hashlib.md5(longest_sentence.encode('utf8')).hexdigest()
 
-        for slot_name in entity_representation['slot_names']:
+        for slot_name in entity_representation.slot_names:
             if not slot_name.isupper(): continue
             ## for toy system, just assert that longest sentence is
             ## the slot fill for every slot name            
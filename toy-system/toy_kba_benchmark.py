@@ -0,0 +1,414 @@
+#!/usr/bin/python
+"""
+Repeatable benchmarks for the toy KBA system, runnable offline.
+
+  generate  writes a synthetic corpus of streamcorpus chunks in hourly
+            directories, with matching filter-topics, profiles and
+            slot-names files
+  run       times each stage of the toy system separately, and the
+            whole toy_kba_system.py end to end, measures the memory
+            of each, and saves the results as JSON
+  compare   compares two results files and exits non-zero if any stage
+            got slower, or used more memory, by more than a threshold
+
+For example:
+
+    python toy_kba_benchmark.py generate synthetic-corpus
+    python toy_kba_benchmark.py run synthetic-corpus before.json
+    ... change something ...
+    python toy_kba_benchmark.py run synthetic-corpus after.json
+    python toy_kba_benchmark.py compare before.json after.json
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import gc
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import datetime
+import subprocess
+import streamcorpus
+from array import array
+from streamcorpus import OffsetType
+
+import toy_kba_algorithm
+import toy_kba_corpus
+
+logger = logging.getLogger('kba-toy-system')
+
+## names of the files that generate writes next to the hourly
+## directories of the synthetic corpus
+TOPICS_FILE = 'filter-topics.json'
+PROFILES_FILE = 'profiles.json'
+SLOT_NAMES_FILE = 'slot-names.json'
+
+def make_word(rand):
+    '''
+    makes a pronounceable lowercase pseudo-word
+    '''
+    return ''.join(rand.choice('bcdfghjklmnprstvz') + rand.choice('aeiou')
+                   for _ in xrange(rand.randint(1, 4)))
+
+def make_stream_item(rand, epoch_ticks, vocab, entity_names, args):
+    '''
+    makes a StreamItem with clean_visible text and 'serif' sentences
+    whose tokens have CHARS offsets into clean_visible
+    '''
+    abs_url = 'http://synthetic.example.com/%d/%d' % (epoch_ticks, rand.getrandbits(64))
+    doc_id = hashlib.md5(abs_url).hexdigest()
+
+    sentences = []
+    parts = []
+    pos = 0
+    for sent_num in xrange(args.sentences):
+        words = [rand.choice(vocab) for _ in xrange(args.words)]
+        if rand.random() < args.density:
+            ## put a name in this sentence
+            words[rand.randrange(len(words))] = rand.choice(entity_names)
+        words[0] = words[0].capitalize()
+
+        tokens = []
+        for word in ' '.join(words).split() + ['.']:
+            if word != '.' and tokens:
+                ## space between words, but not before the period
+                parts.append(' ')
+                pos += 1
+            offset = streamcorpus.Offset(
+                type=OffsetType.CHARS, first=pos, length=len(word))
+            tokens.append(streamcorpus.Token(
+                token_num=len(tokens), token=word,
+                offsets={OffsetType.CHARS: offset}))
+            parts.append(word)
+            pos += len(word)
+        sentences.append(streamcorpus.Sentence(tokens=tokens))
+        parts.append('\n')
+        pos += 1
+
+    si = streamcorpus.StreamItem(
+        doc_id=doc_id, abs_url=abs_url, source='synthetic',
+        stream_id='%d-%s' % (epoch_ticks, doc_id),
+        stream_time=streamcorpus.StreamTime(
+            epoch_ticks=epoch_ticks,
+            zulu_timestamp=datetime.datetime.utcfromtimestamp(
+                epoch_ticks).strftime('%Y-%m-%dT%H:%M:%S.000000Z')),
+        body=streamcorpus.ContentItem(
+            clean_visible=''.join(parts),
+            sentences={'serif': sentences}))
+    return si
+
+def generate(args):
+    '''
+    writes the synthetic corpus and its topics, profiles and slot
+    names to args.corpus
+    '''
+    rand = random.Random(args.seed)
+    vocab = [make_word(rand) for _ in xrange(args.vocab)]
+
+    ## entities have one to three capitalized words as their names
+    targets = []
+    profiles = {'entities': {}}
+    entity_names = []
+    for entity_num in xrange(args.entities):
+        name = ' '.join(make_word(rand).capitalize()
+                        for _ in xrange(rand.randint(1, 3)))
+        target_id = 'http://en.wikipedia.org/wiki/%s' % name.replace(' ', '_')
+        targets.append({
+            'target_id': target_id,
+            'entity_type': rand.choice(['PER', 'ORG', 'FAC']),
+            'training_time_range_end': '2012-06-01T00:00:00.000000Z',
+            })
+        profiles['entities'][target_id] = {
+            'slots': {'canonical_name': name,
+                      'AFFILIATE': [{'value': name}]},
+            'citations': [],
+            }
+        entity_names.append(name)
+
+    start = datetime.datetime(2012, 1, 1)
+    for chunk_num in xrange(args.chunks):
+        date_hour = start + datetime.timedelta(hours=chunk_num // args.chunks_per_hour)
+        dir_path = os.path.join(args.corpus, date_hour.strftime('%Y-%m-%d-%H'))
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        epoch_ticks = int((date_hour - datetime.datetime(1970, 1, 1)).total_seconds())
+
+        chunk_path = os.path.join(dir_path, 'synthetic-%d-%d.sc' % (args.docs, chunk_num))
+        chunk = streamcorpus.Chunk(path=chunk_path, mode='wb')
+        for doc_num in xrange(args.docs):
+            si = make_stream_item(rand, epoch_ticks + doc_num, vocab, entity_names, args)
+            chunk.add(si)
+        chunk.close()
+
+        if args.xz:
+            subprocess.check_call(['xz', '--force', chunk_path])
+            chunk_path += '.xz'
+        logger.info('wrote %s' % chunk_path)
+
+    json.dump({'topic_set_id': 'synthetic', 'targets': targets},
+              open(os.path.join(args.corpus, TOPICS_FILE), 'w'), indent=4)
+    json.dump(profiles, open(os.path.join(args.corpus, PROFILES_FILE), 'w'), indent=4)
+    json.dump(toy_kba_algorithm.slot_names,
+              open(os.path.join(args.corpus, SLOT_NAMES_FILE), 'w'), indent=4)
+
+class StageTimer(object):
+    '''
+    accumulates wall time and item counts for named stages
+    '''
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds, count=1):
+        rec = self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0})
+        rec['seconds'] += seconds
+        rec['count'] += count
+
+def scorer_bytes(scorer):
+    '''
+    :returns int: bytes held by scorer for its document: the object,
+    its __dict__ if it has one, and the strings and arrays in its
+    attributes
+    '''
+    size = sys.getsizeof(scorer)
+    values = []
+    if hasattr(scorer, '__dict__'):
+        size += sys.getsizeof(scorer.__dict__)
+        values.extend(scorer.__dict__.itervalues())
+    for name in getattr(type(scorer), '__slots__', ()):
+        values.append(getattr(scorer, name, None))
+    for value in values:
+        if isinstance(value, (str, unicode, array)):
+            size += sys.getsizeof(value)
+    return size
+
+def time_stages(args):
+    '''
+    runs each stage of the toy system over the whole corpus in this
+    process, and returns a StageTimer, with the memory held by
+    Scorers per document counted as the 'scorer_bytes' and
+    'scorer_objects' stages, whose seconds are bytes and objects
+    '''
+    timer = StageTimer()
+
+    filter_topics = json.load(open(os.path.join(args.corpus, TOPICS_FILE)))
+    profiles = json.load(open(os.path.join(args.corpus, PROFILES_FILE)))
+    slot_names = json.load(open(os.path.join(args.corpus, SLOT_NAMES_FILE)))
+
+    start = time.time()
+    recall_filters = toy_kba_algorithm.make_recall_filters(profiles, args.mode)
+    entity_representations = toy_kba_algorithm.prepare_entities(
+        filter_topics['targets'], recall_filters=recall_filters,
+        slot_names=slot_names)
+    timer.add('prepare_entities', time.time() - start, len(entity_representations))
+
+    start = time.time()
+    matcher = toy_kba_algorithm.EntityMatcher(entity_representations)
+    timer.add('build_matcher', time.time() - start)
+
+    for date_hour, chunk_path in toy_kba_corpus.date_hour_chunks(args.corpus):
+        start = time.time()
+        data = toy_kba_corpus.load_chunk_data(chunk_path)
+        timer.add('load_chunk', time.time() - start)
+
+        start = time.time()
+        stream_items = list(streamcorpus.Chunk(data=data))
+        timer.add('deserialize', time.time() - start, len(stream_items))
+
+        scorers = []
+        pattern_counts = []
+        for si in stream_items:
+            ## objects tracked by the gc that the new Scorer holds on
+            ## to, which are only counted while gc is off
+            gc.disable()
+            objects = gc.get_count()[0]
+            start = time.time()
+            scorer = toy_kba_algorithm.Scorer(si)
+            timer.add('normalize', time.time() - start)
+            timer.add('scorer_objects', gc.get_count()[0] - objects)
+            gc.enable()
+            timer.add('scorer_bytes', scorer_bytes(scorer))
+
+            start = time.time()
+            pattern_counts.append(matcher.count_patterns(scorer.text))
+            timer.add('scan', time.time() - start)
+            scorers.append(scorer)
+
+        ## all documents of the chunk against all targets at once,
+        ## counted per pair so that it compares with older results
+        start = time.time()
+        scores = matcher.batch_scores(
+            pattern_counts, toy_kba_algorithm.LEN_FRAC, args.cutoff)
+        timer.add('assess_target', time.time() - start,
+                  len(scorers) * len(matcher.target_ids))
+
+        for doc_num, target_num in zip(*(scores.selected & (scores.relevance == 2)).nonzero()):
+            entity_repr = entity_representations[matcher.target_ids[target_num]]
+            start = time.time()
+            list(scorers[doc_num].fill_slots(
+                    entity_repr, scores.observed(doc_num, target_num)[0]))
+            timer.add('fill_slots', time.time() - start)
+
+    return timer
+
+def time_end_to_end(args, output_path):
+    '''
+    runs toy_kba_system.py over the whole corpus in a child process
+
+    :returns tuple: (seconds, peak_rss_kb) of the child
+    '''
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    system = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'toy_kba_system.py')
+    command = [sys.executable, system, '--stream', '--ssf',
+               '--max', str(sys.maxint), '--cutoff', str(args.cutoff),
+               '--slot-names', os.path.join(args.corpus, SLOT_NAMES_FILE),
+               args.mode,
+               os.path.join(args.corpus, TOPICS_FILE),
+               os.path.join(args.corpus, PROFILES_FILE),
+               args.corpus, output_path]
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        child = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+        ## wait4 also reports the peak resident memory of the child
+        pid, status, rusage = os.wait4(child.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise subprocess.CalledProcessError(status, command)
+    os.remove(output_path)
+    return elapsed, rusage.ru_maxrss
+
+def run(args):
+    '''
+    times the stages and the end-to-end run args.repeat times, keeping
+    the fastest time of each, and saves the results to args.results
+    '''
+    ## the scorer logs some documents at WARN
+    logger.setLevel(logging.ERROR)
+
+    stages = {}
+    memory = {}
+    for repeat in xrange(args.repeat):
+        timer = time_stages(args)
+        elapsed, peak_rss_kb = time_end_to_end(args, args.results + '.run')
+        timer.add('end_to_end', elapsed)
+        memory['end_to_end_peak_rss_kb'] = min(
+            memory.get('end_to_end_peak_rss_kb', peak_rss_kb), peak_rss_kb)
+        for stage, rec in timer.stages.iteritems():
+            if stage not in stages or rec['seconds'] < stages[stage]['seconds']:
+                stages[stage] = rec
+
+    ## the memory counts are kept apart from the timings
+    for stage in ('scorer_bytes', 'scorer_objects'):
+        rec = stages.pop(stage)
+        memory[stage + '_per_doc'] = rec['seconds'] / max(1, rec['count'])
+
+    for stage, rec in stages.iteritems():
+        rec['per_item_usec'] = 1e6 * rec['seconds'] / max(1, rec['count'])
+
+    results = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'corpus': os.path.abspath(args.corpus),
+        'mode': args.mode,
+        'cutoff': args.cutoff,
+        'repeat': args.repeat,
+        'python': sys.version,
+        'stages': stages,
+        'memory': memory,
+        }
+    json.dump(results, open(args.results, 'w'), indent=4, sort_keys=True)
+
+    for stage in sorted(stages):
+        print '%-18s %10.3f sec %10d items %12.1f usec/item' % (
+            stage, stages[stage]['seconds'], stages[stage]['count'],
+            stages[stage]['per_item_usec'])
+    for name in sorted(memory):
+        print '%-30s %12.1f' % (name, memory[name])
+
+def compare(args):
+    '''
+    prints the ratio of new to old time for every stage, and of new
+    to old memory, and returns non-zero if any ratio exceeds 1 +
+    args.threshold
+    '''
+    old_results = json.load(open(args.old))
+    new_results = json.load(open(args.new))
+    old = old_results['stages']
+    new = new_results['stages']
+
+    regressions = 0
+    for stage in sorted(set(old) & set(new)):
+        ratio = new[stage]['per_item_usec'] / max(old[stage]['per_item_usec'], 1e-9)
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        print '%-18s %12.1f -> %12.1f usec/item  x%.2f %s' % (
+            stage, old[stage]['per_item_usec'], new[stage]['per_item_usec'],
+            ratio, flag)
+
+    for stage in sorted(set(old) ^ set(new)):
+        print '%-18s only in %s' % (stage, stage in old and args.old or args.new)
+
+    ## results from before memory was measured have none
+    old_memory = old_results.get('memory', {})
+    new_memory = new_results.get('memory', {})
+    for name in sorted(set(old_memory) & set(new_memory)):
+        ratio = new_memory[name] / max(old_memory[name], 1e-9)
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        print '%-30s %12.1f -> %12.1f  x%.2f %s' % (
+            name, old_memory[name], new_memory[name], ratio, flag)
+
+    return regressions and 1 or 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    gen = subparsers.add_parser('generate', help='write a synthetic corpus')
+    gen.set_defaults(func=generate)
+    gen.add_argument('corpus', help='directory in which to create hourly directories of chunks')
+    gen.add_argument('--chunks', type=int, default=20, help='number of chunk files')
+    gen.add_argument('--chunks-per-hour', type=int, default=5, help='number of chunk files in each hourly directory')
+    gen.add_argument('--docs', type=int, default=100, help='number of StreamItems per chunk')
+    gen.add_argument('--sentences', type=int, default=30, help='number of sentences per document')
+    gen.add_argument('--words', type=int, default=15, help='number of words per sentence')
+    gen.add_argument('--vocab', type=int, default=5000, help='number of distinct words')
+    gen.add_argument('--entities', type=int, default=100, help='number of target entities')
+    gen.add_argument('--density', type=float, default=0.02, help='probability that a sentence mentions an entity')
+    gen.add_argument('--xz', default=False, action='store_true', help='compress chunks with xz')
+    gen.add_argument('--seed', type=int, default=0, help='random seed')
+
+    run_parser = subparsers.add_parser('run', help='time each stage and the whole run')
+    run_parser.set_defaults(func=run)
+    run_parser.add_argument('corpus', help='directory made by generate')
+    run_parser.add_argument('results', help='path of JSON file to create with the timings')
+    run_parser.add_argument('--mode', default='slots', help="'simple' or 'slots', as for toy_kba_system.py")
+    run_parser.add_argument('--cutoff', type=int, default=400, help='relevance cutoff, measured in thousandths')
+    run_parser.add_argument('--repeat', type=int, default=3, help='keep the fastest of this many repetitions')
+
+    cmp_parser = subparsers.add_parser('compare', help='compare two results files')
+    cmp_parser.set_defaults(func=compare)
+    cmp_parser.add_argument('old', help='results of the baseline')
+    cmp_parser.add_argument('new', help='results to check for regressions')
+    cmp_parser.add_argument('--threshold', type=float, default=0.10, help='largest allowed slowdown per stage, as a fraction')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    sys.exit(args.func(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,433 @@
+#!/usr/bin/python
+"""
+Caches that let toy_kba_system.py skip work that it has already done.
+
+TextCache stores the normalized text and sentences that Scorer builds
+for each document, so that runs which only change --cutoff,
+--names-frac or the recall filters do not decrypt, decompress and
+normalize the corpus again.
+
+ProfileCache stores the entity representations and citations compiled
+from the filter-topics, profiles and slot names, so that runs over the
+same inputs do not parse large profiles files again.
+
+ScoreMemo holds the scores and slot fills of recently seen documents
+in memory, so that duplicates of a document within a run, such as
+syndicated news, are not normalized and scored again.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import mmap
+import struct
+from array import array
+import hashlib
+import logging
+import tempfile
+import collections
+
+import toy_kba_algorithm
+
+logger = logging.getLogger('kba-toy-system')
+
+class TextCache(object):
+    '''
+    Directory of files, one per chunk file, each holding the stream_id,
+    normalized text and (sent_str, first, last) sentences of every
+    document in the chunk that has clean_visible.  Files are named by
+    a hash of the chunk path and
+    toy_kba_algorithm.NORMALIZATION_VERSION, and are read through
+    mmap, so that only the documents actually used are decoded.
+
+    The total size of the directory is kept under max_bytes by
+    deleting the least recently used files.
+
+    Each file is laid out as:
+
+      header:           MAGIC, num_docs, num_sents
+      document table:   num_docs x DOC_STRUCT
+      sentence table:   num_sents x SENT_STRUCT
+      blob:             utf8 bytes of stream_ids, texts and sentences
+    '''
+    MAGIC = 'KBATXC01'
+    HEADER_STRUCT = struct.Struct('<8sII')
+    ## stream_id offset and length, text offset and length, index of
+    ## the first sentence and number of sentences
+    DOC_STRUCT = struct.Struct('<QHQIII')
+    ## sent_str offset and length, first and last char offsets
+    SENT_STRUCT = struct.Struct('<QIqq')
+    ## text length of documents on which the Scorer was not ready
+    NOT_READY = 0xFFFFFFFF
+
+    def __init__(self, cache_dir, max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        ## size of the cache directory, computed on first put
+        self.total_bytes = None
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, chunk_path):
+        key = '%d:%s' % (toy_kba_algorithm.NORMALIZATION_VERSION,
+                         os.path.abspath(chunk_path))
+        return os.path.join(self.cache_dir,
+                            hashlib.md5(key).hexdigest() + '.txc')
+
+    def has(self, chunk_path):
+        return os.path.exists(self.path(chunk_path))
+
+    def get(self, chunk_path):
+        '''
+        :returns generator: (stream_id, normalized) for each document
+        stored for chunk_path, where normalized is the (text,
+        sentences) tuple to pass to Scorer, or None if the Scorer was
+        not ready on that document.  Returns None if chunk_path is not
+        in the cache.
+        '''
+        path = self.path(chunk_path)
+        try:
+            fh = open(path, 'rb')
+        except IOError:
+            return None
+
+        ## mark as recently used for eviction
+        os.utime(path, None)
+        return self._read(fh)
+
+    def _read(self, fh):
+        buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+        try:
+            magic, num_docs, num_sents = self.HEADER_STRUCT.unpack_from(buf, 0)
+            assert magic == self.MAGIC, magic
+            doc_table = self.HEADER_STRUCT.size
+            sent_table = doc_table + num_docs * self.DOC_STRUCT.size
+
+            for doc_num in xrange(num_docs):
+                (id_off, id_len, text_off, text_len, sent_index, doc_sents) = \
+                    self.DOC_STRUCT.unpack_from(
+                        buf, doc_table + doc_num * self.DOC_STRUCT.size)
+                stream_id = buf[id_off:id_off + id_len]
+
+                if text_len == self.NOT_READY:
+                    yield stream_id, None
+                    continue
+
+                text = buf[text_off:text_off + text_len].decode('utf8')
+                sentences = []
+                for sent_num in xrange(sent_index, sent_index + doc_sents):
+                    str_off, str_len, first, last = self.SENT_STRUCT.unpack_from(
+                        buf, sent_table + sent_num * self.SENT_STRUCT.size)
+                    sentences.append(
+                        (buf[str_off:str_off + str_len].decode('utf8'), first, last))
+
+                yield stream_id, (text, sentences)
+        finally:
+            buf.close()
+
+    def put(self, chunk_path, docs):
+        '''
+        Stores docs for chunk_path, where docs is a list in the format
+        returned by get.
+        '''
+        num_sents = sum(len(normalized[1]) for _, normalized in docs if normalized)
+        blob_off = self.HEADER_STRUCT.size + len(docs) * self.DOC_STRUCT.size \
+            + num_sents * self.SENT_STRUCT.size
+
+        doc_table = []
+        sent_table = []
+        blob = []
+        blob_end = [blob_off]
+        def add_blob(value):
+            ## returns offset and length of value in the file
+            offset = blob_end[0]
+            blob.append(value)
+            blob_end[0] += len(value)
+            return offset, len(value)
+
+        for stream_id, normalized in docs:
+            id_off, id_len = add_blob(stream_id)
+            if normalized is None:
+                doc_table.append(self.DOC_STRUCT.pack(
+                    id_off, id_len, 0, self.NOT_READY, 0, 0))
+                continue
+
+            text, sentences = normalized
+            text_off, text_len = add_blob(text.encode('utf8'))
+            doc_table.append(self.DOC_STRUCT.pack(
+                id_off, id_len, text_off, text_len, len(sent_table), len(sentences)))
+            for sent_str, first, last in sentences:
+                str_off, str_len = add_blob(sent_str.encode('utf8'))
+                sent_table.append(self.SENT_STRUCT.pack(str_off, str_len, first, last))
+
+        ## write to a temp file and rename, so that concurrent readers,
+        ## e.g. other --workers, never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(self.HEADER_STRUCT.pack(self.MAGIC, len(docs), len(sent_table)))
+            fh.write(''.join(doc_table))
+            fh.write(''.join(sent_table))
+            fh.write(''.join(blob))
+        os.rename(tmp_path, self.path(chunk_path))
+
+        ## only list the directory again once it might be too big
+        if self.total_bytes is None:
+            self.evict()
+        else:
+            self.total_bytes += blob_end[0]
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        '''
+        Deletes the least recently used files until the cache fits in
+        max_bytes, and updates total_bytes
+        '''
+        self.total_bytes = evict_lru(self.cache_dir, self.max_bytes, ('.txc',))
+
+def evict_lru(cache_dir, max_bytes, suffixes):
+    '''
+    Deletes the least recently used files in cache_dir whose names end
+    in one of suffixes, until they fit in max_bytes.  Files are used
+    when they are written or their mtime is touched.
+
+    :returns int: total size of the remaining files
+    '''
+    files = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith(suffixes):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            ## removed by another process
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    files.sort()
+    while total > max_bytes and files:
+        mtime, size, path = files.pop(0)
+        logger.debug('evicting %s from %s' % (path, cache_dir))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+    return total
+
+class CompiledProfiles(object):
+    '''
+    The entity representations and citations stored in a ProfileCache
+    file.  Strings are decoded once each, so equal names, entity_types
+    and slot_names are shared by all targets that use them.
+    '''
+    def __init__(self, buf):
+        self.buf = buf
+        header = ProfileCache.HEADER_STRUCT
+        magic, num_strings, num_entities, num_index = header.unpack_from(buf, 0)
+        assert magic == ProfileCache.MAGIC, magic
+
+        ## all tables are arrays of uint32
+        pos = header.size
+        def table(length):
+            start = pos
+            values = array('I')
+            values.fromstring(buf[start:start + length * values.itemsize])
+            return values, start + length * values.itemsize
+
+        self.string_offsets, pos = table(num_strings + 1)
+        self.entity_table, pos = table(num_entities * ProfileCache.ENTITY_FIELDS)
+        self.index, pos = table(num_index)
+        self.blob_start = pos
+        self.strings = [None] * num_strings
+
+        self.entity_representations = {}
+        self.citation_ranges = {}
+        shared = {}
+        fields = ProfileCache.ENTITY_FIELDS
+        for entity_num in xrange(num_entities):
+            (target_id, entity_type, longest, parts_start, parts_end,
+             slots_start, slots_end, cites_start, cites_end) = \
+                self.entity_table[entity_num * fields:(entity_num + 1) * fields]
+            target_id = self.string(target_id)
+            self.citation_ranges[target_id] = (cites_start, cites_end)
+            if entity_type == ProfileCache.NO_STRING:
+                ## only in profiles, not in filter-topics
+                continue
+
+            slots = (slots_start, slots_end)
+            if slots not in shared:
+                shared[slots] = self.strings_at(slots_start, slots_end)
+            self.entity_representations[target_id] = \
+                toy_kba_algorithm.EntityRepresentation(
+                    self.strings_at(parts_start, parts_end), longest,
+                    self.string(entity_type), shared[slots])
+
+    def string(self, string_num):
+        value = self.strings[string_num]
+        if value is None:
+            start = self.blob_start + self.string_offsets[string_num]
+            end = self.blob_start + self.string_offsets[string_num + 1]
+            value = self.strings[string_num] = self.buf[start:end].decode('utf8')
+        return value
+
+    def strings_at(self, start, end):
+        return [self.string(string_num) for string_num in self.index[start:end]]
+
+    def citations(self, target_id):
+        '''
+        :returns list: mention_ids of the citations of target_id in
+        the profiles
+        '''
+        start, end = self.citation_ranges[target_id]
+        return [str(mention_id) for mention_id in self.strings_at(start, end)]
+
+class ProfileCache(object):
+    '''
+    Directory of compiled profiles, one file per distinct set of
+    inputs, named by a hash of the content of the filter-topics,
+    profiles and slot names files, the mode and any selected
+    target_ids.  Each file is read
+    through mmap into a CompiledProfiles, and is laid out as:
+
+      header:          MAGIC, num_strings, num_entities, num_index
+      string offsets:  num_strings + 1 uint32 offsets into the blob
+      entity table:    num_entities x ENTITY_FIELDS uint32
+      index:           num_index uint32 string numbers, which the
+                       entity table refers to by ranges
+      blob:            utf8 bytes of each distinct string
+    '''
+    MAGIC = 'KBAPRF01'
+    HEADER_STRUCT = struct.Struct('<8sIII')
+    ## target_id, entity_type, longest and the ranges in the index of
+    ## the parts, slot_names and citation mention_ids
+    ENTITY_FIELDS = 9
+    ## entity_type of targets that have no representation
+    NO_STRING = 0xFFFFFFFF
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, paths, mode, target_ids=None):
+        '''
+        :returns str: hash of the content of the files in paths, which
+        may include None for inputs that are not used, mode and the
+        target_ids that were selected, if any
+        '''
+        selection = target_ids is None and '*' or ' '.join(sorted(target_ids))
+        md5 = hashlib.md5('%d:%s:%s' % (toy_kba_algorithm.NORMALIZATION_VERSION,
+                                        mode, selection.encode('utf8')))
+        for path in paths:
+            md5.update('\0')
+            if path is None:
+                continue
+            with open(path, 'rb') as fh:
+                for block in iter(lambda: fh.read(2**20), ''):
+                    md5.update(block)
+        return md5.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.kbp')
+
+    def get(self, key):
+        '''
+        :returns CompiledProfiles: or None if key is not in the cache
+        '''
+        try:
+            fh = open(self.path(key), 'rb')
+        except IOError:
+            return None
+        buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+        return CompiledProfiles(buf)
+
+    def put(self, key, entity_representations, citations):
+        '''
+        Stores entity_representations, the output of prepare_entities,
+        and citations, a dict from target_id to a list of mention_ids.
+
+        :returns CompiledProfiles: as get would return for key
+        '''
+        string_nums = {}
+        blob = []
+        string_offsets = array('I', [0])
+        def intern(value):
+            string_num = string_nums.get(value)
+            if string_num is None:
+                string_num = string_nums[value] = len(blob)
+                blob.append(value.encode('utf8'))
+                string_offsets.append(string_offsets[-1] + len(blob[-1]))
+            return string_num
+
+        index = array('I')
+        ranges = {}
+        def add_range(values):
+            ## equal lists, like the slot_names of an entity_type, are
+            ## stored once
+            values = tuple(intern(value) for value in values)
+            if values not in ranges:
+                ranges[values] = (len(index), len(index) + len(values))
+                index.extend(values)
+            return ranges[values]
+
+        entity_table = array('I')
+        for target_id in sorted(set(entity_representations) | set(citations)):
+            entity_repr = entity_representations.get(target_id)
+            if entity_repr is None:
+                fields = [self.NO_STRING, 0, 0, 0, 0, 0]
+            else:
+                parts = add_range(entity_repr.parts)
+                slots = add_range(entity_repr.slot_names)
+                fields = [intern(entity_repr.entity_type), entity_repr.longest,
+                          parts[0], parts[1], slots[0], slots[1]]
+            cites = add_range(unicode(mention_id) for mention_id in
+                              citations.get(target_id, []))
+            entity_table.extend([intern(target_id)] + fields + list(cites))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(self.HEADER_STRUCT.pack(
+                    self.MAGIC, len(blob),
+                    len(entity_table) // self.ENTITY_FIELDS, len(index)))
+            fh.write(string_offsets.tostring())
+            fh.write(entity_table.tostring())
+            fh.write(index.tostring())
+            fh.write(''.join(blob))
+        os.rename(tmp_path, self.path(key))
+
+        return self.get(key)
+
+class ScoreMemo(object):
+    '''
+    In-memory cache of up to max_entries values, evicting the least
+    recently used.
+    '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        '''
+        :returns: the value stored for key, or None
+        '''
+        value = self.entries.pop(key, None)
+        if value is None:
+            return None
+        ## the most recently used entry is the last
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
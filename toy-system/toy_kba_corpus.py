@@ -0,0 +1,284 @@
+#!/usr/bin/python
+"""
+Helpers for locating and reading the chunk files of the kba-ccr-2013
+corpus that toy_kba_system.py needs to read.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import subprocess
+from itertools import islice
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('kba-toy-system')
+
+## hourly directories are named like 2011-10-07-14
+date_hour_re = re.compile('^\d{4}-\d{2}-\d{2}-\d{2}$')
+
+## file extensions of chunk files that load_chunk_data can read
+chunk_extensions = ('.sc', '.sc.xz', '.sc.xz.gpg')
+
+def in_shard(key, shard_num, num_shards):
+    '''
+    Assigns key, a target_id or chunk path, to one of num_shards
+    shards by a hash that is the same on every machine and run.
+
+    :returns bool: whether key belongs to shard_num
+    '''
+    if isinstance(key, unicode):
+        key = key.encode('utf8')
+    return int(hashlib.md5(key).hexdigest(), 16) % num_shards == shard_num
+
+def citation_chunk_path(corpus, mention_id):
+    '''
+    Returns the path of the XX/YY/stream_id.sc.xz.gpg file that holds
+    the document cited by mention_id
+    '''
+    stream_id = mention_id.split('#')[0]
+    epoch_ticks, doc_id = stream_id.split('-')
+    first = doc_id[:2]
+    second = doc_id[2:4]
+
+    return os.path.join(corpus, first, second, stream_id) + '.sc.xz.gpg'
+
+def chunk_index(citations, target_ids, corpus):
+    '''
+    Inverts the citations of target_ids into a map from chunk_path to
+    the list of target_ids that cite a document in that chunk, so that
+    each chunk can be read once and scored against all of its
+    targets.  citations(target_id) returns the mention_ids cited by
+    target_id.
+
+    :returns OrderedDict: chunk_path --> [target_id, ...] in the order
+    that the chunks are first cited when iterating over target_ids
+    '''
+    index = OrderedDict()
+    for target_id in target_ids:
+        for mention_id in citations(target_id):
+            chunk_path = citation_chunk_path(corpus, mention_id)
+            chunk_targets = index.setdefault(chunk_path, [])
+            if target_id not in chunk_targets:
+                chunk_targets.append(target_id)
+
+    return index
+
+def date_hour_chunks(corpus, listdir=os.listdir):
+    '''
+    Walks the hourly directories of corpus in chronological order.
+    listdir lists a directory of the corpus, e.g.
+    toy_kba_remote.HTTPCorpus.listdir for a remote corpus.
+
+    :returns generator: (date_hour, chunk_path) for every chunk file,
+    in order of date_hour and then file name
+    '''
+    ## zero-padded names sort chronologically
+    date_hours = sorted(name for name in listdir(corpus)
+                        if date_hour_re.match(name))
+    for date_hour in date_hours:
+        dir_path = os.path.join(corpus, date_hour)
+        for name in sorted(listdir(dir_path)):
+            if name.endswith(chunk_extensions):
+                yield date_hour, os.path.join(dir_path, name)
+
+def watch_date_hour_chunks(corpus, poll_interval=5, settle=2, stop=None):
+    '''
+    Like date_hour_chunks on a local corpus, but after the chunks that
+    are already there, polls corpus every poll_interval seconds and
+    yields the chunk files that land in new or existing hourly
+    directories, until stop, a threading.Event, is set.  Only directories whose mtime changed are
+    listed again.  A chunk file is yielded once it has not been
+    modified for settle seconds, so that one that is still being
+    copied in is not read; the later chunks of its directory wait for
+    it, to keep the order of file names.  Chunks that land in an
+    earlier hour than the latest one are yielded when they are found.
+
+    :returns generator: (date_hour, chunk_path) for every chunk file
+    '''
+    seen = set()
+    ## mtime of each directory when all of its chunks were yielded
+    dir_mtimes = {}
+    while True:
+        now = time.time()
+        date_hours = sorted(name for name in os.listdir(corpus)
+                            if date_hour_re.match(name))
+        for date_hour in date_hours:
+            dir_path = os.path.join(corpus, date_hour)
+            try:
+                dir_mtime = os.path.getmtime(dir_path)
+                if dir_mtimes.get(dir_path) == dir_mtime:
+                    continue
+                names = sorted(os.listdir(dir_path))
+            except OSError:
+                ## removed or renamed since it was listed
+                continue
+
+            settled = True
+            for name in names:
+                chunk_path = os.path.join(dir_path, name)
+                if chunk_path in seen or not name.endswith(chunk_extensions):
+                    continue
+                try:
+                    settled = now - os.path.getmtime(chunk_path) >= settle
+                except OSError:
+                    settled = False
+                if not settled:
+                    break
+                seen.add(chunk_path)
+                yield date_hour, chunk_path
+
+            ## a file can land in the same tick of a coarse mtime as
+            ## the listing, so recent directories are listed again
+            if settled and now - dir_mtime > max(settle, 1):
+                dir_mtimes[dir_path] = dir_mtime
+
+        if stop is None:
+            time.sleep(poll_interval)
+        elif stop.wait(poll_interval):
+            return
+
+class ChunkPipe(object):
+    '''
+    Reads a chunk file through gpg and xz children, as its extension
+    requires, so that its thrift bytes can be read from stdout as they
+    are decrypted and decompressed.
+    '''
+    def __init__(self, chunk_path):
+        self.chunk_path = chunk_path
+        self.commands = []
+        if chunk_path.endswith('.gpg'):
+            self.commands.append(['gpg', '--quiet', '--decrypt'])
+        if chunk_path.endswith(('.xz', '.xz.gpg')):
+            self.commands.append(['xz', '--decompress'])
+
+        ## chain the children into a pipeline.  subprocess makes its
+        ## pipes close-on-exec, so children started by other prefetch
+        ## threads do not hold them open; close_fds would also close
+        ## every other possible fd in each child, which can take
+        ## longer than reading a small chunk.
+        self.children = []
+        stdout = open(chunk_path, 'rb')
+        for command in self.commands:
+            child = subprocess.Popen(command, stdin=stdout,
+                                     stdout=subprocess.PIPE)
+            stdout.close()
+            stdout = child.stdout
+            self.children.append(child)
+        self.stdout = stdout
+
+    def close(self, stats=None):
+        '''
+        Waits for the children.  If stats, a toy_kba_stats.RunStats, is
+        provided, the CPU time of the gpg and xz children is recorded
+        as 'gpg_cpu' and 'xz_cpu'.
+
+        :returns bool: whether all of the children succeeded
+        '''
+        self.stdout.close()
+        failed = False
+        for command, child in zip(self.commands, self.children):
+            ## wait4 also reports the resources used by the child
+            pid, status, rusage = os.wait4(child.pid, 0)
+            child.returncode = status
+            if status != 0:
+                failed = True
+            if stats is not None:
+                stats.add('%s_cpu' % command[0], rusage.ru_utime + rusage.ru_stime)
+        return not failed
+
+    def kill(self):
+        '''
+        stops the children, for a reader that stops before the end
+        '''
+        self.stdout.close()
+        for child in self.children:
+            if child.poll() is None:
+                child.kill()
+            child.wait()
+
+def load_chunk_data(chunk_path, stats=None):
+    '''
+    Reads, decrypts and decompresses a chunk file into memory, in the
+    same way as streamcorpus.Chunk(path=chunk_path) does while
+    iterating.  If stats, a toy_kba_stats.RunStats, is provided, the
+    wall time is recorded as 'load' and the CPU time of the gpg and xz
+    children as 'gpg_cpu' and 'xz_cpu'.
+
+    :returns str: thrift bytes suitable for streamcorpus.Chunk(data=...),
+    or None if the file cannot be read
+    '''
+    if not os.path.exists(chunk_path):
+        logger.critical('failed to find %s' % chunk_path)
+        return None
+
+    if stats is not None:
+        start = stats.start('load')
+
+    ## reading from the pipe releases the GIL, so several chunks can
+    ## be loaded in background threads while another is being scored
+    pipe = ChunkPipe(chunk_path)
+    data = pipe.stdout.read()
+    succeeded = pipe.close(stats)
+
+    if stats is not None:
+        stats.stop('load', start)
+        stats.incr('bytes_loaded', len(data))
+
+    if not succeeded:
+        logger.critical('failed to decrypt or decompress %s' % chunk_path)
+        return None
+
+    return data
+
+def prefetch_chunks(tasks, depth=2, skip=None, stats=None, remote=None):
+    '''
+    Loads the chunk files of upcoming tasks with load_chunk_data in up
+    to depth background threads, so that reading, gpg and xz overlap
+    with scoring.  Each task is a tuple whose first element is a
+    chunk_path.  Chunks for which skip(chunk_path) is true are not
+    loaded.  stats is passed on to load_chunk_data.  If remote, a
+    toy_kba_remote.HTTPCorpus, is provided, chunk paths are URLs that
+    are fetched from it first.
+
+    :returns generator: (task, data) for each task in the order of
+    tasks, where data is the output of load_chunk_data, or None if
+    the chunk was skipped
+    '''
+    tasks = iter(tasks)
+
+    def load(chunk_path):
+        if remote is not None:
+            chunk_path = remote.fetch(chunk_path, stats)
+            if chunk_path is None:
+                return None
+        return load_chunk_data(chunk_path, stats)
+
+    def start(task):
+        result = []
+        if skip is not None and skip(task[0]):
+            return task, None, result
+        thread = threading.Thread(
+            target=lambda: result.append(load(task[0])))
+        thread.daemon = True
+        thread.start()
+        return task, thread, result
+
+    pending = deque(start(task) for task in islice(tasks, depth))
+    while pending:
+        task, thread, result = pending.popleft()
+
+        ## keep depth chunks loading while this one is scored
+        for next_task in islice(tasks, 1):
+            pending.append(start(next_task))
+
+        if thread is not None:
+            thread.join()
+        yield task, result and result[0] or None
@@ -0,0 +1,403 @@
+#!/usr/bin/python
+"""
+Builds an inverted index of the tokens of a corpus, so that runs of
+toy_kba_system.py with --token-index read only the documents that can
+contain a name part of some target.
+
+    python toy_kba_index.py tiny-corpus corpus-index
+    python toy_kba_system.py --stream --token-index corpus-index ... tiny-corpus filter-run.txt
+
+The index holds one file per hourly directory of the corpus, mapping
+each token of the normalized text of its documents, as split from
+toy_kba_algorithm.strip_string, to the documents that contain it, and
+each document to the offset of its StreamItem in the decrypted and
+decompressed chunk.  Running the indexer again only indexes the
+hourly directories whose chunk files changed, or that are new.
+
+A name part can only be in a document if its longest run of non-space
+chars is within one of the document's tokens, so a run finds the
+candidates of a chunk by searching the vocabulary of its hour for
+those runs.  Other documents get no records, as with the prefilter in
+toy_kba_pipeline, so the run file is the same as without the index.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from array import array
+
+import numpy
+import regex as re
+
+import toy_kba_algorithm
+import toy_kba_corpus
+import toy_kba_reader
+
+logger = logging.getLogger('kba-toy-system')
+
+class IndexFile(object):
+    '''
+    The index of one hourly directory, read through mmap.  Each file
+    is laid out as:
+
+      header:   MAGIC, NORMALIZATION_VERSION, num_chunks, num_docs,
+                num_tokens, num_postings
+      columns:  the arrays in COLUMNS, in order
+      strings:  chunk file names, then stream_ids, then the sorted
+                tokens, each in utf8 followed by a newline
+
+    Documents are numbered in the order of the chunks and of their
+    items, and are only those with clean_visible.  A document whose
+    text was not indexed, because it could not be decoded or was
+    larger than --max-item-bytes, has NOT_INDEXED in doc_flags and is
+    always a candidate.
+    '''
+    MAGIC = 'KBAIDX01'
+    HEADER_STRUCT = struct.Struct('<8sIIIII')
+    ## name, numpy dtype and length of each column, given the counts
+    ## from the header
+    COLUMNS = [
+        ('chunk_sizes', '<u8', lambda c, d, t, p: c),
+        ('chunk_docs', '<u4', lambda c, d, t, p: c + 1),
+        ('doc_offsets', '<u8', lambda c, d, t, p: d),
+        ('doc_sizes', '<u4', lambda c, d, t, p: d),
+        ('doc_flags', 'u1', lambda c, d, t, p: d),
+        ('token_postings', '<u4', lambda c, d, t, p: t + 1),
+        ('postings', '<u4', lambda c, d, t, p: p),
+        ('string_offsets', '<u4', lambda c, d, t, p: c + d + t + 1),
+        ]
+    NOT_INDEXED = 1
+
+    def __init__(self, path):
+        self.path = path
+        fh = open(path, 'rb')
+        self.buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+
+        magic, version, self.num_chunks, self.num_docs, self.num_tokens, \
+            num_postings = self.HEADER_STRUCT.unpack_from(self.buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError('%s is not a token index' % path)
+        self.version = version
+
+        pos = self.HEADER_STRUCT.size
+        for name, dtype, length in self.COLUMNS:
+            column = numpy.frombuffer(
+                self.buf, dtype,
+                length(self.num_chunks, self.num_docs, self.num_tokens, num_postings),
+                pos)
+            setattr(self, name, column)
+            pos += column.nbytes
+        self.strings_base = pos
+
+        self.chunk_names = [self.string(chunk_num)
+                            for chunk_num in xrange(self.num_chunks)]
+
+    def string(self, string_num):
+        start = self.strings_base + int(self.string_offsets[string_num])
+        end = self.strings_base + int(self.string_offsets[string_num + 1]) - 1
+        return self.buf[start:end]
+
+    def chunks(self):
+        '''
+        :returns list: (name, size) of every chunk file in the index
+        '''
+        return zip(self.chunk_names, self.chunk_sizes.tolist())
+
+    def candidates(self, keys_re):
+        '''
+        :returns numpy.ndarray: bool for each document, whether it has
+        a token in which keys_re finds a match, or was not indexed
+        '''
+        first = self.num_chunks + self.num_docs
+        token_starts = self.string_offsets[first:]
+        vocabulary = self.buf[self.strings_base + int(token_starts[0]):
+                              self.strings_base + int(token_starts[-1])]
+        match_starts = [match.start() for match in keys_re.finditer(vocabulary)]
+
+        ## the token of each match, once each
+        tokens = numpy.unique(numpy.searchsorted(
+                token_starts - token_starts[0], match_starts, 'right') - 1)
+        selected = numpy.zeros(self.num_docs, bool)
+        selected[self.doc_flags & self.NOT_INDEXED != 0] = True
+        if len(tokens):
+            starts = self.token_postings[tokens]
+            ends = self.token_postings[tokens + 1]
+            selected[numpy.concatenate(
+                    [self.postings[start:end]
+                     for start, end in zip(starts.tolist(), ends.tolist())])] = True
+        return selected
+
+def write_index_file(path, chunks):
+    '''
+    Writes the IndexFile of an hourly directory to path, replacing it
+    atomically.  chunks lists (name, size, docs) for every chunk file,
+    where docs lists (stream_id, offset, size, tokens) for every
+    document with clean_visible, and tokens is a set of utf8 tokens, or
+    None if the text was not indexed.
+    '''
+    chunk_sizes = []
+    chunk_docs = [0]
+    doc_offsets = []
+    doc_sizes = []
+    doc_flags = []
+    strings = []
+    token_docs = {}
+    for name, size, docs in chunks:
+        chunk_sizes.append(size)
+        strings.append(name)
+        for stream_id, offset, doc_size, tokens in docs:
+            doc_num = len(doc_offsets)
+            doc_offsets.append(offset)
+            doc_sizes.append(doc_size)
+            strings.append(stream_id)
+            if tokens is None:
+                doc_flags.append(IndexFile.NOT_INDEXED)
+                continue
+            doc_flags.append(0)
+            for token in tokens:
+                doc_nums = token_docs.get(token)
+                if doc_nums is None:
+                    doc_nums = token_docs[token] = array('I')
+                doc_nums.append(doc_num)
+        chunk_docs.append(len(doc_offsets))
+
+    token_postings = [0]
+    postings = array('I')
+    for token in sorted(token_docs):
+        strings.append(token)
+        postings.extend(token_docs[token])
+        token_postings.append(len(postings))
+
+    string_offsets = [0]
+    for string in strings:
+        string_offsets.append(string_offsets[-1] + len(string) + 1)
+
+    columns = dict(chunk_sizes=chunk_sizes, chunk_docs=chunk_docs,
+                   doc_offsets=doc_offsets, doc_sizes=doc_sizes,
+                   doc_flags=doc_flags, token_postings=token_postings,
+                   postings=postings, string_offsets=string_offsets)
+
+    dir_path = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(IndexFile.HEADER_STRUCT.pack(
+                IndexFile.MAGIC, toy_kba_algorithm.NORMALIZATION_VERSION,
+                len(chunk_sizes), len(doc_offsets), len(token_docs), len(postings)))
+        for name, dtype, _ in IndexFile.COLUMNS:
+            fh.write(numpy.asarray(columns[name], dtype).tostring())
+        for string in strings:
+            fh.write(string + '\n')
+    os.rename(tmp_path, path)
+
+def name_keys(entity_representations):
+    '''
+    :returns list: the longest run of non-space chars of every name
+    part, in utf8, or None if some part is only spaces, such as u' '
+    from a recall filter of "-", which is found in almost every
+    document without being one of its tokens.  The empty part has no
+    length, so it never makes a document score and has no key.
+    '''
+    keys = set()
+    for entity_repr in entity_representations.itervalues():
+        for name in entity_repr.parts:
+            if not name:
+                continue
+            runs = name.split(u' ')
+            key = max(runs, key=len)
+            if not key:
+                return None
+            keys.add(key.encode('utf8'))
+    return sorted(keys)
+
+class TokenIndex(object):
+    '''
+    The index in index_dir of the corpus at corpus, which is a
+    directory or a URL, used to find the documents of a chunk that can
+    contain a name part of entity_representations.  Index files are
+    opened as chunks of their hours are asked for, and the candidates
+    of the last hour are kept.
+    '''
+    def __init__(self, index_dir, corpus, entity_representations):
+        self.index_dir = index_dir
+        self.corpus = corpus.rstrip('/')
+        self.keys = name_keys(entity_representations)
+        if self.keys is None:
+            logger.warn('a name part is only spaces, so every document '
+                        'is a candidate and %s is not used' % index_dir)
+        self._init_hour()
+
+    def _init_hour(self):
+        ## the date_hour, IndexFile and candidates of the last hour
+        self.hour = None, None, None
+        self.keys_re = None
+        if self.keys:
+            self.keys_re = re.compile(toy_kba_algorithm.trie_pattern(self.keys))
+
+    def __getstate__(self):
+        ## an mmap cannot be sent to another process
+        state = dict(self.__dict__)
+        del state['hour'], state['keys_re']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_hour()
+
+    def path(self, date_hour):
+        return os.path.join(self.index_dir, date_hour + '.kbi')
+
+    def plan(self, chunk_path, size=None):
+        '''
+        Looks up chunk_path in the index.  If size is provided, it is
+        the size of the chunk file, which must match the index.
+
+        :returns list: (stream_id, offset, candidate) for every document
+        of the chunk that has clean_visible, in order, or None if the
+        chunk is not in the index
+        '''
+        if self.keys_re is None or not chunk_path.startswith(self.corpus + '/'):
+            return None
+        parts = chunk_path[len(self.corpus) + 1:].split('/')
+        if len(parts) != 2:
+            return None
+        date_hour, name = parts
+
+        if self.hour[0] != date_hour:
+            index_file = candidates = None
+            if os.path.exists(self.path(date_hour)):
+                index_file = IndexFile(self.path(date_hour))
+                if index_file.version != toy_kba_algorithm.NORMALIZATION_VERSION:
+                    logger.warn('ignoring %s from another NORMALIZATION_VERSION'
+                                % index_file.path)
+                    index_file = None
+                else:
+                    candidates = index_file.candidates(self.keys_re)
+            self.hour = date_hour, index_file, candidates
+
+        date_hour, index_file, candidates = self.hour
+        if index_file is None or name not in index_file.chunk_names:
+            return None
+        chunk_num = index_file.chunk_names.index(name)
+        if size is not None and size != index_file.chunk_sizes[chunk_num]:
+            logger.warn('%s has changed since it was indexed' % chunk_path)
+            return None
+
+        start = int(index_file.chunk_docs[chunk_num])
+        end = int(index_file.chunk_docs[chunk_num + 1])
+        num_chunks = index_file.num_chunks
+        return [(index_file.string(num_chunks + doc_num),
+                 int(index_file.doc_offsets[doc_num]),
+                 bool(candidates[doc_num]))
+                for doc_num in xrange(start, end)]
+
+def index_chunk(chunk_path, max_item_bytes=None):
+    '''
+    :returns list: (stream_id, offset, size, tokens) for every
+    document in chunk_path with clean_visible, for write_index_file
+    '''
+    docs = []
+    ## an item larger than max_item_bytes is cut down to learn its
+    ## stream_id, and read by every run, which may have a larger one
+    for offset, size, si in toy_kba_reader.read_chunk(
+            chunk_path, max_item_bytes=max_item_bytes, oversize='truncate',
+            positions=True):
+        if max_item_bytes is not None and size > max_item_bytes:
+            docs.append((si.stream_id, offset, size, None))
+            continue
+        if not si.body.clean_visible:
+            continue
+        try:
+            text = toy_kba_algorithm.strip_string(si.body.clean_visible.decode('utf8'))
+        except Exception, exc:
+            ## the Scorer also fails on this document
+            logger.warn('failed to index %s: %s' % (si.stream_id, exc))
+            docs.append((si.stream_id, offset, size, None))
+            continue
+        tokens = set(text.encode('utf8').split(' '))
+        tokens.discard('')
+        docs.append((si.stream_id, offset, size, tokens))
+    return docs
+
+def index_date_hour(task):
+    '''
+    Indexes the chunk files of one hourly directory into index_dir,
+    unless its index is up to date.
+
+    :returns tuple: (date_hour, num_docs), where num_docs is None if
+    the index was up to date
+    '''
+    corpus, index_dir, date_hour, chunk_names, max_item_bytes = task
+    dir_path = os.path.join(corpus, date_hour)
+    chunks = [(name, os.path.getsize(os.path.join(dir_path, name)))
+              for name in chunk_names]
+
+    path = os.path.join(index_dir, date_hour + '.kbi')
+    if os.path.exists(path):
+        index_file = IndexFile(path)
+        if index_file.version == toy_kba_algorithm.NORMALIZATION_VERSION and \
+                index_file.chunks() == chunks:
+            return date_hour, None
+
+    indexed = []
+    num_docs = 0
+    for name, size in chunks:
+        docs = index_chunk(os.path.join(dir_path, name), max_item_bytes)
+        indexed.append((name, size, docs))
+        num_docs += len(docs)
+    write_index_file(path, indexed)
+    return date_hour, num_docs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', help='directory of YYYY-MM-DD-HH directories of chunk files')
+    parser.add_argument('index_dir', help='directory in which to create or update the index')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes indexing hourly directories in parallel')
+    parser.add_argument('--max-item-bytes', type=int, default=None, help='ceiling on the thrift size of a StreamItem to index; larger items are read by every run, see toy_kba_system.py --max-item-bytes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not os.path.isdir(args.corpus):
+        sys.exit('%s is not a directory' % args.corpus)
+    if not os.path.exists(args.index_dir):
+        os.makedirs(args.index_dir)
+
+    start_time = time.time()
+    hours = []
+    for date_hour, chunk_path in toy_kba_corpus.date_hour_chunks(args.corpus):
+        if not hours or hours[-1][2] != date_hour:
+            hours.append((args.corpus, args.index_dir, date_hour, [], args.max_item_bytes))
+        hours[-1][3].append(os.path.basename(chunk_path))
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(index_date_hour, hours)
+    else:
+        results = (index_date_hour(task) for task in hours)
+
+    num_indexed = 0
+    for date_hour, num_docs in results:
+        if num_docs is None:
+            logger.debug('%s is up to date' % date_hour)
+            continue
+        logger.info('indexed %d docs of %s' % (num_docs, date_hour))
+        num_indexed += 1
+
+    logger.info('indexed %d of %d hours in %.1f seconds' % (
+            num_indexed, len(hours), time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
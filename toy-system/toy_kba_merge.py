@@ -0,0 +1,188 @@
+#!/usr/bin/python
+"""
+Merges the run files written by toy_kba_system.py with --shard i/N
+into one submission file, with a single filter_run whose run_info
+combines those of the shards.
+
+    python toy_kba_system.py --shard 0/2 ... filter-run.0.txt
+    python toy_kba_system.py --shard 1/2 ... filter-run.1.txt
+    python toy_kba_merge.py filter-run.txt filter-run.0.txt filter-run.1.txt
+
+The lines of the shards are merged in order of their date_hour, so
+that a run over hourly directories stays in chronological order.  Only
+one line of each shard is held in memory at a time.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import re
+import os
+import sys
+import json
+import heapq
+import logging
+import argparse
+
+import toy_kba_output
+
+logger = logging.getLogger('kba-toy-system')
+
+## run_info counters that are totals over the work each shard did;
+## other numbers, like num_entities, describe the whole run and are
+## the same or overlapping in every shard, so the largest is kept
+SUMMED_RUN_INFO = ['num_entity_doc_compares', 'num_filter_results',
+                   'elapsed_time', 'items_skipped', 'items_truncated',
+                   'score_memo_hits', 'score_memo_misses']
+
+## index of the date_hour field in each line of a run file
+DATE_HOUR_FIELD = 7
+
+def read_filter_run(path):
+    '''
+    Reads the filter_run that toy_kba_system.py writes in comment
+    lines at the end of a run file
+
+    :returns dict: the filter_run, or None if there is none
+    '''
+    comments = []
+    for line in toy_kba_output.open_run_file(path):
+        if line.startswith('#'):
+            comments.append(line[1:])
+
+    ## the first comment line is a one line header written at the
+    ## start of the run, before its run_info was known
+    for start in (1, 0):
+        try:
+            return json.loads(''.join(comments[start:]))
+        except ValueError:
+            continue
+    return None
+
+def merge_run_info(run_infos):
+    '''
+    :returns dict: the combined run_info of the shards
+    '''
+    merged = {'num_shards': len(run_infos)}
+    stages = {}
+    for run_info in run_infos:
+        for key, value in run_info.iteritems():
+            if key == 'shard':
+                continue
+            elif key == 'stages':
+                for stage, rec in value.iteritems():
+                    total = stages.setdefault(stage, {'seconds': 0.0, 'count': 0})
+                    total['seconds'] += rec['seconds']
+                    total['count'] += rec['count']
+            elif key in SUMMED_RUN_INFO:
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged[key] = max(merged.get(key, value), value)
+    if stages:
+        merged['stages'] = stages
+    return merged
+
+def check_shards(filter_runs, partial=False):
+    '''
+    Exits if the shards do not make up exactly one run
+    '''
+    shards = set()
+    num_shards = set()
+    for path, filter_run in filter_runs:
+        if filter_run is None:
+            sys.exit('%s has no filter_run, was it written with --shard?' % path)
+        shard = filter_run['run_info'].get('shard')
+        if shard is None:
+            sys.exit('%s was not written with --shard' % path)
+        shard_num, count = map(int, shard.split('/'))
+        if shard_num in shards:
+            sys.exit('shard %s is given more than once' % shard)
+        shards.add(shard_num)
+        num_shards.add(count)
+
+    if len(num_shards) != 1:
+        sys.exit('shards are from runs split %s ways' % sorted(num_shards))
+
+    for key in ('team_id', 'system_id', 'task_id'):
+        values = set(filter_run[key] for _, filter_run in filter_runs)
+        if len(values) != 1:
+            sys.exit('shards have different %s: %s' % (key, sorted(values)))
+
+    missing = set(xrange(num_shards.pop())) - shards
+    if missing:
+        if not partial:
+            sys.exit('missing shards %s, use --partial to merge anyway' % sorted(missing))
+        logger.warn('merging without shards %s' % sorted(missing))
+
+def merge_lines(paths):
+    '''
+    k-way merge of the run lines of paths by date_hour; ties keep the
+    order of paths
+
+    :returns generator: the lines of all paths
+    '''
+    heap = []
+    def push(shard_num, lines):
+        for line in lines:
+            if line.startswith('#'):
+                continue
+            date_hour = line.split('\t')[DATE_HOUR_FIELD]
+            heapq.heappush(heap, (date_hour, shard_num, line, lines))
+            return
+
+    for shard_num, path in enumerate(paths):
+        push(shard_num, iter(toy_kba_output.open_run_file(path)))
+
+    last = {}
+    while heap:
+        date_hour, shard_num, line, lines = heapq.heappop(heap)
+        if date_hour < last.get(shard_num, ''):
+            logger.warn('%s is not in date_hour order' % paths[shard_num])
+        last[shard_num] = date_hour
+        yield line
+        push(shard_num, lines)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='path of the merged run file to create, compressed if it ends in .gz or .xz')
+    parser.add_argument('shards', nargs='+', help='run files written with --shard')
+    parser.add_argument('--partial', default=False, action='store_true', help='merge even if some shards are missing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    assert not os.path.exists(args.output), "Output path already exists."
+
+    filter_runs = [(path, read_filter_run(path)) for path in args.shards]
+    check_shards(filter_runs, args.partial)
+
+    filter_run = dict(filter_runs[0][1])
+    filter_run['run_info'] = merge_run_info(
+        [shard_run['run_info'] for _, shard_run in filter_runs])
+
+    output = toy_kba_output.RunWriter(
+        args.output, toy_kba_output.output_compression(args.output))
+    output.write_comment(json.dumps(filter_run))
+
+    num_lines = 0
+    for line in merge_lines(args.shards):
+        output.write_line(line)
+        num_lines += 1
+
+    if num_lines != filter_run['run_info'].get('num_filter_results', num_lines):
+        logger.warn('merged %d lines, but the shards report %d' % (
+                num_lines, filter_run['run_info']['num_filter_results']))
+
+    ## same trailing comment lines as toy_kba_system.py
+    filter_run_json_string = json.dumps(filter_run, indent=4, sort_keys=True)
+    output.write_comment(re.sub("\n", "\n#", filter_run_json_string))
+    output.close()
+
+    logger.info('merged %d lines from %d shards into %s' % (
+            num_lines, len(args.shards), args.output))
+
+if __name__ == '__main__':
+    main()
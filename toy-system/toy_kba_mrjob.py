@@ -1,35 +1,45 @@
 #!/usr/bin/python
 """
 This is a MapReduce version of toy_kba_system.py.  It illustrates the
-input/output for the citation-recommendation-2012 task in TREC KBA.
+input/output for the kba-ccr-2013 and kba-ssf-2013 tasks in TREC KBA.
 
-Unlike toy_kba_system.py, this uses hadoop and mrjob to handle the
-opening of gzipped archives and deserialization via JSON.  Also unlike
-toy_kba_system.py, this does not create the filter-run instance to
-describe the run submission nor does this iterate over date-hour
-directories chronologically.  Those crucial steps would need to be
-constructured around this.
+Each line of input is the path of a chunk file, which every mapper
+must be able to read, e.g. on a shared filesystem.  The mapper scores
+every document in the chunk against all of the targets and emits the
+lines of a run submission file.  Unlike toy_kba_system.py, this does
+not create the filter-run instance to describe the run submission nor
+does this iterate over date-hour directories chronologically.  Those
+crucial steps would need to be constructured around this.
+
+The entity representations are prepared once by toy_kba_system.py
+with --save-entities and shipped to the mappers with the job:
+
+    python toy_kba_system.py --save-entities entities.json --max 0 ...
+    find kba-corpus -name '*.sc.xz.gpg' > chunk-paths.txt
+    python toy_kba_mrjob.py -r local --entities entities.json chunk-paths.txt
 
 This is a mapper-only MapReduce job.
 
 
-Copyright (c) 2012 Computable Insights LLC
+Copyright (c) 2012-2013 Computable Insights LLC
 released under the MIT X11 License, see license.txt
 """
 
 ## import standard libraries and parse command line args
+import os
 import sys
 import json
-import time
-import urllib
 
 ## use this hadoop streaming wrapper from Yelp, see
 ## https://github.com/Yelp/mrjob/
 from mrjob.job import MRJob
-from mrjob.protocol import JSONValueProtocol
+from mrjob.protocol import RawValueProtocol
 
 ## get our filter algorithm
 import toy_kba_algorithm
+import toy_kba_corpus
+import toy_kba_pipeline
+import toy_kba_stats
 
 def log(mesg):
     sys.stderr.write("%s\n" % mesg)
@@ -40,84 +50,84 @@ def log_status(mesg):
 
 ## This is our job class with a mapper method.  No reducer is needed.
 class ToyKBA(MRJob):
-    ## tell mrjob to expect lines without keys containing just a JSON string
-    INPUT_PROTOCOL = JSONValueProtocol
-    ## similarly, generate output as json lines without keys
-    OUTPUT_PROTOCOL = JSONValueProtocol
-
-    def __init__(self, *args, **kwargs):
-        MRJob.__init__(self, *args, **kwargs)
-
-        ## load entities from json file
-        log("loading entity list")
-        entities = json.load(urllib.urlopen("https://s3.amazonaws.com/trec-kba-2012/entity-urlnames.json"))
-        self.entity_representations = toy_kba_algorithm.prepare_entities(entities)
-
-    def mapper(self, key, doc):
-        ## mrjob has already deserialize the line to get a stream-item
-        ## http://trec-kba.org/schemas/v1.0/stream-item.json
-
-        self.increment_counter('ToyKBA', 'docs', 1)
-
-        try:
-            if "cleansed" not in doc["body"]:
-                ## This sytem onnly considers docs that have cleansed
-                ## text from boilerpipe's ArticleExtractor.
-                ## Alternatively, system can use doc["body"]["raw"].
-                return
-
-            ## count docs considered
-            self.increment_counter('ToyKBA', 'docs-with-cleansed', 1)
-
-            ## get the text
-            raw_bytes = doc["body"]["cleansed"].decode("string-escape")
-            try:
-                ## the content-item instance called "body" has a
-                ## guess at character encoding from HTTP headers
-                ## and meta tags.
-                if doc["body"]["encoding"]:
-                    text = raw_bytes.decode(doc["body"]["encoding"], "ignore")
-                else:
-                    text = raw_bytes
-            except Exception, exc:
-                log("decoding raw_bytes failed: %s" % exc)
-                ## proceed anyway
-                text = raw_bytes
-
-            ## instantiate an instance of Scorer from toy_kba_algorithm
-            scorer = toy_kba_algorithm.Scorer(text)
-
-            ## give up if the scorer fails
-            if not scorer.ready:
-                return
-
-            self.increment_counter('ToyKBA', 'docs-can-score', 1)
-
-            ## start filter_result instance 
-            filter_result = {
-                "stream_id": doc["stream_id"],
-                "citations": []  # will populate below
-                }
-
-            for entity in self.entity_representations:
-                ## run a filter algorithm
-                relevance = scorer.compute_relevance(self.entity_representations[entity])
-
-                self.increment_counter('ToyKBA', 'doc-entity-scores', 1)
-
-                ## hardcoded cutoff
-                if relevance > 400:
-                    ## add to filter_result
-                    filter_result["citations"].append(
-                        {"entity": entity, "relevance": relevance})
-
-            if len(filter_result["citations"]) > 0:
-                ## give the filter result to hadoop to save
-                yield None, filter_result
-
-        finally:
-            ## update hadoops skip record counters
-            self.increment_counter('SkippingTaskCounters','MapProcessedRecords',1)
+    ## each line of input is a chunk path
+    INPUT_PROTOCOL = RawValueProtocol
+    ## generate output as lines of a run submission file
+    OUTPUT_PROTOCOL = RawValueProtocol
+    ## ship the modules that the mapper imports along with this script
+    FILES = ['toy_kba_algorithm.py', 'toy_kba_cache.py', 'toy_kba_corpus.py',
+             'toy_kba_pipeline.py', 'toy_kba_reader.py', 'toy_kba_stats.py']
+
+    def configure_args(self):
+        super(ToyKBA, self).configure_args()
+        self.add_file_arg("--entities", help="JSON file of entity representations from toy_kba_system.py --save-entities")
+        self.add_passthru_arg("--cutoff", type=int, default=400, help="relevance cutoff, measured in thousandths")
+        self.add_passthru_arg("--names-frac", default=False, action="store_true", help="use fraction of name length as confidence")
+        self.add_passthru_arg("--ssf", default=False, action="store_true", help="generate Streaming Slot Filling (SSF) results instead of Cummulative Citation Recommendation (CCR)")
+        self.add_passthru_arg("--target-id", default='', help="specific target_id to run")
+        self.add_passthru_arg("--team-id", default="CompInsights", help="team_id for the first field of each line")
+        self.add_passthru_arg("--system-id", default="toy_1", help="system_id for the second field of each line")
+
+    def mapper_init(self):
+        ## load the entities that were shipped with the job
+        log("loading entity representations")
+        entity_representations = dict(
+            (target_id, toy_kba_algorithm.EntityRepresentation.from_dict(rec))
+            for target_id, rec in json.load(open(self.options.entities)).iteritems())
+
+        if self.options.target_id:
+            self.target_ids = [self.options.target_id]
+        else:
+            self.target_ids = sorted(entity_representations)
+
+        ## same sense of --names-frac as in toy_kba_system.py
+        conf_heuristic = toy_kba_algorithm.LEN_FRAC
+        if not self.options.names_frac:
+            conf_heuristic = toy_kba_algorithm.NAMES_FRAC
+
+        filter_run = {"team_id": self.options.team_id,
+                      "system_id": self.options.system_id}
+
+        self.run_scorer = toy_kba_pipeline.RunScorer(
+            entity_representations, filter_run, conf_heuristic,
+            self.options.cutoff, self.options.ssf)
+
+    def mapper(self, key, chunk_path):
+        chunk_path = chunk_path.strip()
+        if not chunk_path:
+            return
+
+        log_status("scoring %s" % chunk_path)
+
+        ## chunks in hourly directories carry their date_hour
+        date_hour = os.path.basename(os.path.dirname(chunk_path))
+        if not toy_kba_corpus.date_hour_re.match(date_hour):
+            date_hour = ''
+
+        ## collect the stats of just this chunk
+        stats = toy_kba_stats.RunStats()
+        self.run_scorer.stats = stats
+
+        for recs in toy_kba_pipeline.score_chunk(
+                self.run_scorer, chunk_path, self.target_ids, date_hour):
+            if recs is None:
+                continue
+            for rec in recs:
+                ## give the line to hadoop to save
+                yield None, "\t".join(map(str, rec))
+
+        self.increment_counters(stats)
+
+        ## update hadoops skip record counters
+        self.increment_counter('SkippingTaskCounters', 'MapProcessedRecords', 1)
+
+    def increment_counters(self, stats):
+        ## hadoop counters are integers, so stage times are in msec
+        for counter, value in stats.counters.iteritems():
+            self.increment_counter('ToyKBA', counter, value)
+        for stage, seconds in stats.seconds.iteritems():
+            self.increment_counter('ToyKBA', '%s-msec' % stage, int(seconds * 1000))
+            self.increment_counter('ToyKBA', '%s-count' % stage, stats.counts[stage])
 
 
 if __name__ == "__main__":
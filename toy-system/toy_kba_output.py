@@ -0,0 +1,447 @@
+#!/usr/bin/python
+"""
+Writes the lines of a run submission file from a background thread,
+so that formatting, compressing and writing the output overlaps with
+scoring.  Also writes the score store of a run, see ScoreWriter.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import gzip
+import json
+import time
+import struct
+import Queue
+import logging
+import threading
+import subprocess
+from array import array
+
+logger = logging.getLogger('kba-toy-system')
+
+def output_compression(path):
+    '''
+    :returns str: 'gz' or 'xz' if path ends with that extension, or None
+    '''
+    for compression in ('gz', 'xz'):
+        if path.endswith('.' + compression):
+            return compression
+    return None
+
+def open_run_file(path):
+    '''
+    Opens a run file for reading, decompressing it if its name ends in
+    .gz or .xz
+
+    :returns file: iterates over the lines of the run file
+    '''
+    compression = output_compression(path)
+    if compression == 'gz':
+        return gzip.open(path, 'rb')
+    elif compression == 'xz':
+        child = subprocess.Popen(['xz', '--decompress', '--stdout', path],
+                                 stdout=subprocess.PIPE, close_fds=True)
+        return child.stdout
+    return open(path, 'rb')
+
+class RunWriter(object):
+    '''
+    Takes lists of records of a run submission, see
+    toy_kba_pipeline.RunScorer, through a queue, formats them as tab
+    separated lines in batches and writes them to path from a
+    background thread.  If compression is 'gz' or 'xz', the output is
+    compressed as it is written, with the gzip module or an xz child
+    process.  The file is fsynced every fsync_interval seconds, if
+    that is not None, and when the writer is closed.  If append is
+    true, writing continues at the end of an existing file.
+
+        writer = RunWriter('run.txt.xz', 'xz')
+        writer.write(recs)
+        writer.close()
+    '''
+    ## largest number of queued items to format into one write
+    BATCH_SIZE = 1000
+
+    def __init__(self, path, compression=None, fsync_interval=60,
+                 stats=None, queue_size=10000, append=False):
+        if compression not in (None, 'gz', 'xz'):
+            raise ValueError('unknown compression %r' % compression)
+
+        self.path = path
+        self.compression = compression
+        self.fsync_interval = fsync_interval
+        ## optional toy_kba_stats.RunStats
+        self.stats = stats
+
+        self.raw = open(path, append and 'ab' or 'wb')
+        self._open_stream()
+
+        ## a bounded queue keeps a slow disk from filling memory
+        self.queue = Queue.Queue(queue_size)
+        ## set by the thread if writing fails, raised in the caller
+        self.error = None
+        self.last_fsync = time.time()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, recs):
+        '''
+        queues a list of records, each a list of 11 fields
+        '''
+        self._check()
+        self.queue.put(recs)
+
+    def write_line(self, line):
+        '''
+        queues an already formatted line, ending in a newline
+        '''
+        self._check()
+        self.queue.put(line)
+
+    def write_comment(self, text):
+        '''
+        queues text to write as a comment line that starts with #
+        '''
+        self._check()
+        self.queue.put('#%s\n' % text)
+
+    def checkpoint(self):
+        '''
+        Waits until everything queued so far is written and fsynced.
+        Compressed output is ended there and continued in a new gzip
+        member or xz stream, so that the file can be truncated back to
+        this point and still decompress.
+
+        :returns int: size of the file at this point
+        '''
+        self._check()
+        checkpoint = _Checkpoint()
+        self.queue.put(checkpoint)
+        checkpoint.done.wait()
+        self._check()
+        return checkpoint.offset
+
+    def close(self):
+        '''
+        writes everything that is queued, fsyncs and closes the file
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+        self._close_stream()
+        self._fsync()
+        self.raw.close()
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError('failed to write %s: %s' % (self.path, self.error))
+
+    def _open_stream(self):
+        self.xz_child = None
+        if self.compression == 'gz':
+            self.fh = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        elif self.compression == 'xz':
+            self.raw.flush()
+            self.xz_child = subprocess.Popen(
+                ['xz', '--compress'], stdin=subprocess.PIPE,
+                stdout=self.raw, close_fds=True)
+            self.fh = self.xz_child.stdin
+        else:
+            self.fh = self.raw
+
+    def _close_stream(self):
+        if self.fh is not self.raw:
+            ## finish the compressed stream
+            self.fh.close()
+        if self.xz_child is not None:
+            if self.xz_child.wait() != 0:
+                raise IOError('xz failed to compress %s' % self.path)
+
+    def _fsync(self):
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.last_fsync = time.time()
+
+    def _format(self, item):
+        if isinstance(item, str):
+            return item
+        return ''.join('\t'.join(map(str, rec)) + '\n' for rec in item)
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        if self.stats is not None:
+            start = self.stats.start('write')
+        data = ''.join(map(self._format, batch))
+        self.fh.write(data)
+        if self.stats is not None:
+            num_recs = sum(len(item) for item in batch
+                           if not isinstance(item, str))
+            self.stats.stop('write', start, num_recs)
+            self.stats.incr('bytes_written', len(data))
+
+    def _run(self):
+        done = False
+        checkpoint = None
+        try:
+            while not done:
+                ## block for one item, then take whatever else is
+                ## queued, up to a checkpoint or close
+                batch = []
+                item = self.queue.get()
+                while True:
+                    if item is None:
+                        done = True
+                        break
+                    if isinstance(item, _Checkpoint):
+                        checkpoint = item
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.BATCH_SIZE:
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+
+                self._write_batch(batch)
+
+                if checkpoint is not None:
+                    self._close_stream()
+                    self._fsync()
+                    checkpoint.offset = os.fstat(self.raw.fileno()).st_size
+                    self._open_stream()
+                    checkpoint.done.set()
+                    checkpoint = None
+
+                elif self.fsync_interval is not None and \
+                        time.time() - self.last_fsync > self.fsync_interval:
+                    ## compressors hold back a partial block, so only
+                    ## what they have already written is made durable
+                    self.fh.flush()
+                    self._fsync()
+
+        except Exception, exc:
+            logger.critical('failed to write %s' % self.path, exc_info=True)
+            self.error = exc
+            if checkpoint is not None:
+                checkpoint.done.set()
+            ## keep draining so that the caller does not block on put
+            while not done:
+                item = self.queue.get()
+                if isinstance(item, _Checkpoint):
+                    item.done.set()
+                done = item is None
+
+class _Checkpoint(object):
+    ## queued by RunWriter.checkpoint to wait for the writer thread
+    def __init__(self):
+        self.done = threading.Event()
+        self.offset = None
+
+class ScoreWriter(object):
+    '''
+    Stores every score of a run with a confidence above zero, whatever
+    its cutoff, with the slot fills of every vital one, whether or not
+    the run is SSF, so that toy_kba_scores.py can write the run files
+    of other cutoffs, or of the other task, without scoring the corpus
+    again.
+
+    The file is MAGIC followed by records, each a RECORD_STRUCT of a
+    tag and the length of the data that follows:
+
+      'RUN ' record:  JSON of the filter_run, written when the file is
+                      created and again when the writer is closed
+      'ROWS' record:  ROWS_STRUCT of num_rows, num_slots and
+                      num_strings, then each of ROW_COLUMNS as num_rows
+                      items, each of SLOT_COLUMNS as num_slots items,
+                      num_strings + 1 uint32 offsets into the blob and
+                      the blob of utf8 strings
+
+    The data of each record, and each column and the blob within it, is
+    padded to a multiple of 4 bytes.
+    Strings are numbered within their ROWS record.  The slots of row
+    i are slot_end[i - 1] up to slot_end[i].
+    '''
+    MAGIC = 'KBASCR01'
+    RECORD_STRUCT = struct.Struct('<4sI')
+    ROWS_STRUCT = struct.Struct('<III')
+    ## (name, array typecode) of each column, in the order of the
+    ## fields of a run line
+    ROW_COLUMNS = [('stream_id', 'I'), ('target_id', 'I'),
+                   ('confidence', 'i'), ('relevance', 'b'),
+                   ('contains_mention', 'b'), ('date_hour', 'I'),
+                   ('slot_end', 'I')]
+    SLOT_COLUMNS = [('slot_conf', 'i'), ('slot_name', 'I'),
+                    ('slot_equiv_id', 'I'), ('byte_range', 'I')]
+    ## rows held in memory before they are written as a record
+    BLOCK_ROWS = 2**16
+
+    def __init__(self, path, filter_run, offset=None):
+        '''
+        Creates path, or if offset is provided, truncates the existing
+        path to offset, as returned by checkpoint, and appends to it.
+        '''
+        self.path = path
+        if offset is None:
+            self.fh = open(path, 'wb')
+            self.fh.write(self.MAGIC)
+            self._write_run(filter_run)
+        else:
+            self.fh = open(path, 'r+b')
+            self.fh.truncate(offset)
+            self.fh.seek(offset)
+        self._reset()
+
+    def _reset(self):
+        self.columns = dict((name, array(typecode)) for name, typecode
+                            in self.ROW_COLUMNS + self.SLOT_COLUMNS)
+        self.string_nums = {}
+        self.strings = []
+
+    def _intern(self, value):
+        string_num = self.string_nums.get(value)
+        if string_num is None:
+            string_num = self.string_nums[value] = len(self.strings)
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            self.strings.append(value)
+        return string_num
+
+    def write(self, scores):
+        '''
+        Adds scores, a list of (stream_id, target_id, confidence,
+        relevance, contains_mention, date_hour, slot_rows) tuples, as
+        built by toy_kba_pipeline.RunScorer with keep_scores, where
+        slot_rows is a list of the (slot_conf, slot_name,
+        slot_equiv_id, byte_range) rows of Scorer.fill_slots
+        '''
+        columns = self.columns
+        intern = self._intern
+        for stream_id, target_id, confidence, relevance, contains_mention, \
+                date_hour, slot_rows in scores:
+            columns['stream_id'].append(intern(stream_id))
+            columns['target_id'].append(intern(target_id))
+            columns['confidence'].append(confidence)
+            columns['relevance'].append(relevance)
+            columns['contains_mention'].append(contains_mention)
+            columns['date_hour'].append(intern(date_hour))
+            for slot_conf, slot_name, slot_equiv_id, byte_range in slot_rows:
+                columns['slot_conf'].append(slot_conf)
+                columns['slot_name'].append(intern(slot_name))
+                columns['slot_equiv_id'].append(intern(slot_equiv_id))
+                columns['byte_range'].append(intern(byte_range))
+            columns['slot_end'].append(len(columns['slot_conf']))
+
+        if len(columns['slot_end']) >= self.BLOCK_ROWS:
+            self.flush()
+
+    def flush(self):
+        '''
+        writes the rows added so far as a ROWS record
+        '''
+        num_rows = len(self.columns['slot_end'])
+        if not num_rows:
+            return
+        offsets = array('I', [0])
+        for value in self.strings:
+            offsets.append(offsets[-1] + len(value))
+
+        parts = [self.ROWS_STRUCT.pack(num_rows, len(self.columns['slot_conf']),
+                                       len(self.strings))]
+        for name, typecode in self.ROW_COLUMNS + self.SLOT_COLUMNS:
+            parts.append(_padded(self.columns[name].tostring()))
+        parts.append(offsets.tostring())
+        parts.append(_padded(''.join(self.strings)))
+        self._write_record('ROWS', ''.join(parts))
+        self._reset()
+
+    def checkpoint(self):
+        '''
+        Writes and fsyncs everything added so far.
+
+        :returns int: size of the file at this point
+        '''
+        self.flush()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        return self.fh.tell()
+
+    def close(self, filter_run):
+        '''
+        writes the rows added so far and the final filter_run, and
+        closes the file
+        '''
+        self.flush()
+        self._write_run(filter_run)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+
+    def _write_run(self, filter_run):
+        ## padded with white space, so that ROWS records stay aligned
+        self._write_record('RUN ', _padded(json.dumps(filter_run), ' '))
+
+    def _write_record(self, tag, data):
+        self.fh.write(self.RECORD_STRUCT.pack(tag, len(data)))
+        self.fh.write(data)
+
+def _padded(data, fill='\0'):
+    ## pads data to a multiple of 4 bytes
+    return data + fill * (-len(data) % 4)
+
+class RunManifest(object):
+    '''
+    Log of the checkpoints of a run, kept next to its output file so
+    that an interrupted run can be resumed.  Each line is a JSON
+    object with the size of the output file at the checkpoint, the
+    tasks completed since the previous checkpoint, and the run_info
+    counters of the run so far.  A last line cut short by a crash is
+    ignored.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        '''
+        :returns tuple: (offset, completed, run_info) of the last
+        checkpoint, where completed is a list of all tasks completed
+        before it, or (0, [], {}) if there is none
+        '''
+        offset, completed, run_info = 0, [], {}
+        if not os.path.exists(self.path):
+            return offset, completed, run_info
+
+        for line in open(self.path):
+            try:
+                checkpoint = json.loads(line)
+            except ValueError:
+                logger.warn('ignoring incomplete checkpoint in %s' % self.path)
+                break
+            offset = checkpoint['offset']
+            completed.extend(checkpoint['completed'])
+            run_info = checkpoint['run_info']
+
+        return offset, completed, run_info
+
+    def record(self, offset, completed, run_info):
+        '''
+        appends a checkpoint and fsyncs it
+        '''
+        with open(self.path, 'ab') as fh:
+            fh.write(json.dumps({'offset': offset, 'completed': completed,
+                                 'run_info': run_info}) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def truncate(self):
+        '''
+        starts the log over, for a run that starts from the beginning
+        '''
+        open(self.path, 'wb').close()
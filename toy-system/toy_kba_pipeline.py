@@ -0,0 +1,860 @@
+#!/usr/bin/python
+"""
+Turns StreamItems into the lines of a kba-ccr-2013 or kba-ssf-2013
+submission file, see http://trec-kba.org/trec-kba-2013.shtml#submissions
+
+This is the body of the main loop of toy_kba_system.py, separated out
+so that the different ways of scheduling a run can share it.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import time
+import hashlib
+import logging
+import signal
+import multiprocessing
+import numpy
+
+## get our filter algorithm
+import toy_kba_algorithm
+import toy_kba_cache
+import toy_kba_corpus
+import toy_kba_reader
+import toy_kba_stats
+
+logger = logging.getLogger('kba-toy-system')
+
+## number of documents that score_blocks scores at once.  Until its
+## block is scored, each document holds its serif sentences, which
+## are hundreds of KB of thrift objects, so a block of 64 dominated
+## peak memory; 16 still batches the scan over all targets.
+BATCH_DOCS = 16
+
+class ScratchScorers(object):
+    '''
+    A ring of Scorers that are reset for each new document in turn,
+    instead of allocating a Scorer per document.  score_blocks holds
+    at most BATCH_DOCS documents with scorers, and drops them once
+    they are scored, so a Scorer is never reset while it is in use.
+    '''
+    def __init__(self, size=BATCH_DOCS):
+        self.scorers = [toy_kba_algorithm.Scorer() for _ in xrange(size)]
+        self.next = 0
+
+    def get(self, si, normalized=None):
+        '''
+        :returns Scorer: the next Scorer, reset for si, or for
+        normalized text as in Scorer.reset
+        '''
+        scorer = self.scorers[self.next]
+        self.next = (self.next + 1) % len(self.scorers)
+        scorer.reset(si, normalized)
+        return scorer
+
+class RunScorer(object):
+    '''
+    Scores StreamItems against prepared entities and assembles the
+    records of a run submission.
+    '''
+    def __init__(self, entity_representations, filter_run,
+                 conf_heuristic=toy_kba_algorithm.LEN_FRAC,
+                 cutoff=400, ssf=False, text_cache=None,
+                 exact_slot_ranges=False, prefilter=True, keep_scores=False,
+                 remote=None, max_item_bytes=None, oversize='skip',
+                 score_memo=0, token_index=None, matcher=None):
+        self.entity_representations = entity_representations
+        self.filter_run = filter_run
+        self.conf_heuristic = conf_heuristic
+        self.cutoff = cutoff
+        self.ssf = ssf
+        ## optional toy_kba_cache.TextCache
+        self.text_cache = text_cache
+        self.exact_slot_ranges = exact_slot_ranges
+        ## also return the scores below the cutoff, for a
+        ## toy_kba_output.ScoreWriter
+        self.keep_scores = keep_scores
+        ## optional toy_kba_remote.HTTPCorpus, from which chunk paths
+        ## that are URLs are fetched
+        self.remote = remote
+        ## ceiling on the thrift size of a StreamItem, and what
+        ## toy_kba_reader does with larger ones
+        self.max_item_bytes = max_item_bytes
+        self.oversize = oversize
+        ## scores and slot fills of up to score_memo recently seen
+        ## documents, keyed by a hash of their clean_visible
+        self.memo = None
+        if score_memo > 0 and text_cache is None:
+            ## a text_cache must hold the normalized text of every
+            ## document, so none can be skipped
+            self.memo = toy_kba_cache.ScoreMemo(score_memo)
+
+        ## compile all of the name parts into one automaton, so each
+        ## document is scanned once for all targets, unless an
+        ## EntityMatcher of entity_representations is provided
+        if matcher is None:
+            matcher = toy_kba_algorithm.EntityMatcher(entity_representations)
+        self.matcher = matcher
+        ## target_ids, and their columns in the matcher's BatchScores
+        self._columns = None, None
+
+        ## skip decoding documents that cannot reach the cutoff.  With
+        ## a negative cutoff every document is in the run, and a
+        ## text_cache must hold every document of a chunk.
+        self.prefilter = None
+        if prefilter and cutoff >= 0 and text_cache is None:
+            self.prefilter = toy_kba_algorithm.NamePrefilter(entity_representations)
+
+        ## optional toy_kba_index.TokenIndex, which rules out documents
+        ## before they are read, when the prefilter could be used
+        self.token_index = None
+        if cutoff >= 0 and text_cache is None:
+            self.token_index = token_index
+
+        ## Scorers reused by score_chunk for every document
+        self.scratch = ScratchScorers()
+
+        ## replaced by score_chunks to share the caller's RunStats
+        self.stats = toy_kba_stats.RunStats()
+
+    def empty_result(self):
+        '''
+        :returns: the output of score_stream_item for a document in
+        which no target has a name part
+        '''
+        if self.keep_scores:
+            return [], []
+        return []
+
+    def score_stream_item(self, si, target_ids, date_hour=''):
+        '''
+        Scores si against each of target_ids.
+
+        :returns list: records of 11 fields each, or None if the
+        document cannot be scored.  With keep_scores, returns a tuple
+        (records, scores), where scores lists every target with a
+        confidence above zero, in the format of ScoreWriter.write.
+        '''
+        ## instantiate an instance of Scorer from toy_kba_algorithm
+        scorer = toy_kba_algorithm.Scorer(si)
+
+        return self.score_document(si.stream_id, scorer, target_ids, date_hour)
+
+    def score_document(self, stream_id, scorer, target_ids, date_hour=''):
+        '''
+        Scores the document with stream_id that scorer was built from
+        against each of target_ids, see score_stream_item
+        '''
+        return self.score_documents([(stream_id, scorer, None)], target_ids, date_hour)[0]
+
+    def score_documents(self, documents, target_ids, date_hour=''):
+        '''
+        Scores a block of documents, a list of (stream_id, scorer,
+        key) tuples, against each of target_ids at once with
+        EntityMatcher.batch_scores.  If key is not None, it identifies
+        the document's clean_visible in self.memo, and a document that
+        is found there is not scanned again.
+
+        :returns list: the output of score_stream_item for each
+        document
+        '''
+        count_not_ready(self.stats, documents)
+        entries = self.observe_documents(documents)
+
+        start = self.stats.start('assess')
+        results = self.document_results(documents, entries, target_ids, date_hour)
+        ## includes fill_slots, which is also timed on its own
+        self.stats.stop('assess', start, len(documents) * len(target_ids))
+        return results
+
+    def observe_documents(self, documents):
+        '''
+        Finds the name parts of every target in a block of documents,
+        as for score_documents, scanning only the documents that are
+        not in self.memo, and the first of any with the same key.
+
+        :returns list: the memo entry of each document, see
+        document_result, or None if its scorer is not ready
+        '''
+        stats = self.stats
+        entries = [None] * len(documents)
+        scan = []
+        first_scanned = {}
+        for doc_num, (stream_id, scorer, key) in enumerate(documents):
+            if not scorer.ready:
+                continue
+            if key is not None:
+                entries[doc_num] = self.memo.get(key)
+                if entries[doc_num] is not None or key in first_scanned:
+                    continue
+                first_scanned[key] = doc_num
+            scan.append(doc_num)
+
+        if scan:
+            ## find name parts of all targets in one pass over each text
+            start = stats.start('scan')
+            pattern_counts = [self.matcher.count_patterns(documents[doc_num][1].text)
+                              for doc_num in scan]
+            stats.stop('scan', start, len(scan))
+
+            ## part of assessing the documents, which score_documents
+            ## counts
+            start = stats.start('assess')
+            batch = self.matcher.batch_scores(pattern_counts)
+            for row, doc_num in enumerate(scan):
+                entries[doc_num] = (batch.observed_names(row), {})
+                key = documents[doc_num][2]
+                if key is not None:
+                    self.memo.put(key, entries[doc_num])
+            stats.stop('assess', start, 0)
+
+        ## duplicates within the block share the entry of the first
+        for doc_num, (stream_id, scorer, key) in enumerate(documents):
+            if scorer.ready and entries[doc_num] is None:
+                entries[doc_num] = entries[first_scanned[key]]
+        return entries
+
+    def document_results(self, documents, entries, target_ids, date_hour=''):
+        '''
+        :returns list: the output of score_stream_item for each of
+        documents, from its entry of observe_documents
+        '''
+        results = [None] * len(documents)
+        for doc_num, (stream_id, scorer, key) in enumerate(documents):
+            if entries[doc_num] is None:
+                continue
+            results[doc_num] = self.document_result(
+                stream_id, scorer, entries[doc_num], target_ids, date_hour)
+        return results
+
+    def memo_result(self, stream_id, key, target_ids, date_hour=''):
+        '''
+        Looks up a document in self.memo by key, a hash of its
+        clean_visible; documents with the same clean_visible have the
+        same text, sentences and scores.  Hits and misses are counted
+        by the caller, which knows whether the result was usable.
+
+        :returns: the output of score_stream_item for the document,
+        or None if it must be scored, because it is not in the memo
+        or its slots have not been filled for all of target_ids
+        '''
+        entry = self.memo.get(key)
+        if entry is None:
+            return None
+        return self.entry_result(stream_id, entry, target_ids, date_hour)
+
+    def entry_result(self, stream_id, entry, target_ids, date_hour=''):
+        '''
+        :returns: the output of score_stream_item for a document from
+        its memo entry, or None if slots must be filled
+        '''
+        start = self.stats.start('assess')
+        result = self.document_result(stream_id, None, entry, target_ids, date_hour)
+        self.stats.stop('assess', start, len(target_ids))
+        return result
+
+    def columns(self, target_ids):
+        '''
+        :returns array: the column of each of target_ids in BatchScores
+        '''
+        ## the same list is usually passed for every document of a chunk
+        if self._columns[0] is not target_ids:
+            self._columns = target_ids, numpy.array(
+                [self.matcher.target_nums[target_id] for target_id in target_ids],
+                numpy.int64)
+        return self._columns[1]
+
+    def document_result(self, stream_id, scorer, entry, target_ids, date_hour=''):
+        '''
+        Assembles the output of score_stream_item for a document from
+        entry, an (observed, slot_rows) pair, where observed is the
+        document's toy_kba_algorithm.ObservedNames, and slot_rows maps
+        each target_id to the output of fill_slots for it.  Missing
+        slot rows are filled from scorer, and added to slot_rows.
+
+        :returns: the output of score_stream_item, or None if scorer
+        is None and slot rows are missing
+        '''
+        observed, target_slot_rows = entry
+        scores = observed.scores(self.matcher, self.conf_heuristic, self.cutoff)
+        columns = self.columns(target_ids)
+        confidence_row = scores.confidence[0, columns]
+        selected = scores.selected[0, columns]
+        wanted = selected
+        if self.keep_scores:
+            wanted = wanted | (confidence_row > 0)
+
+        dropped = len(target_ids) - int(selected.sum())
+        if dropped:
+            logger.info('dropping %d lines for low conf' % dropped)
+
+        recs = []
+        kept_scores = []
+        for col in numpy.flatnonzero(wanted).tolist():
+            target_id = target_ids[col]
+            target_num = columns[col]
+            confidence = int(confidence_row[col])
+            relevance = int(scores.relevance[0, target_num])
+            contains_mention = int(scores.contains_mention[0, target_num])
+
+            ## on "vital" ranked docs, attempt Streaming Slot Filling
+            ## (SSF) for the run or the score store
+            slot_rows = None
+            if relevance == 2 and (self.ssf and confidence > self.cutoff or
+                                   self.keep_scores and confidence > 0):
+                slot_rows = target_slot_rows.get(target_id)
+                if slot_rows is None:
+                    if scorer is None:
+                        return None
+                    slot_rows = target_slot_rows[target_id] = self.fill_slots(
+                        scorer, self.entity_representations[target_id],
+                        scores.observed(0, target_num)[0])
+
+            if self.keep_scores and confidence > 0:
+                kept_scores.append((stream_id, target_id, confidence, relevance,
+                                    contains_mention, date_hour, slot_rows or []))
+
+            if not confidence > self.cutoff:
+                continue
+
+            recs.extend(self.records(stream_id, target_id, confidence,
+                                     relevance, contains_mention, date_hour,
+                                     slot_rows))
+
+        if self.keep_scores:
+            return recs, kept_scores
+        return recs
+
+    def records(self, stream_id, target_id, confidence, relevance,
+                contains_mention, date_hour, slot_rows=None):
+        '''
+        :returns list: the records of one (document, target) pair
+        with a confidence above the cutoff, where slot_rows are the
+        slot fills of a vital one for SSF
+        '''
+        ## assemble line in the format specified on
+        ## http://trec-kba.org/trec-kba-2013.shtml#submissions
+        ccr_rec = [
+            ## sytem identifier
+            self.filter_run["team_id"], self.filter_run["system_id"],
+
+            ## this task identifier
+            stream_id, target_id,
+
+            ## algorithm output:
+            confidence, relevance, contains_mention,
+
+            ## identify the directory containing this chunk file
+            date_hour,
+
+            ## default values for SSF run
+            "NULL", -1, "0-0",
+            ]
+
+        if not self.ssf:
+            ## use only the CCR record
+            return [ccr_rec]
+
+        ## instead of the CCR record, generate SSF records
+        recs = []
+        for row in slot_rows or []:
+
+            ## these fields differ from the base CCR record:
+            ssf_conf, slot_name, slot_equiv_id, byte_range = row
+
+            ## copy CCR record and insert SSF-specific fields;
+            ## all of its fields are immutable, so a shallow
+            ## copy is enough
+            ssf_rec = list(ccr_rec)
+            ssf_rec[4]  = ssf_conf
+            ssf_rec[8]  = slot_name
+            ssf_rec[9]  = slot_equiv_id
+            ssf_rec[10] = byte_range
+
+            recs.append(ssf_rec)
+
+        return recs
+
+    def fill_slots(self, scorer, entity_repr, name):
+        start = self.stats.start('fill_slots')
+        ## name is the longest name observed, which Scorer.fill_slots
+        ## looks for in the sentences
+        rows = list(scorer.fill_slots(entity_repr, name, self.exact_slot_ranges))
+        self.stats.stop('fill_slots', start)
+        return rows
+
+class SweepScorer(object):
+    '''
+    Scores each document under several configurations, with a
+    RunScorer for each, so that the chunks are read and their
+    documents normalized once for all of them.  configs lists
+    (entity_representations, filter_run, conf_heuristic, cutoff, ssf)
+    for each configuration, and the other arguments are shared, as in
+    RunScorer.  The configurations with the same
+    entity_representations, e.g. of the same mode, are a group that
+    shares one EntityMatcher and memo, so each document is scanned and
+    its slots filled once for the whole group.
+
+    The output of score_chunk with a SweepScorer is a list of the
+    outputs of the RunScorers for each document, or None if the
+    document cannot be scored.
+    '''
+    def __init__(self, configs, text_cache=None, exact_slot_ranges=False,
+                 prefilter=True, remote=None, max_item_bytes=None,
+                 oversize='skip', score_memo=0, token_index=None):
+        ## documents are prefiltered once for all of the RunScorers,
+        ## and scanned by the first RunScorer of each group, which
+        ## holds the group's memo
+        self.run_scorers = []
+        ## (first config number, config numbers) of each group
+        self.groups = []
+        groups = {}
+        for config_num, (entity_representations, filter_run, conf_heuristic,
+                         cutoff, ssf) in enumerate(configs):
+            group = groups.get(id(entity_representations))
+            if group is None:
+                group = groups[id(entity_representations)] = (config_num, [])
+                self.groups.append(group)
+                matcher = None
+                memo_size = score_memo
+            else:
+                matcher = self.run_scorers[group[0]].matcher
+                memo_size = 0
+            group[1].append(config_num)
+            self.run_scorers.append(RunScorer(
+                    entity_representations, filter_run, conf_heuristic,
+                    cutoff, ssf, text_cache, exact_slot_ranges, False,
+                    False, remote, max_item_bytes, oversize, memo_size,
+                    matcher=matcher))
+        self.text_cache = text_cache
+        self.exact_slot_ranges = exact_slot_ranges
+        self.remote = remote
+        self.max_item_bytes = max_item_bytes
+        self.oversize = oversize
+        ## the first RunScorer of each group has a memo, or none does
+        self.memo = self.run_scorers[0].memo
+
+        ## a document is skipped only if no configuration has a name
+        ## part in it, which is what the prefilter and token_index
+        ## find with the name parts of all of them
+        self.prefilter = None
+        self.token_index = None
+        if min(config[3] for config in configs) >= 0 and text_cache is None:
+            if prefilter:
+                self.prefilter = toy_kba_algorithm.NamePrefilter(
+                    sweep_representations(configs))
+            self.token_index = token_index
+
+        self.scratch = ScratchScorers()
+        self.stats = toy_kba_stats.RunStats()
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        ## replaced by score_chunks, as for a RunScorer
+        self._stats = stats
+        for run_scorer in self.run_scorers:
+            run_scorer.stats = stats
+
+    def score_documents(self, documents, target_ids, date_hour=''):
+        '''
+        :returns list: the output of RunScorer.score_documents for
+        each document, under every configuration
+        '''
+        stats = self.stats
+        count_not_ready(stats, documents)
+        config_results = [None] * len(self.run_scorers)
+        for lead, config_nums in self.groups:
+            entries = self.run_scorers[lead].observe_documents(documents)
+            for config_num in config_nums:
+                start = stats.start('assess')
+                config_results[config_num] = self.run_scorers[config_num].document_results(
+                    documents, entries, target_ids, date_hour)
+                stats.stop('assess', start, len(documents) * len(target_ids))
+
+        results = zip(*config_results)
+        ## a document that cannot be scored fails in every configuration
+        return [result[0] is not None and list(result) or None
+                for result in results]
+
+    def memo_result(self, stream_id, key, target_ids, date_hour=''):
+        '''
+        :returns list: the output of RunScorer.memo_result under every
+        configuration, or None if any of them must score the document
+        '''
+        results = [None] * len(self.run_scorers)
+        for lead, config_nums in self.groups:
+            entry = self.run_scorers[lead].memo.get(key)
+            if entry is None:
+                return None
+            for config_num in config_nums:
+                results[config_num] = self.run_scorers[config_num].entry_result(
+                    stream_id, entry, target_ids, date_hour)
+                if results[config_num] is None:
+                    return None
+        return results
+
+    def empty_result(self):
+        return [run_scorer.empty_result() for run_scorer in self.run_scorers]
+
+def count_not_ready(stats, documents):
+    '''
+    counts the documents of a block, as for RunScorer.score_documents,
+    whose scorers are not ready, which get no records
+    '''
+    for stream_id, scorer, key in documents:
+        if not scorer.ready:
+            logger.critical('failed because scorer is not ready')
+            stats.incr('docs_not_ready')
+
+def sweep_representations(configs):
+    '''
+    :returns dict: the entity representations of all of configs, see
+    SweepScorer, keyed by (config number, target_id), e.g. for a
+    NamePrefilter or TokenIndex that finds the name parts of all of
+    them
+    '''
+    representations = {}
+    for config_num, config in enumerate(configs):
+        for target_id, entity_repr in config[0].iteritems():
+            representations[config_num, target_id] = entity_repr
+    return representations
+
+def index_plan(run_scorer, chunk_path):
+    '''
+    :returns list: the output of TokenIndex.plan for chunk_path, or
+    None if run_scorer has no token_index or it cannot be used for
+    chunk_path
+    '''
+    if run_scorer.token_index is None:
+        return None
+    size = None
+    if run_scorer.remote is None:
+        ## a local chunk must be the one that was indexed
+        if not os.path.exists(chunk_path):
+            return None
+        size = os.path.getsize(chunk_path)
+    return run_scorer.token_index.plan(chunk_path, size)
+
+def score_blocks(run_scorer, documents, target_ids, date_hour=''):
+    '''
+    Scores documents in blocks of up to BATCH_DOCS with
+    RunScorer.score_documents.  documents is an iterable of
+    (stream_id, scorer, key, seconds, result) tuples, where key is
+    for RunScorer.memo, seconds is the time already spent on the
+    document, and result is the output for a document that needs no
+    scoring, e.g. one rejected by the prefilter, in which case scorer
+    is None.
+
+    :returns generator: the output of RunScorer.score_stream_item
+    for each document, in order
+    '''
+    block = []
+    num_scored = 0
+    for doc in documents:
+        block.append(doc)
+        if doc[1] is not None:
+            num_scored += 1
+        if num_scored < BATCH_DOCS:
+            continue
+        ## the scorers of a full block are reset for the next one
+        ## once it is scored, see ScratchScorers
+        for result in _score_block(run_scorer, block, num_scored, target_ids, date_hour):
+            yield result
+        block = []
+        num_scored = 0
+
+    for result in _score_block(run_scorer, block, num_scored, target_ids, date_hour):
+        yield result
+
+def _score_block(run_scorer, block, num_scored, target_ids, date_hour):
+    stats = run_scorer.stats
+    start = time.time()
+    results = iter(run_scorer.score_documents(
+            [(stream_id, scorer, key) for stream_id, scorer, key, _, _ in block
+             if scorer is not None], target_ids, date_hour))
+    ## each scored document takes an even share of the block
+    share = (time.time() - start) / max(1, num_scored)
+
+    for stream_id, scorer, key, seconds, result in block:
+        if scorer is not None:
+            result = results.next()
+            seconds += share
+        stats.observe('document', seconds)
+        yield result
+
+def score_chunk(run_scorer, chunk_path, target_ids, date_hour='', data=None):
+    '''
+    Scores every StreamItem in chunk_path against target_ids.  If
+    data is provided, it is the already decrypted and decompressed
+    content of chunk_path, see toy_kba_corpus.load_chunk_data.  If
+    run_scorer has a text_cache that holds chunk_path, the chunk is
+    not read at all.  If run_scorer has a token_index, only the
+    documents that it does not rule out are read.
+
+    :returns generator: the output of RunScorer.score_stream_item
+    for each document with clean_visible text, in chunk order, or no
+    records for documents rejected by run_scorer.prefilter
+    '''
+    stats = run_scorer.stats
+    stats.incr('chunks')
+    chunk_start = time.time()
+
+    text_cache = run_scorer.text_cache
+    ## the cache does not hold the clean_visible that exact slot
+    ## ranges are mapped back to
+    if text_cache is not None and not run_scorer.exact_slot_ranges:
+        cached = text_cache.get(chunk_path)
+        if cached is not None:
+            stats.incr('text_cache_hits')
+            documents = cached_documents(run_scorer, cached)
+            for result in score_blocks(run_scorer, documents, target_ids, date_hour):
+                yield result
+
+            stats.observe('chunk', time.time() - chunk_start)
+            return
+
+        stats.incr('text_cache_misses')
+
+    plan = index_plan(run_scorer, chunk_path)
+    if plan is not None and not any(candidate for _, _, candidate in plan):
+        ## no document of the chunk can contain a name part
+        stats.incr('chunks_skipped_by_index')
+        for result in score_blocks(run_scorer, indexed_documents(run_scorer, plan, []),
+                                   target_ids, date_hour):
+            yield result
+
+        stats.observe('chunk', time.time() - chunk_start)
+        return
+
+    ## a remote chunk is read from its copy in the local cache
+    local_path = chunk_path
+    if data is None and run_scorer.remote is not None:
+        local_path = run_scorer.remote.fetch(chunk_path, stats)
+
+    if data is None and (local_path is None or not os.path.exists(local_path)):
+        logger.critical('failed to find %s' % chunk_path)
+        stats.incr('chunks_missing')
+        return
+
+    ## without data, reading from the chunk also waits for gpg and
+    ## xz, which are only timed separately as 'load' with --prefetch
+    offsets = None
+    if plan is not None:
+        offsets = [offset for _, offset, candidate in plan if candidate]
+    chunk = toy_kba_reader.read_chunk(
+        local_path, data, run_scorer.max_item_bytes, run_scorer.oversize, stats,
+        offsets)
+
+    ## normalized text of each document to store in text_cache
+    docs = []
+    documents = chunk_documents(run_scorer, chunk, target_ids, date_hour, docs)
+    if plan is not None:
+        documents = indexed_documents(run_scorer, plan, documents)
+    for result in score_blocks(run_scorer, documents, target_ids, date_hour):
+        yield result
+
+    stats.observe('chunk', time.time() - chunk_start)
+
+    ## only reached if the caller consumed the whole chunk
+    if text_cache is not None:
+        text_cache.put(chunk_path, docs)
+
+def cached_documents(run_scorer, cached):
+    '''
+    :returns generator: the documents of a chunk from a text_cache,
+    for score_blocks
+    '''
+    stats = run_scorer.stats
+    for stream_id, normalized in stats.timed_iter('text_cache', cached):
+        stats.incr('docs')
+        if normalized is None:
+            logger.critical('failed because scorer is not ready')
+            stats.incr('docs_not_ready')
+            yield stream_id, None, None, 0, None
+            continue
+
+        doc_start = time.time()
+        scorer = run_scorer.scratch.get(None, normalized)
+        yield stream_id, scorer, None, time.time() - doc_start, None
+
+def chunk_documents(run_scorer, chunk, target_ids, date_hour, docs):
+    '''
+    :returns generator: the documents of the StreamItems in chunk,
+    for score_blocks.  Documents found in run_scorer.memo are already
+    scored.  If run_scorer has a text_cache, the normalized text of
+    each one is appended to docs.
+    '''
+    stats = run_scorer.stats
+    for si in stats.timed_iter('deserialize', chunk):
+        if not si.body.clean_visible:
+            ## This sytem only considers docs that have
+            ## clean_visible text
+            logger.critical('giving up for lack of clean_visible')
+            stats.incr('docs_without_clean_visible')
+            continue
+
+        stats.incr('docs')
+        doc_start = time.time()
+
+        if run_scorer.prefilter is not None:
+            start = stats.start('prefilter')
+            candidate = run_scorer.prefilter.candidate(si.body.clean_visible)
+            stats.stop('prefilter', start)
+            if not candidate:
+                ## no target has a name part in this doc
+                stats.incr('docs_prefiltered')
+                yield si.stream_id, None, None, time.time() - doc_start, \
+                    run_scorer.empty_result()
+                continue
+
+        key = None
+        if run_scorer.memo is not None:
+            ## a duplicate of a recent document costs a hash and a
+            ## lookup, without normalizing it
+            key = hashlib.md5(si.body.clean_visible).digest()
+            result = run_scorer.memo_result(si.stream_id, key, target_ids, date_hour)
+            if result is not None:
+                stats.incr('score_memo_hits')
+                yield si.stream_id, None, None, time.time() - doc_start, result
+                continue
+            stats.incr('score_memo_misses')
+
+        ## reset a Scorer from toy_kba_algorithm for this document
+        start = stats.start('normalize')
+        scorer = run_scorer.scratch.get(si)
+        stats.stop('normalize', start)
+
+        if run_scorer.text_cache is not None:
+            if scorer.ready:
+                docs.append((si.stream_id, (scorer.text, scorer.sentences)))
+            else:
+                docs.append((si.stream_id, None))
+
+        yield si.stream_id, scorer, key, time.time() - doc_start, None
+
+def indexed_documents(run_scorer, plan, documents):
+    '''
+    :returns generator: the documents of a chunk for score_blocks, in
+    chunk order, from plan, the output of TokenIndex.plan, and
+    documents, the output of chunk_documents for the candidates of
+    plan.  The other documents of plan get no records, as if rejected
+    by the prefilter.
+    '''
+    stats = run_scorer.stats
+    documents = iter(documents)
+    doc = next(documents, None)
+    for stream_id, offset, candidate in plan:
+        if candidate:
+            ## a candidate that chunk_documents skips, e.g. one larger
+            ## than max_item_bytes, is not in documents
+            if doc is not None and doc[0] == stream_id:
+                yield doc
+                doc = next(documents, None)
+            continue
+
+        stats.incr('docs')
+        stats.incr('docs_skipped_by_index')
+        yield stream_id, None, None, 0, run_scorer.empty_result()
+
+    while doc is not None:
+        yield doc
+        doc = next(documents, None)
+
+## each worker process builds its own RunScorer or SweepScorer once at
+## startup
+_worker_scorer = None
+
+def _init_worker(scorer_class, *run_scorer_args):
+    global _worker_scorer
+    ## workers are stopped by the main process, not by the signals
+    ## that it handles, e.g. in toy_kba_system.py --watch
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _worker_scorer = scorer_class(*run_scorer_args)
+
+def _score_chunk_in_worker(task):
+    ## send back the stats of just this chunk
+    _worker_scorer.stats = toy_kba_stats.RunStats()
+    results = list(score_chunk(_worker_scorer, *task))
+    return task, results, _worker_scorer.stats.to_dict()
+
+def score_chunks(tasks, run_scorer_args, workers=1, prefetch=0, stats=None,
+                 stop=None, scorer_class=RunScorer):
+    '''
+    Scores the chunks described by tasks, which is an iterable of
+    (chunk_path, target_ids, date_hour) tuples.  With more than one
+    worker, the chunks are scored in a pool of processes, each holding
+    its own scorer_class(*run_scorer_args), a RunScorer or a
+    SweepScorer.  In a single process,
+    prefetch is the number of upcoming chunks to load in background
+    threads while the current one is scored.
+
+    Timings and counters from all processes are accumulated in stats,
+    a toy_kba_stats.RunStats, if it is provided.
+
+    If tasks waits on stop, a threading.Event, for more tasks, as
+    toy_kba_corpus.watch_date_hour_chunks does, stop is set when the
+    caller stops early, so that the pool can shut down.
+
+    :returns generator: a (task, results) pair per task, where
+    results iterates over the output of score_chunk, always in the
+    order of tasks, so that the run file does not depend on how many
+    workers were used
+    '''
+    if stats is None:
+        stats = toy_kba_stats.RunStats()
+
+    if workers <= 1:
+        run_scorer = scorer_class(*run_scorer_args)
+        run_scorer.stats = stats
+        if prefetch > 0:
+            ## no need to load chunks that are in the text_cache, or
+            ## that the token_index rules out whole
+            skip = None
+            if run_scorer.text_cache is not None:
+                skip = run_scorer.text_cache.has
+            elif run_scorer.token_index is not None:
+                def skip(chunk_path):
+                    plan = index_plan(run_scorer, chunk_path)
+                    return plan is not None and \
+                        not any(candidate for _, _, candidate in plan)
+            for task, data in toy_kba_corpus.prefetch_chunks(
+                    tasks, prefetch, skip, stats, run_scorer.remote):
+                ## if data is None, score_chunk reads chunk_path itself
+                yield task, score_chunk(run_scorer, *task, data=data)
+        else:
+            for task in tasks:
+                yield task, score_chunk(run_scorer, *task)
+        return
+
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (scorer_class,) + tuple(run_scorer_args))
+    try:
+        pool_results = pool.imap(_score_chunk_in_worker, tasks)
+        while True:
+            try:
+                ## a blocking wait cannot be interrupted by signals in
+                ## python 2, so poll instead
+                task, results, worker_stats = pool_results.next(timeout=1)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            stats.merge(worker_stats)
+            yield task, results
+        pool.close()
+    finally:
+        ## the caller may stop early, e.g. at --max docs, and the pool
+        ## waits for tasks to end
+        if stop is not None:
+            stop.set()
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+"""
+Reads the profiles of targets from a profiles file, either all of
+them or only those of selected targets.  Selected targets are read
+from a JSON file one at a time, so that a run over a few targets does
+not hold the whole file in memory.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import json
+import logging
+
+logger = logging.getLogger('kba-toy-system')
+
+class JSONStream(object):
+    '''
+    Reads JSON values one at a time from a file, so that the members
+    of a large object can be decoded and dropped one by one.  Only as
+    much of the file as the current value needs is held in memory.
+    '''
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, fh, block_size=2**20):
+        self.fh = fh
+        self.block_size = block_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size):
+        data = self.fh.read(size)
+        if not data:
+            self.eof = True
+        ## drop what has already been consumed
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        '''
+        :returns str: next char that is not white space, without
+        consuming it, or '' at the end of the file
+        '''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill(self.block_size)
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('expected %r at %r' % (char, self.buf[self.pos:self.pos + 40]))
+        self.pos += 1
+
+    def value(self):
+        '''
+        :returns: the next complete JSON value
+        '''
+        self.peek()
+        size = self.block_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                ## a number at the end of the buffer might continue
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            ## read twice as much each time, so that a large value is
+            ## decoded a logarithmic number of times
+            self._fill(size)
+            size *= 2
+
+    def members(self):
+        '''
+        :returns generator: (key, value) for each member of the object
+        that starts at the current position
+        '''
+        self.expect('{')
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+            yield key, self
+            if self.peek() == ',':
+                self.pos += 1
+        self.expect('}')
+
+def iter_profile_entities(path, target_ids):
+    '''
+    Reads a JSON profiles file one entity at a time.
+
+    :returns generator: (target_id, profile) for each of target_ids
+    in the "entities" of the profiles file.  Stops reading once all of
+    them are found.
+    '''
+    wanted = set(target_ids)
+    stream = JSONStream(open(path, 'rb'))
+    for key, value_stream in stream.members():
+        if key != 'entities':
+            value_stream.value()
+            continue
+
+        for target_id, profile_stream in value_stream.members():
+            ## every profile is decoded, but only wanted ones are kept
+            profile = profile_stream.value()
+            if target_id in wanted:
+                yield target_id, profile
+                wanted.discard(target_id)
+                if not wanted:
+                    return
+
+def load_profiles(path, target_ids=None):
+    '''
+    Loads a .json or .yaml profiles file.  If target_ids is provided,
+    the result only holds the profiles of those targets, and a JSON
+    file is read incrementally, see iter_profile_entities.
+
+    :returns dict: in the same format as the profiles file
+    '''
+    if target_ids is not None and path.endswith('.json'):
+        return {'entities': dict(iter_profile_entities(path, target_ids))}
+
+    if path.endswith('.json'):
+        profiles = json.load(open(path))
+    elif path.endswith('.yaml'):
+        ## only imported for YAML profiles, since importing yaml takes
+        ## tens of megabytes that every run would otherwise hold
+        import yaml
+        profiles = yaml.load(open(path))
+    else:
+        raise ValueError('profiles must be .json or .yaml: %r' % path)
+
+    if target_ids is not None:
+        ## YAML is not read incrementally, but only the selected
+        ## targets are kept
+        profiles['entities'] = dict(
+            (target_id, profiles['entities'][target_id])
+            for target_id in target_ids if target_id in profiles['entities'])
+
+    return profiles
@@ -0,0 +1,519 @@
+#!/usr/bin/python
+"""
+Reads the StreamItems of a chunk file one at a time, as gpg and xz
+decrypt and decompress it, so that memory holds one item at a time
+instead of the whole chunk.
+
+Items are decoded by thrift's fastbinary straight from the pipe.  With
+a ceiling of max_item_bytes, an item whose thrift encoding is larger
+is never decoded in full; under the 'skip' policy it is passed over,
+and under the 'truncate' policy only the fields that the Scorer reads
+are kept, see ChunkReader.read_truncated.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import struct
+import logging
+from cStringIO import StringIO
+
+import streamcorpus
+from thrift.Thrift import TType
+from thrift.transport import TTransport
+from thrift.protocol.TBinaryProtocol import TBinaryProtocolAccelerated
+from thrift.protocol import fastbinary
+
+import toy_kba_corpus
+
+logger = logging.getLogger('kba-toy-system')
+
+## what to do with an item larger than max_item_bytes
+OVERSIZE_POLICIES = ['skip', 'truncate']
+
+## encoded sizes of the thrift types that have a fixed size
+FIXED_SIZES = {TType.BOOL: 1, TType.BYTE: 1, TType.I16: 2, TType.I32: 4,
+               TType.I64: 8, TType.DOUBLE: 8}
+
+FIELD_HEADER = struct.Struct('!bh')
+I16 = struct.Struct('!h')
+I32 = struct.Struct('!i')
+
+def field_ids(thrift_class):
+    '''
+    :returns dict: name --> field id of each field of thrift_class
+    '''
+    return dict((spec[2], spec[0]) for spec in thrift_class.thrift_spec if spec)
+
+## fields kept by the 'truncate' policy: the small fields that
+## identify the item, and the parts of its body that the Scorer reads
+STREAM_ITEM_FIELDS = field_ids(streamcorpus.StreamItem)
+CONTENT_ITEM_FIELDS = field_ids(streamcorpus.ContentItem)
+TRUNCATED_ITEM_FIELDS = set(STREAM_ITEM_FIELDS[name] for name in
+                            ['version', 'doc_id', 'abs_url', 'source',
+                             'stream_id', 'stream_time'])
+## room left for those fields, most of which come after the body
+TRUNCATED_RESERVE = 4096
+
+class SkippedStruct(object):
+    '''
+    A struct without fields, which fastbinary decodes any struct into
+    by skipping all of its fields in C
+    '''
+    thrift_spec = ()
+SKIPPED_STRUCT_ARGS = (SkippedStruct, SkippedStruct.thrift_spec)
+
+class ItemTooLarge(Exception):
+    pass
+
+## streamcorpus.Chunk raises VersionMismatchError, which the 0.2.x
+## streamcorpus that reads the v0_2_0 corpus does not have
+VersionMismatchError = getattr(streamcorpus, 'VersionMismatchError', ValueError)
+
+class ChunkReader(TTransport.TTransportBase, TTransport.CReadableTransport):
+    '''
+    Thrift transport over the file of thrift bytes of a chunk, which
+    fastbinary reads through cstringio_buf and cstringio_refill like
+    TTransport.TBufferedTransport.  While fastbinary decodes an item
+    under a limit, the bytes read since the start of the item are
+    kept, so that an item that turns out to be larger than
+    max_item_bytes can be read again by the skipping and truncating
+    scanners below, without ever holding more than about
+    max_item_bytes of it.  The scanners then hold one block at a time.
+    If fh is seekable, skip_to seeks in it instead of reading past the
+    bytes that it skips.
+    '''
+    def __init__(self, fh, max_item_bytes=None, block_size=2**16,
+                 seekable=False):
+        self.fh = fh
+        self.max_item_bytes = max_item_bytes
+        self.block_size = block_size
+        self.seekable = seekable
+        ## current block of the file, and its offset in the file
+        self.data = ''
+        self.base = 0
+        self.buf = StringIO(self.data)
+        ## offset of the current item, and the blocks read since it
+        ## started, the first of which starts at kept_base
+        self.item_start = 0
+        self.kept = []
+        self.kept_base = 0
+        ## only enforced while fastbinary decodes an item
+        self.limit = None
+        ## bytes read by the scanners, when capturing: the pieces of
+        ## the blocks before the current one, and the offset in the
+        ## file where the uncaptured bytes of the current block start
+        self.capture = None
+        self.capture_size = 0
+        self.capture_limit = 0
+        self.capture_mark = 0
+
+    @property
+    def cstringio_buf(self):
+        return self.buf
+
+    def cstringio_refill(self, partialread, reqlen):
+        ## partialread is the rest of the current block
+        offset = self.base + len(self.data) - len(partialread)
+        if self.limit is not None and offset + reqlen - self.item_start > self.limit:
+            raise ItemTooLarge()
+
+        size = self.block_size
+        if self.limit is not None:
+            ## read no further than the limit allows
+            room = self.item_start + self.limit - offset - len(partialread)
+            size = max(1, min(size, room))
+        block = self.fh.read(max(size, reqlen - len(partialread)))
+        data = partialread + block
+        if len(data) < reqlen:
+            raise EOFError()
+
+        if self.capture is not None:
+            self._captured(offset)
+            self.capture_mark = offset
+        if self.limit is not None:
+            self.kept.append(block)
+        self.data = data
+        self.base = offset
+        self.buf = StringIO(data)
+        return self.buf
+
+    def read(self, sz):
+        data = self.buf.read(sz)
+        if len(data) < sz:
+            data = self.cstringio_refill(data, sz).read(sz)
+        return data
+
+    def discard(self, size):
+        '''
+        Skips size bytes without holding more than a block of them,
+        unless they are being captured.
+        '''
+        remaining = len(self.data) - self.buf.tell()
+        if size <= remaining:
+            self.buf.seek(size, os.SEEK_CUR)
+            return
+
+        if self.capture is not None:
+            pending = self.base + self.buf.tell() - self.capture_mark
+            if self.capture_size + pending + size <= self.capture_limit:
+                self.read(size)
+                return
+            ## too large to capture
+            self.capture = None
+
+        size -= remaining
+        offset = self.base + len(self.data)
+        while True:
+            block = self.fh.read(self.block_size)
+            if not block:
+                raise EOFError()
+            if len(block) > size:
+                break
+            size -= len(block)
+            offset += len(block)
+
+        self.data = block
+        self.base = offset
+        self.buf = StringIO(block)
+        self.buf.seek(size)
+
+    def skip_to(self, offset):
+        '''
+        Moves forward to offset in the file, e.g. to the start of an
+        item found in a toy_kba_index.TokenIndex
+        '''
+        pos = self.base + self.buf.tell()
+        if offset < pos:
+            raise ValueError('cannot go back from %d to %d' % (pos, offset))
+        if not self.seekable or offset <= self.base + len(self.data):
+            self.discard(offset - pos)
+            return
+        self.fh.seek(offset)
+        self.data = ''
+        self.base = offset
+        self.buf = StringIO(self.data)
+
+    def _captured(self, end):
+        '''
+        captures the bytes of the current block up to offset end
+        '''
+        data = self.data[self.capture_mark - self.base:end - self.base]
+        self.capture_size += len(data)
+        if self.capture_size > self.capture_limit:
+            ## stop capturing, but keep scanning
+            self.capture = None
+        else:
+            self.capture.append(data)
+
+    def at_end(self):
+        '''
+        :returns bool: whether there are no more bytes in the file
+        '''
+        if self.buf.tell() < len(self.data):
+            return False
+        block = self.fh.read(self.block_size)
+        self.base += len(self.data)
+        self.data = block
+        self.buf = StringIO(block)
+        return not block
+
+    def start_item(self):
+        self.item_start = self.base + self.buf.tell()
+        self.kept = [self.data]
+        self.kept_base = self.base
+
+    def item_size(self):
+        return self.base + self.buf.tell() - self.item_start
+
+    def restart_item(self):
+        '''
+        Goes back to the start of the current item, which is at most
+        about max_item_bytes before the bytes read so far
+        '''
+        data = ''.join(self.kept)[self.item_start - self.kept_base:]
+        ## the scanners only go forward from here
+        self.kept = []
+        self.kept_base = self.item_start
+        self.data = data
+        self.base = self.item_start
+        self.buf = StringIO(data)
+
+    def read_field_header(self):
+        '''
+        :returns tuple: (ftype, fid) of the next field of a struct, or
+        (TType.STOP, None) at its end
+        '''
+        ftype = ord(self.read(1))
+        if ftype == TType.STOP:
+            return ftype, None
+        return ftype, I16.unpack(self.read(2))[0]
+
+    def skip_value(self, ttype):
+        '''
+        reads past a value of ttype, without decoding it
+        '''
+        if ttype in FIXED_SIZES:
+            self.discard(FIXED_SIZES[ttype])
+        elif ttype == TType.STRING:
+            self.discard(I32.unpack(self.read(4))[0])
+        elif ttype == TType.STRUCT:
+            while True:
+                ftype, fid = self.read_field_header()
+                if ftype == TType.STOP:
+                    break
+                self.skip_value(ftype)
+        elif ttype == TType.MAP:
+            ktype, vtype, size = struct.unpack('!bbi', self.read(6))
+            for i in xrange(size):
+                self.skip_value(ktype)
+                self.skip_value(vtype)
+        elif ttype in (TType.SET, TType.LIST):
+            etype, size = struct.unpack('!bi', self.read(5))
+            if etype in FIXED_SIZES:
+                self.discard(size * FIXED_SIZES[etype])
+            elif etype == TType.STRUCT:
+                ## lists of small structs, like sentences and their
+                ## tokens, are skipped by fastbinary one element at a
+                ## time, instead of one field at a time in python
+                skipped = SkippedStruct()
+                for i in xrange(size):
+                    fastbinary.decode_binary(skipped, self, SKIPPED_STRUCT_ARGS)
+            else:
+                for i in xrange(size):
+                    self.skip_value(etype)
+        else:
+            raise ValueError('cannot skip thrift type %d' % ttype)
+
+    def copy_value(self, ttype, limit):
+        '''
+        Reads past a value of ttype, keeping its bytes if there are no
+        more than limit of them.
+
+        :returns str: the bytes of the value, or None if there are
+        more than limit
+        '''
+        self.capture = []
+        self.capture_size = 0
+        self.capture_limit = limit
+        self.capture_mark = self.base + self.buf.tell()
+        try:
+            self.skip_value(ttype)
+            if self.capture is not None:
+                self._captured(self.base + self.buf.tell())
+        finally:
+            capture, self.capture = self.capture, None
+        return capture is not None and ''.join(capture) or None
+
+    def read_truncated(self, max_item_bytes):
+        '''
+        Reads the current item from its start, keeping only the fields
+        in TRUNCATED_ITEM_FIELDS and the clean_visible and sentences of
+        its body, in at most max_item_bytes.  If the body does not fit
+        in max_item_bytes - TRUNCATED_RESERVE, the sentences are
+        dropped, and clean_visible is cut short at the last whole utf8
+        char that fits.
+
+        :returns str: thrift bytes of the truncated StreamItem
+        '''
+        parts = []
+        size = [0]
+        def add(data):
+            parts.append(data)
+            size[0] += len(data)
+
+        while True:
+            ftype, fid = self.read_field_header()
+            if ftype == TType.STOP:
+                break
+
+            if fid in TRUNCATED_ITEM_FIELDS:
+                value = self.copy_value(ftype, max_item_bytes - size[0])
+                if value is not None:
+                    add(FIELD_HEADER.pack(ftype, fid) + value)
+
+            elif fid == STREAM_ITEM_FIELDS['body'] and ftype == TType.STRUCT:
+                add(FIELD_HEADER.pack(ftype, fid))
+                body_limit = max_item_bytes - TRUNCATED_RESERVE
+                while True:
+                    ftype, fid = self.read_field_header()
+                    if ftype == TType.STOP:
+                        break
+                    if fid == CONTENT_ITEM_FIELDS['clean_visible'] and ftype == TType.STRING:
+                        length = I32.unpack(self.read(4))[0]
+                        keep = max(0, min(length, body_limit - size[0] - 7))
+                        clean_visible = self.read(keep)
+                        self.discard(length - keep)
+                        if keep < length:
+                            clean_visible = clean_visible[:utf8_prefix(clean_visible)]
+                        add(FIELD_HEADER.pack(ftype, fid) +
+                            I32.pack(len(clean_visible)) + clean_visible)
+                    elif fid == CONTENT_ITEM_FIELDS['sentences']:
+                        value = self.copy_value(ftype, body_limit - size[0])
+                        if value is not None:
+                            add(FIELD_HEADER.pack(ftype, fid) + value)
+                    else:
+                        self.skip_value(ftype)
+                add(chr(TType.STOP))
+
+            else:
+                self.skip_value(ftype)
+
+        add(chr(TType.STOP))
+        return ''.join(parts)
+
+def utf8_prefix(data):
+    '''
+    :returns int: length of the longest prefix of data that does not
+    end within a utf8 char
+    '''
+    start = len(data) - 1
+    while start > 0 and ord(data[start]) & 0xC0 == 0x80:
+        start -= 1
+    if start < 0:
+        return 0
+    lead = ord(data[start])
+    if lead < 0x80:
+        char_len = 1
+    elif lead < 0xE0:
+        char_len = 2
+    elif lead < 0xF0:
+        char_len = 3
+    else:
+        char_len = 4
+    if start + char_len > len(data):
+        return start
+    return len(data)
+
+def read_stream_items(fh, max_item_bytes=None, oversize='skip', stats=None,
+                      name='', offsets=None, seekable=False, positions=False):
+    '''
+    Decodes the StreamItems in fh, a file of thrift bytes, one at a
+    time.  Items whose thrift encoding is larger than max_item_bytes
+    are handled by the oversize policy, and counted in stats, a
+    toy_kba_stats.RunStats, if it is provided.
+
+    If offsets, an increasing list of the offsets of items in fh, is
+    provided, only those items are decoded, and the bytes between them
+    are skipped, by seeking if fh is seekable.
+
+    :returns generator: StreamItems, or with positions, (offset, size,
+    si) for each item, where si is None if the item was skipped
+    '''
+    if oversize not in OVERSIZE_POLICIES:
+        raise ValueError('unknown oversize policy %r' % oversize)
+
+    reader = ChunkReader(fh, max_item_bytes, seekable=seekable)
+    protocol = TBinaryProtocolAccelerated(reader)
+    version = streamcorpus.StreamItem().version
+    if offsets is not None:
+        offsets = iter(offsets)
+    while True:
+        if offsets is None:
+            if reader.at_end():
+                break
+        else:
+            offset = next(offsets, None)
+            if offset is None:
+                break
+            try:
+                reader.skip_to(offset)
+            except EOFError:
+                logger.critical('chunk ends before the item at %d: %s' % (offset, name))
+                if stats is not None:
+                    stats.incr('chunks_truncated')
+                break
+
+        reader.start_item()
+        si = streamcorpus.StreamItem()
+        ## the ceiling is checked as fastbinary reads more of the
+        ## file, and again once it has read the whole item
+        reader.limit = max_item_bytes
+        try:
+            si.read(protocol)
+            oversized = max_item_bytes is not None and \
+                reader.item_size() > max_item_bytes
+        except ItemTooLarge:
+            oversized = True
+        except EOFError:
+            logger.critical('chunk ends within an item after %d bytes: %s' % (
+                    reader.item_size(), name))
+            if stats is not None:
+                stats.incr('chunks_truncated')
+            break
+        finally:
+            reader.limit = None
+
+        if oversized:
+            reader.restart_item()
+            if oversize == 'skip':
+                reader.skip_value(TType.STRUCT)
+                logger.warn('skipped item of %d bytes in %s' % (reader.item_size(), name))
+                if stats is not None:
+                    stats.incr('items_skipped')
+                if positions:
+                    yield reader.item_start, reader.item_size(), None
+                continue
+
+            si = streamcorpus.StreamItem()
+            si.read(TBinaryProtocolAccelerated(TTransport.TMemoryBuffer(
+                        reader.read_truncated(max_item_bytes))))
+            logger.warn('truncated %s of %d bytes in %s' % (
+                    si.stream_id, reader.item_size(), name))
+            if stats is not None:
+                stats.incr('items_truncated')
+
+        ## as in streamcorpus.Chunk, a StreamItem without a default
+        ## version, as in streamcorpus 0.2.x, reads any version
+        if version is not None and si.version != version:
+            raise VersionMismatchError(
+                'read msg.version = %d != %d = message().version):' % (
+                    si.version, version))
+
+        if positions:
+            yield reader.item_start, reader.item_size(), si
+        else:
+            yield si
+
+def read_chunk(chunk_path, data=None, max_item_bytes=None, oversize='skip',
+               stats=None, offsets=None, positions=False):
+    '''
+    Reads the StreamItems of chunk_path, or of data, its decrypted and
+    decompressed content, see toy_kba_corpus.load_chunk_data, with
+    read_stream_items, which offsets and positions are passed on to.
+    Only the current item is held in memory, other than data.
+
+    :returns generator: StreamItems
+    '''
+    if data is not None:
+        for si in read_stream_items(StringIO(data), max_item_bytes,
+                                    oversize, stats, chunk_path, offsets,
+                                    True, positions):
+            yield si
+        return
+
+    pipe = toy_kba_corpus.ChunkPipe(chunk_path)
+    try:
+        ## a chunk that is neither encrypted nor compressed is read
+        ## straight from the file
+        for si in read_stream_items(pipe.stdout, max_item_bytes,
+                                    oversize, stats, chunk_path, offsets,
+                                    not pipe.commands, positions):
+            yield si
+    except:
+        ## including GeneratorExit, if the caller stops early
+        pipe.kill()
+        raise
+
+    if offsets is not None and pipe.commands:
+        ## the rest of the chunk is not needed
+        pipe.kill()
+        return
+
+    if not pipe.close(stats):
+        logger.critical('failed to decrypt or decompress %s' % chunk_path)
+        if stats is not None:
+            stats.incr('chunks_failed')
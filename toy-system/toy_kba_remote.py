@@ -0,0 +1,276 @@
+#!/usr/bin/python
+"""
+Reads the chunk files of a corpus that is served over HTTP, such as
+the public copy of the kba-streamcorpus-2013 in S3, instead of from a
+local directory.
+
+HTTPCorpus fetches each chunk file into a local ChunkCache before it
+is decrypted and decompressed, over keep-alive connections that are
+shared by the threads of --prefetch.  Chunk paths of a remote corpus
+are URLs under the corpus URL, so the rest of toy_kba_system.py
+handles them like local paths.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import re
+import socket
+import urllib
+import hashlib
+import httplib
+import logging
+import tempfile
+import threading
+import urlparse
+
+import toy_kba_cache
+import toy_kba_corpus
+
+logger = logging.getLogger('kba-toy-system')
+
+def is_remote(corpus):
+    '''
+    :returns bool: whether corpus is an http:// or https:// URL
+    '''
+    return corpus.startswith(('http://', 'https://'))
+
+class ConnectionPool(object):
+    '''
+    Keep-alive connections to one HTTP server, shared by threads.  At
+    most max_connections requests are in flight at once; other
+    threads wait for a connection to be released.
+    '''
+    ## size of the blocks in which response bodies are copied
+    BLOCK_SIZE = 2**16
+
+    def __init__(self, scheme, netloc, max_connections=4, timeout=60):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        ## connections that are open and not in use
+        self.idle = []
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def get(self, path, fh=None):
+        '''
+        GETs path from the server.  If the response is 200 OK and fh
+        is provided, the body is copied into fh, otherwise it is
+        returned.
+
+        :returns tuple: (status, body), where body is None if it was
+        copied into fh
+        '''
+        with self.slots:
+            with self.lock:
+                conn = self.idle and self.idle.pop() or None
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+
+            start = fh is not None and fh.tell() or 0
+            while True:
+                try:
+                    conn.request('GET', path)
+                    response = conn.getresponse()
+                    body = None
+                    if response.status == 200 and fh is not None:
+                        for block in iter(lambda: response.read(self.BLOCK_SIZE), ''):
+                            fh.write(block)
+                    else:
+                        body = response.read()
+                    break
+
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if not reused:
+                        raise
+                    ## the server may have closed an idle connection,
+                    ## so try once more on a new one
+                    logger.debug('retrying %s on a new connection' % path)
+                    if fh is not None:
+                        fh.seek(start)
+                        fh.truncate()
+                    conn = self._connect()
+                    reused = False
+
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+
+        return response.status, body
+
+class ChunkCache(object):
+    '''
+    Directory of chunk files fetched from a remote corpus, stored as
+    they were fetched, still encrypted and compressed.  Each file is
+    named by a hash of its URL followed by its original name, so that
+    toy_kba_corpus.ChunkPipe finds the same extensions as on a local
+    corpus.  The total size is kept
+    under max_bytes by deleting the least recently used files.
+    '''
+    def __init__(self, cache_dir, max_bytes=2**32):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        ## size of the cache directory, computed on first put
+        self.total_bytes = None
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, url):
+        return os.path.join(self.cache_dir, '%s-%s' % (
+                hashlib.md5(url).hexdigest(), url.rsplit('/', 1)[-1]))
+
+    def get(self, url):
+        '''
+        :returns str: local path of url, or None if it is not cached
+        '''
+        path = self.path(url)
+        try:
+            ## mark as recently used for eviction
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, url, tmp_path):
+        '''
+        Moves the fetched file at tmp_path into the cache as url.
+
+        :returns str: local path of url
+        '''
+        path = self.path(url)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, path)
+
+        if self.total_bytes is not None:
+            self.total_bytes += size
+        if self.total_bytes is None or self.total_bytes > self.max_bytes:
+            self.total_bytes = toy_kba_cache.evict_lru(
+                self.cache_dir, self.max_bytes, toy_kba_corpus.chunk_extensions)
+        return path
+
+class HTTPCorpus(object):
+    '''
+    A corpus served over HTTP below url.  fetch gives the local path
+    of a chunk file in the ChunkCache in cache_dir, fetching it if
+    needed, and listdir lists a directory from the index page that
+    the server generates for it, such as those of Apache, nginx or
+    python -m SimpleHTTPServer.
+
+    Each process that uses an HTTPCorpus, e.g. each of the --workers,
+    opens its own connections.
+    '''
+    ## links in a directory index page
+    href_re = re.compile(r'''href=["']?([^"'?#>\s]+)''', re.I)
+
+    def __init__(self, url, cache_dir, max_bytes=2**32, max_connections=4):
+        self.url = url
+        self.cache = ChunkCache(cache_dir, max_bytes)
+        self.max_connections = max_connections
+        self._init_pools()
+
+    def _init_pools(self):
+        self.pools = {}
+        self.lock = threading.Lock()
+        ## a forked child must not share the sockets of its parent
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        ## connections and locks cannot be shared between processes
+        state = dict(self.__dict__)
+        del state['pools'], state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_pools()
+
+    def _get(self, url, fh=None):
+        if self.pid != os.getpid():
+            self._init_pools()
+        parts = urlparse.urlsplit(url)
+        with self.lock:
+            pool = self.pools.get((parts.scheme, parts.netloc))
+            if pool is None:
+                pool = self.pools[(parts.scheme, parts.netloc)] = ConnectionPool(
+                    parts.scheme, parts.netloc, self.max_connections)
+        path = urllib.quote(parts.path or '/')
+        if parts.query:
+            path += '?' + parts.query
+        return pool.get(path, fh)
+
+    def fetch(self, url, stats=None):
+        '''
+        Fetches url into the ChunkCache, unless it is already there.
+        If stats, a toy_kba_stats.RunStats, is provided, the wall time
+        of the fetch is recorded as 'fetch'.
+
+        :returns str: local path of url, or None if it cannot be
+        fetched
+        '''
+        path = self.cache.get(url)
+        if path is not None:
+            if stats is not None:
+                stats.incr('chunk_cache_hits')
+            return path
+
+        if stats is not None:
+            stats.incr('chunk_cache_misses')
+            start = stats.start('fetch')
+
+        ## fetch into a temp file in the cache, so that other threads
+        ## and processes never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                status, body = self._get(url, fh)
+            if status == 200:
+                path = self.cache.put(url, tmp_path)
+            else:
+                logger.critical('failed to fetch %s: HTTP %d' % (url, status))
+        except (httplib.HTTPException, socket.error), exc:
+            logger.critical('failed to fetch %s: %r' % (url, exc))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if stats is not None:
+            stats.stop('fetch', start)
+            if path is not None:
+                stats.incr('bytes_fetched', os.path.getsize(path))
+        return path
+
+    def listdir(self, url):
+        '''
+        Lists the names in the directory at url, like os.listdir.
+        Links to other directories, parents and query pages are left
+        out.
+        '''
+        url = url.rstrip('/') + '/'
+        try:
+            status, body = self._get(url)
+        except (httplib.HTTPException, socket.error), exc:
+            raise OSError('failed to list %s: %r' % (url, exc))
+        if status != 200:
+            raise OSError('failed to list %s: HTTP %d' % (url, status))
+
+        names = []
+        for href in self.href_re.findall(body):
+            name = urllib.unquote(href.rstrip('/'))
+            if not name or '/' in name or ':' in name or name.startswith('.'):
+                continue
+            if name not in names:
+                names.append(name)
+        return names
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+"""
+Writes run files from the score store of a run of toy_kba_system.py,
+for any cutoffs and for either CCR or SSF, without scoring the corpus
+again.
+
+    python toy_kba_system.py --score-store scores.kbs ... filter-run.txt
+    python toy_kba_scores.py scores.kbs filter-run.%d.txt --cutoff 200 --cutoff 400 --cutoff 600
+
+Each run file has the lines that toy_kba_system.py would have written
+with that --cutoff, and with or without --ssf, in the same order.
+When more than one cutoff is given, %d in the output path is replaced
+by each cutoff.  The store only holds scores above zero, so cutoffs
+must not be negative.  The other parameters of the scoring run, such
+as --names-frac and --exact-slot-ranges, are fixed in the store.
+
+This needs numpy, see http://www.numpy.org/
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import re
+import os
+import sys
+import json
+import mmap
+import time
+import logging
+import argparse
+
+import numpy
+
+import toy_kba_output
+
+logger = logging.getLogger('kba-toy-system')
+
+## numpy dtypes of the array typecodes of ScoreWriter columns
+DTYPES = {'I': '<u4', 'i': '<i4', 'b': 'i1'}
+
+class ScoreReader(object):
+    '''
+    Reads a file written by toy_kba_output.ScoreWriter through mmap.
+    A store that was cut short by a crash is read up to its last
+    complete record.
+    '''
+    def __init__(self, path):
+        self.path = path
+        fh = open(path, 'rb')
+        self.buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+
+        writer = toy_kba_output.ScoreWriter
+        if self.buf[:len(writer.MAGIC)] != writer.MAGIC:
+            raise ValueError('%s is not a score store' % path)
+
+        ## the last filter_run, and the offsets of the ROWS records
+        self.filter_run = None
+        self.rows_offsets = []
+        pos = len(writer.MAGIC)
+        while pos + writer.RECORD_STRUCT.size <= len(self.buf):
+            tag, length = writer.RECORD_STRUCT.unpack_from(self.buf, pos)
+            pos += writer.RECORD_STRUCT.size
+            if pos + length > len(self.buf):
+                logger.warn('ignoring incomplete record at the end of %s' % path)
+                break
+            if tag == 'RUN ':
+                self.filter_run = json.loads(self.buf[pos:pos + length])
+            elif tag == 'ROWS':
+                self.rows_offsets.append(pos)
+            pos += length
+
+    def blocks(self):
+        '''
+        :returns generator: (columns, strings) for each ROWS record,
+        where columns maps each column name to a numpy array over the
+        file, and strings is the list of the record's strings
+        '''
+        writer = toy_kba_output.ScoreWriter
+        for pos in self.rows_offsets:
+            num_rows, num_slots, num_strings = \
+                writer.ROWS_STRUCT.unpack_from(self.buf, pos)
+            pos += writer.ROWS_STRUCT.size
+
+            columns = {}
+            for column_list, count in ((writer.ROW_COLUMNS, num_rows),
+                                       (writer.SLOT_COLUMNS, num_slots)):
+                for name, typecode in column_list:
+                    column = numpy.frombuffer(self.buf, DTYPES[typecode],
+                                              count, pos)
+                    columns[name] = column
+                    ## columns are padded to 4 bytes
+                    pos += -(-column.nbytes // 4) * 4
+
+            offsets = numpy.frombuffer(self.buf, DTYPES['I'],
+                                       num_strings + 1, pos).tolist()
+            pos += len(offsets) * 4
+            blob = self.buf[pos:pos + offsets[-1]]
+            strings = [blob[start:end]
+                       for start, end in zip(offsets[:-1], offsets[1:])]
+
+            yield columns, strings
+
+def run_records(columns, strings, cutoff, ssf, team_id, system_id):
+    '''
+    Selects the rows of one block with a confidence above cutoff.
+
+    :returns list: the records of 11 fields that toy_kba_pipeline.RunScorer
+    assembles for those rows, in the same order
+    '''
+    keep = columns['confidence'] > cutoff
+    if ssf:
+        ## only vital rows have slot fills
+        keep &= columns['relevance'] == 2
+    rows = numpy.flatnonzero(keep)
+
+    ## gather the selected rows of each column at once
+    stream_ids, target_ids, date_hours = [
+        [strings[string_num] for string_num in columns[name][rows].tolist()]
+        for name in ('stream_id', 'target_id', 'date_hour')]
+    confidence = columns['confidence'][rows].tolist()
+    relevance = columns['relevance'][rows].tolist()
+    contains_mention = columns['contains_mention'][rows].tolist()
+
+    if not ssf:
+        return [[team_id, system_id, stream_ids[i], target_ids[i],
+                 confidence[i], relevance[i], contains_mention[i],
+                 date_hours[i], "NULL", -1, "0-0"]
+                for i in xrange(len(rows))]
+
+    slot_end = columns['slot_end']
+    slot_ends = slot_end[rows].tolist()
+    slot_starts = numpy.concatenate(([0], slot_end[:-1]))[rows].tolist()
+    slot_conf = columns['slot_conf'].tolist()
+    slot_name, slot_equiv_id, byte_range = [
+        [strings[string_num] for string_num in columns[name].tolist()]
+        for name in ('slot_name', 'slot_equiv_id', 'byte_range')]
+
+    recs = []
+    for i in xrange(len(rows)):
+        for slot in xrange(slot_starts[i], slot_ends[i]):
+            recs.append([team_id, system_id, stream_ids[i], target_ids[i],
+                         slot_conf[slot], relevance[i], contains_mention[i],
+                         date_hours[i], slot_name[slot], slot_equiv_id[slot],
+                         byte_range[slot]])
+    return recs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store', help='score store written by toy_kba_system.py --score-store')
+    parser.add_argument('output', help='path of the run file to create, compressed if it ends in .gz or .xz; %%d is replaced by the cutoff')
+    parser.add_argument('--cutoff', dest='cutoffs', type=int, action='append', help='relevance cutoff, measured in thousandths; may be given more than once, defaults to 400')
+    parser.add_argument('--ssf', default=False, action='store_true', help='generate Streaming Slot Filling (SSF) results instead of Cummulative Citation Recommendation (CCR)')
+    parser.add_argument('--team-id', default=None, help='team_id for the first field of each line, defaults to that of the scoring run')
+    parser.add_argument('--system-id', default=None, help='system_id for the second field of each line, defaults to that of the scoring run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    cutoffs = args.cutoffs or [400]
+    if min(cutoffs) < 0:
+        sys.exit('the store only holds scores above zero, so --cutoff must not be negative')
+    if len(cutoffs) > 1 and '%d' not in args.output:
+        sys.exit('with more than one --cutoff, the output path must contain %d')
+
+    start_time = time.time()
+    reader = ScoreReader(args.store)
+    if reader.filter_run is None:
+        sys.exit('%s has no filter_run' % args.store)
+
+    team_id = args.team_id or reader.filter_run['team_id']
+    system_id = args.system_id or reader.filter_run['system_id']
+
+    ## shards carry their filter_run for toy_kba_merge.py, as in
+    ## toy_kba_system.py
+    print_comments = 'shard' in reader.filter_run.get('run_info', {})
+
+    outputs = []
+    for cutoff in cutoffs:
+        path = '%d' in args.output and args.output.replace('%d', str(cutoff)) \
+            or args.output
+        assert not os.path.exists(path), "Output path already exists: %s" % path
+        output = toy_kba_output.RunWriter(
+            path, toy_kba_output.output_compression(path), fsync_interval=None)
+
+        filter_run = dict(reader.filter_run, team_id=team_id, system_id=system_id)
+        filter_run['task_id'] = args.ssf and 'kba-ssf-2013' or 'kba-ccr-2013'
+        filter_run['run_info'] = dict(filter_run.get('run_info', {}), cutoff=cutoff)
+        if print_comments:
+            output.write_comment(json.dumps(filter_run))
+
+        outputs.append((cutoff, path, output, filter_run))
+
+    num_filter_results = dict((cutoff, 0) for cutoff in cutoffs)
+    for columns, strings in reader.blocks():
+        for cutoff, path, output, filter_run in outputs:
+            recs = run_records(columns, strings, cutoff, args.ssf,
+                               team_id, system_id)
+            output.write(recs)
+            num_filter_results[cutoff] += len(recs)
+
+    for cutoff, path, output, filter_run in outputs:
+        filter_run['run_info']['num_filter_results'] = num_filter_results[cutoff]
+        if print_comments:
+            filter_run_json_string = json.dumps(filter_run, indent=4, sort_keys=True)
+            output.write_comment(re.sub("\n", "\n#", filter_run_json_string))
+        output.close()
+        logger.info('wrote %d lines at cutoff %d to %s' % (
+                num_filter_results[cutoff], cutoff, path))
+
+    logger.info('done in %.1f seconds' % (time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""
+Lightweight instrumentation for toy_kba_system.py runs: wall time and
+counts for each stage of processing, counters, and latency histograms
+for documents and chunks, and with --watch from when each chunk file
+landed in the corpus until its lines were written.  The cost is a couple of time.time() calls
+per stage per document, so it is always on.
+
+
+Copyright (c) 2012-2013 Computable Insights LLC
+released under the MIT X11 License, see license.txt
+"""
+
+## import standard libraries
+import os
+import json
+import time
+import cProfile
+import threading
+
+## stages timed by toy_kba_pipeline and toy_kba_system; any of these
+## can be given to --profile-stage
+STAGES = ['fetch', 'load', 'text_cache', 'deserialize', 'prefilter', 'normalize',
+          'scan', 'assess', 'fill_slots', 'write']
+
+class Histogram(object):
+    '''
+    Counts of latencies in power-of-two buckets of microseconds
+    '''
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def to_dict(self):
+        ## keyed on the exclusive upper bound of each bucket, in usec
+        return dict((str(1 << bucket), count)
+                    for bucket, count in self.buckets.iteritems())
+
+    def merge(self, hist_dict):
+        for upper, count in hist_dict.iteritems():
+            bucket = int(upper).bit_length() - 1
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+class RunStats(object):
+    '''
+    Accumulates the time spent in each stage, counters and latency
+    histograms.  Stages are timed like this:
+
+        start = stats.start('normalize')
+        scorer = toy_kba_algorithm.Scorer(si)
+        stats.stop('normalize', start)
+
+    If profile_stage is set, that stage also runs under cProfile.
+    '''
+    def __init__(self, profile_stage=None):
+        self.seconds = {}
+        self.counts = {}
+        self.counters = {}
+        self.histograms = {'document': Histogram(), 'chunk': Histogram(),
+                           'landed': Histogram()}
+        self.profile_stage = profile_stage
+        self.profiler = profile_stage and cProfile.Profile() or None
+        ## chunks are loaded in background threads by --prefetch
+        self.lock = threading.Lock()
+
+    def start(self, stage):
+        if stage == self.profile_stage:
+            self.profiler.enable()
+        return time.time()
+
+    def stop(self, stage, start, count=1):
+        '''
+        records the time since start, as returned by self.start, and
+        returns it
+        '''
+        elapsed = time.time() - start
+        if stage == self.profile_stage:
+            self.profiler.disable()
+        self.add(stage, elapsed, count)
+        return elapsed
+
+    def timed_iter(self, stage, iterable):
+        '''
+        yields the items of iterable, timing each call to next as stage
+        '''
+        items = iter(iterable)
+        while True:
+            start = self.start(stage)
+            try:
+                item = next(items)
+            except StopIteration:
+                self.stop(stage, start, count=0)
+                return
+            self.stop(stage, start)
+            yield item
+
+    def add(self, stage, seconds, count=1):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + count
+
+    def incr(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def observe(self, histogram, seconds):
+        with self.lock:
+            self.histograms[histogram].add(seconds)
+
+    def summary(self):
+        '''
+        :returns dict: seconds and count of each stage, suitable for
+        filter_run["run_info"]
+        '''
+        return dict((stage, {'seconds': self.seconds[stage],
+                             'count': self.counts[stage]})
+                    for stage in self.seconds)
+
+    def to_dict(self):
+        return {
+            'stages': self.summary(),
+            'counters': dict(self.counters),
+            'histograms': dict((name, hist.to_dict())
+                               for name, hist in self.histograms.iteritems()),
+            }
+
+    def merge(self, stats_dict):
+        '''
+        adds in the output of another RunStats' to_dict, e.g. from a
+        worker process
+        '''
+        for stage, rec in stats_dict['stages'].iteritems():
+            self.add(stage, rec['seconds'], rec['count'])
+        for counter, value in stats_dict['counters'].iteritems():
+            self.incr(counter, value)
+        with self.lock:
+            for name, hist_dict in stats_dict['histograms'].iteritems():
+                self.histograms[name].merge(hist_dict)
+
+    def dump(self, path, **extra):
+        '''
+        writes to_dict() and any extra items as JSON to path, replacing
+        it atomically so that it can be watched during a run
+        '''
+        metrics = self.to_dict()
+        metrics.update(extra)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(metrics, fh, indent=4, sort_keys=True)
+        os.rename(tmp_path, path)
+
+    def dump_profile(self, path):
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
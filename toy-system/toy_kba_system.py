@@ -41,28 +41,64 @@ filter_run = {
 import re
 import os
 import sys
+import copy
 import json
-import yaml
 import time
-import copy
+import signal
 import logging
-import streamcorpus
+import tempfile
+import threading
 
 ## import the command line parsing library from python 2.7, can be
 ## installed on early python too.
 import argparse
+
+## the stage names are needed to parse --profile-stage
+import toy_kba_stats
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument(dest="mode",   help="'simple' baseline and 'slots' baseline")
 parser.add_argument(dest="filter_topics",   help=".json file of filter-topics")
 parser.add_argument(dest="profiles",   help=".json (or .yaml) file containing profiles map from target_id to lists of judged documents and a set of slots")
-parser.add_argument(dest="corpus", help="name of directory containing XX/YY/stream_id.sc.xz.gpg files")
-parser.add_argument(dest="output", help="filename to create for storing output of this run")
-parser.add_argument("--max", dest="max_docs", type=int, default=100, help="limit number of docs we examine")
+parser.add_argument(dest="corpus", help="name of directory containing XX/YY/stream_id.sc.xz.gpg files, or an http:// URL at which such a directory is served")
+parser.add_argument(dest="output", help="filename to create for storing output of this run, compressed if it ends in .gz or .xz")
+parser.add_argument("--max", dest="max_docs", type=int, default=None, help="limit number of docs we examine, defaults to 100, or no limit with --watch")
 parser.add_argument("--cutoff", dest="cutoff", type=int, default=400, help="relevance cutoff, measured in thousandths")
 parser.add_argument("--target-id", default='', help="specific target_id to run")
+parser.add_argument("--shard", default=None, help="run only shard i/N of the work, where i counts from 0; see --shard-by and toy_kba_merge.py")
+parser.add_argument("--shard-by", default="target", choices=["target", "chunk"], help="with --shard, split the targets or the chunk files between the shards by a stable hash")
 parser.add_argument("--names-frac", default=False, action='store_true', help="use fraction of name length as confidence")
 parser.add_argument("--ssf", default=False, action="store_true", help="generate Streaming Slot Filling (SSF) results instead of the default Cummulative Citation Recommendation (CCR)")
+parser.add_argument("--by-chunk", default=False, action="store_true", help="read each cited chunk once and score it against all targets that cite it, instead of once per citation")
+parser.add_argument("--workers", type=int, default=1, help="number of processes for scoring chunks in parallel; the run file is the same for any number of workers")
+parser.add_argument("--exact-slot-ranges", default=False, action="store_true", help="in SSF results, give the char range of the name mention instead of the whole sentence")
+parser.add_argument("--stream", default=False, action="store_true", help="walk the YYYY-MM-DD-HH directories of the corpus in chronological order and score every chunk against all targets, instead of reading cited chunks")
+parser.add_argument("--watch", default=False, action="store_true", help="like --stream, but keep running and score the chunks that land in new or existing YYYY-MM-DD-HH directories of a local corpus within seconds, until interrupted; OUTPUT must contain %%s, which is replaced by the --rotate period of each run file, and by 'watch' in the manifest")
+parser.add_argument("--rotate", default="hour", choices=["hour", "day"], help="with --watch, start a new run file for each hour or each day of date_hours")
+parser.add_argument("--poll-interval", type=float, default=5, help="with --watch, seconds between listings of the corpus")
+parser.add_argument("--settle", type=float, default=2, help="with --watch, seconds that a chunk file must go unmodified before it is read, so that one that is still being copied in is not")
+parser.add_argument("--sweep", default=None, help="path of a JSON list of configurations to run in one pass over the corpus, each an object with a name, which replaces %%s in OUTPUT for its run file, and any of mode, names_frac, cutoff and ssf, which default to the command line")
+parser.add_argument("--prefetch", type=int, default=0, help="number of upcoming chunks to read, decrypt and decompress in background threads while scoring")
+parser.add_argument("--text-cache", default=None, help="directory in which to store the normalized text of each chunk, so that later runs skip decrypting, decompressing and normalizing it")
+parser.add_argument("--text-cache-size", type=int, default=1024, help="maximum size of --text-cache in megabytes, least recently used chunks are evicted")
+parser.add_argument("--remote-cache", default=None, help="directory in which to keep the chunk files fetched from a corpus URL, defaults to kba-remote-cache in the temp directory")
+parser.add_argument("--remote-cache-size", type=int, default=4096, help="maximum size of --remote-cache in megabytes, least recently used chunks are evicted")
+parser.add_argument("--remote-connections", type=int, default=4, help="maximum number of concurrent requests to a corpus URL from each process; use --prefetch to fetch upcoming chunks while scoring")
+parser.add_argument("--max-item-bytes", type=int, default=None, help="ceiling on the thrift size of a StreamItem; larger items are handled by --oversize without being decoded in full, so that memory holds about this much of a chunk at a time")
+parser.add_argument("--oversize", default="skip", choices=["skip", "truncate"], help="with --max-item-bytes, skip larger items, or truncate them to the identifying fields and as much of clean_visible as fits; counted as items_skipped or items_truncated in run_info")
+parser.add_argument("--score-memo", type=int, default=10000, help="number of recently scored documents whose scores and slot fills are kept in memory by a hash of their clean_visible, so that duplicates are not scored again; 0 disables it, as does --text-cache")
+parser.add_argument("--no-prefilter", dest="prefilter", default=True, action="store_false", help="build a Scorer for every document, instead of first checking the raw bytes for name parts of the targets")
+parser.add_argument("--token-index", default=None, help="directory of a token index of the corpus built by toy_kba_index.py, so that only the documents that can contain a name part of the targets are read; chunks that are not in the index are read in full")
 parser.add_argument("--slot-names", default=None, help="path to JSON file mapping entity_type to list of slot_names")
+parser.add_argument("--resume", default=False, action="store_true", help="continue an interrupted run from the last checkpoint in OUTPUT.manifest, instead of requiring that OUTPUT does not exist")
+parser.add_argument("--checkpoint-interval", type=float, default=60, help="seconds between checkpoints of completed chunks in OUTPUT.manifest")
+parser.add_argument("--fsync-interval", type=float, default=60, help="seconds between fsyncs of the output file while it is written")
+parser.add_argument("--profile-cache", default=None, help="directory in which to store the entity representations and citations compiled from the filter-topics, profiles and slot names, so that later runs with the same inputs skip parsing them")
+parser.add_argument("--score-store", default=None, help="path of a file in which to store every score above zero, whatever the --cutoff, with the slot fills of vital ones, for toy_kba_scores.py to write the run files of other cutoffs, CCR or SSF")
+parser.add_argument("--save-entities", default=None, help="path of a JSON file in which to save the prepared entity representations, e.g. for toy_kba_mrjob.py --entities")
+parser.add_argument("--metrics", default=None, help="path of a JSON file to which per-stage timings, counters and latency histograms are written during and after the run")
+parser.add_argument("--metrics-interval", type=float, default=60, help="seconds between updates of the --metrics file")
+parser.add_argument("--profile-stage", default=None, choices=toy_kba_stats.STAGES, help="run this stage under cProfile and write the profile to --profile-output")
+parser.add_argument("--profile-output", default=None, help="path for the cProfile output of --profile-stage, defaults to OUTPUT.prof")
 args = parser.parse_args()
 
 logger = logging.getLogger("kba-toy-system")
@@ -73,16 +109,117 @@ formatter = logging.Formatter("%(asctime)s %(process)d %(levelname)s: %(message)
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-## do not overwrite existing
-assert not os.path.exists(args.output), "Output path already exists."
+shard = None
+if args.shard:
+    try:
+        shard = map(int, args.shard.split('/'))
+        assert len(shard) == 2 and 0 <= shard[0] < shard[1]
+    except (ValueError, AssertionError):
+        sys.exit("--shard must be i/N with 0 <= i < N, not %r" % args.shard)
+
+if args.profile_stage and args.workers > 1:
+    sys.exit("--profile-stage only profiles the main process, so it requires --workers 1")
+
+if args.max_docs is None:
+    args.max_docs = args.watch and sys.maxint or 100
+
+## options that each configuration of --sweep can set
+SWEEP_OPTIONS = ["mode", "names_frac", "cutoff", "ssf"]
+
+sweep_configs = None
+if args.sweep:
+    if '%s' not in args.output:
+        sys.exit("with --sweep, OUTPUT must contain %s, which is replaced by the name of each configuration")
+    if args.watch or args.score_store:
+        sys.exit("--sweep cannot be combined with --watch or --score-store")
+    sweep_configs = json.load(open(args.sweep))
+    names = set()
+    for config in sweep_configs:
+        unknown = set(config) - set(["name"] + SWEEP_OPTIONS)
+        if unknown:
+            sys.exit("unknown options in --sweep configuration: %s" % sorted(unknown))
+        if config.get("name") in names or not config.get("name"):
+            sys.exit("each --sweep configuration needs a different name, not %r" % config.get("name"))
+        names.add(config["name"])
+        for option in SWEEP_OPTIONS:
+            config.setdefault(option, getattr(args, option))
+    if not sweep_configs:
+        sys.exit("--sweep has no configurations")
+
+def sweep_path(config):
+    """
+    :returns str: path of the run file of a --sweep configuration
+    """
+    return args.output.replace('%s', config["name"].encode('utf8'))
+
+manifest_path = args.output + '.manifest'
+if args.watch:
+    if '%s' not in args.output:
+        sys.exit("with --watch, OUTPUT must contain %s, which is replaced by the hour or day of each run file")
+    if args.prefetch:
+        sys.exit("--prefetch reads ahead of the chunk being scored, so with --watch it would hold back each chunk until the next one lands; use --workers")
+    args.stream = True
+    ## the run files are named by the periods they cover, and found
+    ## from the manifest on --resume
+    manifest_path = args.output.replace('%s', 'watch') + '.manifest'
+    assert args.resume or not os.path.exists(manifest_path), "Manifest already exists, use --resume."
+elif sweep_configs:
+    manifest_path = args.output.replace('%s', 'sweep') + '.manifest'
+    for config in sweep_configs:
+        assert args.resume or not os.path.exists(sweep_path(config)), "Output path already exists."
+else:
+    ## do not overwrite existing, unless resuming it
+    assert args.resume or not os.path.exists(args.output), "Output path already exists."
 ## make dir for output if it has dir
-dir = os.path.dirname(args.output)
+dir = os.path.dirname(manifest_path)
 if dir and not os.path.exists(dir):
     os.makedirs(dir)
-output = open(args.output, "wb+")
 
 ## get our filter algorithm
 import toy_kba_algorithm
+import toy_kba_cache
+import toy_kba_corpus
+import toy_kba_index
+import toy_kba_output
+import toy_kba_pipeline
+import toy_kba_profiles
+import toy_kba_remote
+
+if args.watch and toy_kba_remote.is_remote(args.corpus):
+    sys.exit("--watch polls a local corpus directory, not a URL")
+
+## timings and counters of every stage, including those in workers
+stats = toy_kba_stats.RunStats(args.profile_stage)
+
+## checkpoints of the run, for --resume
+manifest = toy_kba_output.RunManifest(manifest_path)
+resume_offset, resume_completed, resume_run_info = 0, [], {}
+## size of each run file at the last checkpoint
+resume_offsets = {}
+if args.resume and (args.watch or args.sweep or os.path.exists(args.output)):
+    resume_offset, resume_completed, resume_run_info = manifest.load()
+    ## with --watch, the last checkpoint is in one of the run files,
+    ## and with --sweep, in the run file of every configuration
+    resume_offsets = resume_run_info.get("sweep_offsets") or \
+        {resume_run_info.get("output_path", args.output): resume_offset}
+    for resume_path, offset in sorted(resume_offsets.iteritems()):
+        if os.path.exists(resume_path):
+            ## drop any output written after the last checkpoint
+            with open(resume_path, 'r+b') as fh:
+                fh.truncate(offset)
+        logger.info('resuming %s at byte %d after %d completed chunks' % (
+                resume_path, offset, len(resume_completed)))
+else:
+    manifest.truncate()
+
+## lines are formatted and written in a background thread; with
+## --watch, each run file is opened by rotate when its first chunk is
+## scored
+output = None
+if not args.watch and not sweep_configs:
+    output = toy_kba_output.RunWriter(
+        args.output, toy_kba_output.output_compression(args.output),
+        args.fsync_interval, stats, append=resume_offset > 0)
 
 ## load entities
 filter_topics = json.load(open(args.filter_topics))
@@ -90,43 +227,129 @@ filter_topics = json.load(open(args.filter_topics))
 ## set the topic set identifier in filter_run
 #filter_run["topic_set_id"] = filter_topics["topic_set_id"]
 
-if args.profiles.endswith('.json'):
-    profiles = json.load(open(args.profiles))
-elif args.profiles.endswith('.yaml'):
-    profiles = yaml.load(open(args.profiles))
-
 ## init our toy algorithm
 entities = filter_topics["targets"]
 
+if args.target_id:
+    ## for parallel mode, just do one
+    target_ids = [args.target_id]
+else:
+    target_ids = [rec['target_id'] for rec in filter_topics['targets']
+                  if rec['training_time_range_end']]
+
+if shard and args.shard_by == 'target':
+    target_ids = [target_id for target_id in target_ids
+                  if toy_kba_corpus.in_shard(target_id, *shard)]
+
+## with --target-id or --shard-by target, only the profiles of
+## target_ids are loaded and prepared
+selected_target_ids = None
+if args.target_id or (shard and args.shard_by == 'target'):
+    selected_target_ids = target_ids
+    entities = [rec for rec in entities if rec['target_id'] in target_ids]
+
 if args.mode not in ['slots', 'simple']:
     sys.exit("mode argument must be either 'slots' or 'simple'")
 
-conf_heuristic = toy_kba_algorithm.LEN_FRAC
-if not args.names_frac:
-    conf_heuristic = toy_kba_algorithm.NAMES_FRAC
-
-recall_filters = {}
-for target_id, data in profiles['entities'].iteritems():
-    recall_filters[target_id] = []
-    for slot_name, values in data['slots'].iteritems():
-        if slot_name.isupper() and args.mode == 'slots':
-            for val in values:
-                recall_filters[target_id].append(val['value'])
-        elif args.mode == 'simple' and slot_name == 'canonical_name':                
-            recall_filters[target_id].append(values)
-            recall_filters[target_id] += values.split()
-
-print recall_filters
-
-slot_names = {}
-if args.slot_names:
-    slot_names = json.load(open(args.slot_names))
-
-entity_representations = toy_kba_algorithm.prepare_entities(
-    entities, recall_filters=recall_filters, 
-    slot_names=slot_names,
-)
-logger.info( json.dumps(entity_representations, indent=4, sort_keys=True) )
+def heuristic(names_frac):
+    """
+    :returns: the confidence heuristic chosen by --names-frac
+    """
+    if names_frac:
+        return toy_kba_algorithm.LEN_FRAC
+    return toy_kba_algorithm.NAMES_FRAC
+
+conf_heuristic = heuristic(args.names_frac)
+
+def prepare_profiles(mode):
+    """
+    Parses the profiles and prepares the entity representations of
+    mode.
+
+    :returns tuple: (entity_representations, citations), where
+    citations maps each target_id in the profiles to a list of the
+    mention_ids of its citations
+    """
+    profiles = toy_kba_profiles.load_profiles(args.profiles, selected_target_ids)
+
+    recall_filters = toy_kba_algorithm.make_recall_filters(profiles, mode)
+    ## only a count: dumping every surface form name of a large
+    ## profiles file took a noticeable part of the startup
+    logger.debug('%d surface form names in the recall filters of %d targets' % (
+            sum(len(names) for names in recall_filters.itervalues()),
+            len(recall_filters)))
+
+    slot_names = {}
+    if args.slot_names:
+        slot_names = json.load(open(args.slot_names))
+
+    entity_representations = toy_kba_algorithm.prepare_entities(
+        entities, recall_filters=recall_filters, 
+        slot_names=slot_names,
+    )
+
+    citations = {}
+    for target_id, data in profiles['entities'].iteritems():
+        citations[target_id] = [citation['mention_id']
+                                for citation in data.get('citations', [])]
+
+    return entity_representations, citations
+
+def load_entities(mode):
+    """
+    Prepares the entity representations of mode, or reads them from
+    --profile-cache
+
+    :returns tuple: (entity_representations, target_citations), where
+    target_citations(target_id) iterates over the mention_ids of the
+    citations of target_id
+    """
+    if args.profile_cache:
+        ## reuse the representations compiled by an earlier run with the
+        ## same inputs, instead of parsing the profiles again
+        profile_cache = toy_kba_cache.ProfileCache(args.profile_cache)
+        key = profile_cache.key(
+            [args.filter_topics, args.profiles, args.slot_names], mode,
+            selected_target_ids)
+        compiled = profile_cache.get(key)
+        if compiled is None:
+            logger.info('compiling profiles into %s' % profile_cache.path(key))
+            compiled = profile_cache.put(key, *prepare_profiles(mode))
+        return compiled.entity_representations, compiled.citations
+
+    entity_representations, citations = prepare_profiles(mode)
+    return entity_representations, lambda target_id: iter(citations[target_id])
+
+if sweep_configs:
+    ## the entities of each mode are prepared once for all of the
+    ## configurations in that mode
+    mode_representations = {}
+    for config in sweep_configs:
+        if config["mode"] not in ['slots', 'simple']:
+            sys.exit("mode of --sweep configuration %r must be either 'slots' or 'simple'" % config["name"])
+        if config["mode"] not in mode_representations:
+            mode_representations[config["mode"]], target_citations = \
+                load_entities(config["mode"])
+    entity_representations = mode_representations[sweep_configs[0]["mode"]]
+else:
+    entity_representations, target_citations = load_entities(args.mode)
+
+logger.info('prepared %d entity representations' % len(entity_representations))
+
+if args.save_entities:
+    with open(args.save_entities, 'w') as fh:
+        json.dump(dict((target_id, entity_repr.to_dict())
+                       for target_id, entity_repr in entity_representations.iteritems()),
+                  fh, indent=4, sort_keys=True)
+
+## a corpus URL is fetched into a local cache as it is read
+remote = None
+if toy_kba_remote.is_remote(args.corpus):
+    remote = toy_kba_remote.HTTPCorpus(
+        args.corpus,
+        args.remote_cache or os.path.join(tempfile.gettempdir(), 'kba-remote-cache'),
+        max_bytes=args.remote_cache_size * 2**20,
+        max_connections=args.remote_connections)
 
 ## set the corpus identifier in filter_run
 corpus_id_parts = args.corpus.split("/")
@@ -136,157 +359,418 @@ filter_run["corpus_id"] = corpus_id_parts[-1] or corpus_id_parts[-2]
 ## filter_run dict to store in our submission... not too much, just a
 ## bit of context for humans.
 filter_run["run_info"] = {
-    "num_entities": len(entities),
+    "num_entities": len(filter_topics["targets"]),
     }
-
-print_comments = False
-if print_comments:
+if shard:
+    filter_run["run_info"]["shard"] = args.shard
+if args.max_item_bytes:
+    filter_run["run_info"]["max_item_bytes"] = args.max_item_bytes
+    filter_run["run_info"]["oversize"] = args.oversize
+
+## shards carry their filter_run for toy_kba_merge.py
+print_comments = bool(shard)
+if print_comments and output is not None and not resume_offset:
     ## create json string (just one line, no pretty printing!)
     filter_run_json_string = json.dumps(filter_run)
     ## write it as a comment at the first line of the file
-    output.write("#%s\n" % filter_run_json_string)
+    output.write_comment(filter_run_json_string)
+
+## with --sweep, each configuration has its own run file, which
+## starts with its own filter_run
+sweep_runs = []
+for config in sweep_configs or []:
+    sweep_filter_run = copy.deepcopy(filter_run)
+    sweep_filter_run["run_info"]["configuration"] = config
+    if config["ssf"]:
+        sweep_filter_run["task_id"] = "kba-ssf-2013"
+    path = sweep_path(config)
+    offset = resume_offsets.get(path, 0)
+    sweep_output = toy_kba_output.RunWriter(
+        path, toy_kba_output.output_compression(path),
+        args.fsync_interval, stats, append=offset > 0)
+    if not offset:
+        sweep_output.write_comment(json.dumps(sweep_filter_run))
+    sweep_runs.append({
+            "config": config, "path": path, "output": sweep_output,
+            "filter_run": sweep_filter_run,
+            "num_filter_results": resume_run_info.get("sweep_filter_results", {}).get(path, 0),
+            })
+
+score_writer = None
+if args.score_store:
+    ## a resumed run continues the store from the last checkpoint
+    score_writer = toy_kba_output.ScoreWriter(
+        args.score_store, filter_run,
+        resume_run_info.get("score_store_offset"))
 
 ## do the run
 # keep track of elapsed time
-start_time = time.time()
-num_entity_doc_compares = 0
-num_filter_results = 0
-num_docs = 0
-num_stream_hours = 0
-
-if args.target_id:
-    ## for parallel mode, just do one
-    target_ids = [args.target_id]
+start_time = time.time() - resume_run_info.get("elapsed_time", 0)
+num_entity_doc_compares = resume_run_info.get("num_entity_doc_compares", 0)
+num_filter_results = resume_run_info.get("num_filter_results", 0)
+num_docs = resume_run_info.get("num_docs", 0)
+num_stream_hours = resume_run_info.get("num_stream_hours", 0)
+
+def citation_tasks():
+    """
+    Generates a (chunk_path, target_ids, date_hour) task for every
+    citation of every target
+    """
+    for target_id in target_ids:
+        logger.info("Processing " + target_id)
+
+        for mention_id in target_citations(target_id):
+            chunk_path = toy_kba_corpus.citation_chunk_path(
+                args.corpus, mention_id)
+
+            yield chunk_path, [target_id], ''
+
+def chunk_tasks():
+    """
+    Generates one (chunk_path, target_ids, date_hour) task for every
+    cited chunk, with all of the targets that cite it
+    """
+    for chunk_path, chunk_target_ids in toy_kba_corpus.chunk_index(
+            target_citations, target_ids, args.corpus).iteritems():
+
+        logger.info("Processing %s for %d targets" % (chunk_path, len(chunk_target_ids)))
+
+        yield chunk_path, chunk_target_ids, ''
+
+def stream_tasks():
+    """
+    Generates one (chunk_path, target_ids, date_hour) task for every
+    chunk in the corpus, walking the hourly directories in
+    chronological order
+    """
+    listdir = remote is not None and remote.listdir or os.listdir
+    for date_hour, chunk_path in toy_kba_corpus.date_hour_chunks(args.corpus, listdir):
+        logger.info("Processing %s" % chunk_path)
+
+        yield chunk_path, target_ids, date_hour
+
+## set by SIGINT or SIGTERM to end a --watch run after the chunks
+## that have landed
+stop_watching = threading.Event()
+
+def watch_tasks():
+    """
+    Like stream_tasks, but goes on to generate a task for each chunk
+    that lands in the corpus later, until stop_watching is set
+    """
+    for date_hour, chunk_path in toy_kba_corpus.watch_date_hour_chunks(
+            args.corpus, args.poll_interval, args.settle, stop_watching):
+        logger.info("Processing %s" % chunk_path)
+
+        yield chunk_path, target_ids, date_hour
+
+    logger.info("stopped watching %s" % args.corpus)
+
+def stop_watch(signum, frame):
+    logger.info("finishing the chunks that have landed, on signal %d" % signum)
+    stop_watching.set()
+
+if args.watch:
+    signal.signal(signal.SIGINT, stop_watch)
+    signal.signal(signal.SIGTERM, stop_watch)
+    tasks = watch_tasks()
+elif args.stream:
+    tasks = stream_tasks()
+elif args.by_chunk:
+    ## visit each cited chunk once and score each of its documents
+    ## against all of the targets that cite that chunk
+    tasks = chunk_tasks()
 else:
-    target_ids = [rec['target_id'] for rec in filter_topics['targets']
-                  if rec['training_time_range_end']]
-
-for target_id in target_ids:
-
-    ## only go up to max_docs
-    if num_docs >= args.max_docs:
-        break
-
-    logger.info("Processing " + target_id)
-
-    for citation in profiles['entities'][target_id]['citations']:
+    tasks = citation_tasks()
+
+def shard_chunks(tasks):
+    """
+    Keeps the tasks whose chunk file belongs to this shard, by the
+    path of the chunk file within the corpus
+    """
+    for task in tasks:
+        if toy_kba_corpus.in_shard(os.path.relpath(task[0], args.corpus), *shard):
+            yield task
+
+if shard and args.shard_by == 'chunk':
+    tasks = shard_chunks(tasks)
+
+def completed_entry(chunk_path, chunk_target_ids):
+    """
+    :returns: the entry of a completed task in the manifest, which is
+    only its chunk_path if it is for all of the targets, as every task
+    of --stream and --watch is, so that the manifest does not grow
+    with the number of targets
+    """
+    if chunk_target_ids == target_ids:
+        return chunk_path
+    return [chunk_path, chunk_target_ids]
+
+def skip_completed(tasks):
+    """
+    Drops the tasks that a resumed run completed before its last
+    checkpoint.  In citation mode the same task can appear more than
+    once, so each completed entry skips only one occurrence.
+    """
+    completed = {}
+    for entry in resume_completed:
+        if isinstance(entry, basestring):
+            ## a task of all of the targets, see completed_entry
+            key = (entry, tuple(target_ids))
+        else:
+            key = (entry[0], tuple(entry[1]))
+        completed[key] = completed.get(key, 0) + 1
+
+    for task in tasks:
+        key = (task[0], tuple(task[1]))
+        if completed.get(key):
+            completed[key] -= 1
+            continue
+        yield task
+
+if resume_completed:
+    tasks = skip_completed(tasks)
+
+text_cache = None
+if args.text_cache:
+    text_cache = toy_kba_cache.TextCache(
+        args.text_cache, max_bytes=args.text_cache_size * 2**20)
+
+## entity_representations, filter_run, conf_heuristic, cutoff and ssf
+## of each configuration, see toy_kba_pipeline.SweepScorer
+configs = [(mode_representations[run["config"]["mode"]], run["filter_run"],
+            heuristic(run["config"]["names_frac"]), run["config"]["cutoff"],
+            run["config"]["ssf"])
+           for run in sweep_runs]
+
+token_index = None
+if args.token_index:
+    cutoffs = [config[3] for config in configs] or [args.cutoff]
+    if min(cutoffs) < 0 or text_cache is not None:
+        logger.warn("--token-index is not used with a negative --cutoff or with --text-cache, which must see every document")
+    else:
+        ## with --sweep, the name parts of every configuration
+        token_index = toy_kba_index.TokenIndex(
+            args.token_index, args.corpus,
+            configs and toy_kba_pipeline.sweep_representations(configs) or
+            entity_representations)
+
+if sweep_runs:
+    scorer_class = toy_kba_pipeline.SweepScorer
+    run_scorer_args = (configs, text_cache, args.exact_slot_ranges,
+                       args.prefilter, remote, args.max_item_bytes,
+                       args.oversize, args.score_memo, token_index)
+else:
+    scorer_class = toy_kba_pipeline.RunScorer
+    run_scorer_args = (entity_representations, filter_run,
+                       conf_heuristic, args.cutoff, args.ssf, text_cache,
+                       args.exact_slot_ranges, args.prefilter,
+                       score_writer is not None, remote, args.max_item_bytes,
+                       args.oversize, args.score_memo, token_index)
+
+last_metrics_time = start_time
+
+def dump_metrics():
+    if args.metrics:
+        stats.dump(args.metrics, elapsed_time=time.time() - start_time,
+                   num_docs=num_docs,
+                   num_entity_doc_compares=num_entity_doc_compares,
+                   num_filter_results=num_filter_results)
+
+## chunks fully scored since the last checkpoint
+completed = []
+last_checkpoint_time = time.time()
+
+## counters of stats that are also reported in run_info, including
+## those of the run being resumed: items larger than --max-item-bytes,
+## counted by toy_kba_reader, and lookups in --score-memo
+RUN_INFO_COUNTERS = []
+if args.max_item_bytes:
+    RUN_INFO_COUNTERS += ["items_skipped", "items_truncated"]
+if args.score_memo and not args.text_cache:
+    RUN_INFO_COUNTERS += ["score_memo_hits", "score_memo_misses"]
+
+def stats_counters():
+    return dict((counter, resume_run_info.get(counter, 0) + stats.counters.get(counter, 0))
+                for counter in RUN_INFO_COUNTERS)
+
+def run_info_counters():
+    run_info = {
+        "num_docs": num_docs,
+        "num_entity_doc_compares": num_entity_doc_compares,
+        "num_filter_results": num_filter_results,
+        "num_stream_hours": num_stream_hours,
+        "last_date_hour": last_date_hour,
+        "elapsed_time": time.time() - start_time,
+        }
+    run_info.update(stats_counters())
+    return run_info
+
+def checkpoint():
+    ## the output must be on disk before the manifest points past it
+    if sweep_runs:
+        offset = 0
+        sweep_offsets = dict((run["path"], run["output"].checkpoint())
+                             for run in sweep_runs)
+    else:
+        offset = output.checkpoint()
+    run_info = run_info_counters()
+    if sweep_runs:
+        run_info["sweep_offsets"] = sweep_offsets
+        run_info["sweep_filter_results"] = dict(
+            (run["path"], run["num_filter_results"]) for run in sweep_runs)
+    if score_writer is not None:
+        run_info["score_store_offset"] = score_writer.checkpoint()
+    if args.watch:
+        run_info["output_path"] = output.path
+    manifest.record(offset, completed, run_info)
+    del completed[:]
+
+def rotated_path(date_hour):
+    """
+    :returns str: path of the --watch run file for date_hour
+    """
+    period = args.rotate == "day" and date_hour[:10] or date_hour
+    return args.output.replace('%s', period)
+
+def rotate(path):
+    """
+    Closes the current run file of --watch and continues in path,
+    appending to it if it was written before, e.g. by a resumed run or
+    for a chunk that landed late in an earlier hour
+    """
+    global output
+    if output is not None:
+        checkpoint()
+        output.close()
+
+    dir = os.path.dirname(path)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    append = os.path.exists(path)
+    output = toy_kba_output.RunWriter(
+        path, toy_kba_output.output_compression(path),
+        args.fsync_interval, stats, append=append)
+    if print_comments and not append:
+        output.write_comment(json.dumps(filter_run))
+    logger.info("writing to %s" % path)
+
+    ## so that --resume truncates this file from here on
+    checkpoint()
+
+## chunks, docs and end-to-end latency of the current hour of --watch
+hour_report = None
+
+def report_hour():
+    """
+    Logs how long after landing the chunks of the last hour were
+    written to the run file
+    """
+    if hour_report is None or not hour_report["chunks"]:
+        return
+    logger.info("hour %(date_hour)s: %(chunks)d chunks, %(docs)d docs, "
+                "written %(last_landed).1f seconds after its last chunk landed, "
+                "at most %(max_landed).1f" % hour_report)
+    dump_metrics()
+
+last_date_hour = resume_run_info.get("last_date_hour")
+for (chunk_path, chunk_target_ids, date_hour), results in \
+        toy_kba_pipeline.score_chunks(tasks, run_scorer_args,
+                                      args.workers, args.prefetch, stats,
+                                      stop_watching, scorer_class):
+
+    if date_hour and date_hour != last_date_hour:
+        ## count each hourly directory that we enter
+        num_stream_hours += 1
+        last_date_hour = date_hour
+
+    if args.watch:
+        if hour_report is None or hour_report["date_hour"] != date_hour:
+            report_hour()
+            hour_report = {"date_hour": date_hour, "chunks": 0, "docs": 0,
+                           "last_landed": 0.0, "max_landed": 0.0}
+        if output is None or output.path != rotated_path(date_hour):
+            rotate(rotated_path(date_hour))
+        chunk_start_docs = num_docs
+
+    chunk_done = True
+    for recs in results:
         ## only go up to max_docs
         if num_docs >= args.max_docs:
+            chunk_done = False
             break
 
-        stream_id = citation['mention_id'].split('#')[0]
-        epoch_ticks, doc_id = stream_id.split('-')
-        first = doc_id[:2]
-        second = doc_id[2:4]
+        ## count docs considered
+        num_docs += 1
 
-        chunk_path = os.path.join(args.corpus, first, second, stream_id) + '.sc.xz.gpg'
+        if recs is None:
+            ## scorer failed on this doc
+            continue
 
-        ## read StreamItem instances until we hit prescribed max,
-        ## which might take more than one chunk file
+        if score_writer is not None:
+            recs, scores = recs
+            score_writer.write(scores)
+
+        num_entity_doc_compares += len(chunk_target_ids)
+
+        if sweep_runs:
+            ## the records of each configuration go to its run file
+            for run, run_recs in zip(sweep_runs, recs):
+                run["output"].write(run_recs)
+                run["num_filter_results"] += len(run_recs)
+                num_filter_results += len(run_recs)
+        else:
+            logger.debug('saving %d recs' % len(recs))
+            for rec in recs:
+                assert len(rec) == 11, (len(rec), rec)
+            output.write(recs)
+
+            ## keep count of how many we have save total
+            num_filter_results += len(recs)
+
+        ## print some speed info every 100 entities
+        if num_docs % 100 == 0:
+            elapsed = time.time() - start_time
+            doc_rate = float(num_docs) / elapsed
+            scoring_rate = float(num_entity_doc_compares) / elapsed
+            logger.info("%d docs, %d scorings in %.1f --> %.3f docs/sec, %.3f compute_relevance/sec" % (
+                    num_docs, num_entity_doc_compares, elapsed, doc_rate, scoring_rate))
+
+        if args.metrics and time.time() - last_metrics_time > args.metrics_interval:
+            dump_metrics()
+            last_metrics_time = time.time()
+
+    if chunk_done:
+        completed.append(completed_entry(chunk_path, chunk_target_ids))
+        if args.watch:
+            ## every chunk is on disk before the next one is scored
+            checkpoint()
+            landed = time.time() - os.path.getmtime(chunk_path)
+            stats.observe('landed', landed)
+            hour_report["chunks"] += 1
+            hour_report["docs"] += num_docs - chunk_start_docs
+            hour_report["last_landed"] = landed
+            hour_report["max_landed"] = max(hour_report["max_landed"], landed)
+        elif time.time() - last_checkpoint_time > args.checkpoint_interval:
+            checkpoint()
+            last_checkpoint_time = time.time()
 
-        if not os.path.exists(chunk_path):
-            logger.critical('failed to find %s' % chunk_path)
-            continue
-        
-        for si in streamcorpus.Chunk(path=chunk_path):
-            if num_docs == args.max_docs:
-                break
-
-            if not si.body.clean_visible:
-                ## This sytem only considers docs that have
-                ## clean_visible text
-                logger.critical('giving up for lack of clean_visible')
-                continue
-
-            ## count docs considered
-            num_docs += 1
-
-            ## instantiate an instance of Scorer from toy_kba_algorithm
-            scorer = toy_kba_algorithm.Scorer(si)
-            
-            ## give up if the scorer fails
-            if not scorer.ready:
-                logger.critical('failed because scorer is not ready')
-                continue
-
-            entity_repr = entity_representations[target_id]
-
-            if 1:
-                ## run a filter algorithm
-                confidence, relevance, contains_mention = \
-                    scorer.assess_target(entity_repr, conf_heuristic)
-                num_entity_doc_compares += 1
-
-                if not confidence > args.cutoff:
-                    logger.info('dropping line for low conf=%f' % confidence)
-                else:
-                    ## assemble line in the format specified on
-                    ## http://trec-kba.org/trec-kba-2013.shtml#submissions
-                    ccr_rec = [
-                        ## sytem identifier
-                        filter_run["team_id"], filter_run["system_id"], 
-                            
-                        ## this task identifier
-                        si.stream_id, target_id, 
-
-                        ## algorithm output:
-                        confidence, relevance, contains_mention,
-
-                        ## identify the directory containing this chunk file
-                        '', #date_hour, 
-
-                        ## default values for SSF run
-                        "NULL", -1, "0-0",
-                        ]
-
-                    if not args.ssf:
-                        ## use only the CCR record
-                        recs = [ccr_rec]
-
-                    else:
-                        ## instead of the CCR record, generate SSF records
-                        recs = []
-
-                        if relevance == 2:
-                            ## on "vital" ranked docs, attempt Streaming
-                            ## Slot Filling (SSF)
-                            for row in scorer.fill_slots(entity_repr):
-
-                                ## these fields differ from the base CCR record:
-                                ssf_conf, slot_name, slot_equiv_id, byte_range = row
-
-                                ## copy CCR record and insert SSF-specific fields:
-                                ssf_rec = copy.deepcopy(ccr_rec)
-                                ssf_rec[4]  = ssf_conf
-                                ssf_rec[8]  = slot_name
-                                ssf_rec[9]  = slot_equiv_id
-                                ssf_rec[10] = byte_range
-
-                                recs.append(ssf_rec)
-
-                    logger.debug('saving %d recs' % len(recs))
-                    for rec in recs:
-                        assert len(rec) == 11, (len(rec), rec)
-
-                        output.write("\t".join(map(str, rec)) + "\n")
-                        output.flush()
-
-                        ## keep count of how many we have save total
-                        num_filter_results += 1
-
-            ## print some speed info every 100 entities
-            if num_docs % 100 == 0:
-                elapsed = time.time() - start_time
-                doc_rate = float(num_docs) / elapsed
-                scoring_rate = float(num_entity_doc_compares) / elapsed
-                logger.info("%d docs, %d scorings in %.1f --> %.3f docs/sec, %.3f compute_relevance/sec" % (
-                        num_docs, num_entity_doc_compares, elapsed, doc_rate, scoring_rate))
+    ## only go up to max_docs
+    if num_docs >= args.max_docs:
+        break
+
+report_hour()
+if output is not None or sweep_runs:
+    checkpoint()
 
 ## store more run info to our official filter_run dict
 filter_run["run_info"]["num_entity_doc_compares"] = num_entity_doc_compares
 filter_run["run_info"]["num_filter_results"] = num_filter_results
 filter_run["run_info"]["elapsed_time"] = time.time() - start_time
 filter_run["run_info"]["num_stream_hours"] = num_stream_hours
+filter_run["run_info"].update(stats_counters())
+## the writer may still be writing the last records
+filter_run["run_info"]["stages"] = stats.summary()
 
 if args.ssf:
     filter_run["task_id"] = "kba-ssf-2013"
@@ -295,12 +779,35 @@ if args.ssf:
 filter_run_json_string = json.dumps(filter_run, indent=4, sort_keys=True)
 ## convert to comment lines
 filter_run_json_string = re.sub("\n", "\n#", filter_run_json_string)
-if print_comments:
+if print_comments and output is not None and not args.watch:
     ## add these comment lines to end of output, and close the output
-    output.write("#%s\n" % filter_run_json_string)
-
-output.close()
+    output.write_comment(filter_run_json_string)
+
+if output is not None:
+    output.close()
+
+for run in sweep_runs:
+    ## the counters of the whole pass, with the lines of this
+    ## configuration
+    run_filter_run = run["filter_run"]
+    run_filter_run["run_info"].update(filter_run["run_info"])
+    run_filter_run["run_info"]["num_filter_results"] = run["num_filter_results"]
+    run["output"].write_comment(re.sub(
+            "\n", "\n#", json.dumps(run_filter_run, indent=4, sort_keys=True)))
+    run["output"].close()
+if score_writer is not None:
+    score_writer.close(filter_run)
+
+dump_metrics()
+if args.profile_stage:
+    profile_output = args.profile_output or args.output + '.prof'
+    stats.dump_profile(profile_output)
+    logger.info('profile of %s stage is stored in %r' % (args.profile_stage, profile_output))
 
 print "#%s\n" % filter_run_json_string
-print "output is stored in %r" % args.output
+if sweep_runs:
+    for run in sweep_runs:
+        print "output of %s is stored in %r" % (run["config"]["name"], run["path"])
+else:
+    print "output is stored in %r" % args.output
 print "# done!"